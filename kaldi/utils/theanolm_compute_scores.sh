@@ -42,19 +42,18 @@ do
 done
 
 mkdir -p "${temp_dir}"
-cut -d' ' -f2- "${text_in}" |
-  awk '$1 != "<s>" { print "<s>", $0 }' |
-  awk '$NF != "</s>" { print $0, "</s>" }' \
-  >"${temp_dir}/text"
-cut -d' ' -f1 "${text_in}" >"${temp_dir}/ids"
 
+# TheanoLM reads the n-best list in Kaldi archive format, adds the sentence
+# start and end tags, and evaluates the common prefixes of the hypotheses of
+# each utterance only once.
 (set -x; theanolm score \
   "${nnlm}" \
-  "${temp_dir}/text" \
+  "${text_in}" \
+  --input-format nbest \
   --output-file "${temp_dir}/scores" \
   --output utterance-scores)
 
-num_ids=$(wc -l <"${temp_dir}/ids")
+num_ids=$(grep -c '[^[:space:]]' "${text_in}" || true)
 num_scores=$(wc -l <"${temp_dir}/scores")
 if [ "${num_ids}" -ne "${num_scores}" ]
 then
@@ -62,6 +61,5 @@ then
     exit 1
 fi
 
-paste "${temp_dir}/ids" "${temp_dir}/scores" |
-  awk '{ print $1, -$2; }' >"${scores_out}"
+awk '{ print $1, -$2; }' <"${temp_dir}/scores" >"${scores_out}"
 echo "${script_name}: Wrote NNLM scores to ${scores_out}."
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+from io import StringIO
+import numpy
+from numpy.testing import assert_almost_equal
+import theano
+from theanolm import Vocabulary, Network, Architecture
+from theanolm.scoring import TextScorer, NBestScorer
+
+class TestClassSoftmaxLayer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        classes_path = os.path.join(script_path, 'classes.txt')
+        with open(classes_path) as classes_file:
+            self.vocabulary = Vocabulary.from_file(classes_file,
+                                                   'srilm-classes')
+        self.architecture = Architecture.from_description(StringIO(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=classsoftmax name=output_layer input=hidden_layer\n"))
+
+        numpy.random.seed(1)
+        self.word_ids = numpy.random.randint(
+            0, self.vocabulary.num_words(), size=(6, 3)).astype('int64')
+        self.class_ids = self.vocabulary.word_id_to_class_id[self.word_ids]
+        self.membership_probs = numpy.ones((5, 3), dtype=theano.config.floatX)
+        self.mask = numpy.ones((5, 3), dtype='int8')
+
+    def tearDown(self):
+        pass
+
+    def test_target_probs(self):
+        network = Network(self.architecture, self.vocabulary)
+        self.assertTrue(network.predicts_words)
+        output_probs_function = theano.function(
+            [network.input_word_ids, network.input_class_ids, network.mask],
+            network.output_probs(),
+            givens=[(network.is_training, numpy.int8(0))],
+            on_unused_input='ignore')
+        output_probs = output_probs_function(self.word_ids[:-1],
+                                             self.class_ids[:-1],
+                                             self.mask)
+        self.assertEqual(output_probs.shape,
+                         (5, 3, self.vocabulary.num_words()))
+        assert_almost_equal(output_probs.sum(2), numpy.ones((5, 3)))
+
+        # The target word probabilities are computed from the target class
+        # only, but should match the full distribution. The class membership
+        # probabilities of the vocabulary are not used.
+        scorer = TextScorer(network)
+        membership_probs = self.membership_probs * 0.5
+        logprobs, _ = scorer._target_logprobs_function(
+            self.word_ids, self.class_ids, membership_probs, self.mask)
+        expected = numpy.log(output_probs[
+            numpy.arange(5)[:, None], numpy.arange(3), self.word_ids[1:]])
+        assert_almost_equal(logprobs, expected, decimal=5)
+
+    def test_step_function(self):
+        # The initial weights are so small that the output is almost uniform,
+        # so use larger weights to make the outputs of different networks
+        # differ.
+        network = Network(self.architecture, self.vocabulary)
+        for param in network.get_variables().values():
+            value = numpy.random.normal(size=param.get_value().shape)
+            param.set_value(value.astype(theano.config.floatX))
+        scorer = TextScorer(network)
+        expected, _ = scorer._target_logprobs_function(
+            self.word_ids, self.class_ids, self.membership_probs, self.mask)
+
+        # The single time step network needs the same parameters.
+        params = network.get_variables()
+        network = Network(self.architecture, self.vocabulary,
+                          mode=Network.Mode(minibatch=False))
+        for path, param in network.get_variables().items():
+            param.set_value(params[path].get_value())
+        step_function = NBestScorer(network).step_function
+        state = [numpy.zeros((1, 3, size), dtype=theano.config.floatX)
+                 for size in network.recurrent_state_size]
+        for time_step in range(5):
+            result = step_function(
+                self.word_ids[time_step:time_step + 1],
+                self.class_ids[time_step:time_step + 1],
+                self.word_ids[time_step + 1:time_step + 2],
+                self.class_ids[time_step + 1:time_step + 2],
+                *state)
+            assert_almost_equal(result[0][0], expected[time_step], decimal=5)
+            state = result[1:]
+
+if __name__ == '__main__':
+    unittest.main()
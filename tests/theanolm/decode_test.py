@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+from theanolm.commands.decode import _output_paths
+from theanolm.exceptions import InputError
+
+class TestDecode(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self.temp_dir.name, 'input')
+        self.output_dir = os.path.join(self.temp_dir.name, 'output')
+        os.makedirs(os.path.join(self.input_dir, 'a'))
+        os.makedirs(os.path.join(self.input_dir, 'b'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_output_paths(self):
+        input_paths = [os.path.join(self.input_dir, 'a', 'utt1.slf.gz'),
+                       os.path.join(self.input_dir, 'a', 'utt2.slf'),
+                       os.path.join(self.input_dir, 'b', 'utt3.slf')]
+        self.assertListEqual(
+            _output_paths(input_paths, self.output_dir),
+            [os.path.join(self.output_dir, 'utt1.slf.gz'),
+             os.path.join(self.output_dir, 'utt2.slf'),
+             os.path.join(self.output_dir, 'utt3.slf')])
+
+        # Lattices with the same name in different directories would be written
+        # to the same file.
+        input_paths.append(os.path.join(self.input_dir, 'b', 'utt2.slf'))
+        with self.assertRaises(InputError):
+            _output_paths(input_paths, self.output_dir)
+
+        # The output directory must not contain the input lattices.
+        input_paths = [os.path.join(self.input_dir, 'a', 'utt1.slf'),
+                       os.path.join(self.input_dir, 'b', 'utt2.slf')]
+        with self.assertRaises(InputError):
+            _output_paths(input_paths, os.path.join(self.input_dir, 'a'))
+        relative_dir = os.path.relpath(os.path.join(self.input_dir, 'b'))
+        with self.assertRaises(InputError):
+            _output_paths(input_paths, relative_dir)
+
+if __name__ == '__main__':
+    unittest.main()
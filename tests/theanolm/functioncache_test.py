@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+from io import StringIO
+import numpy
+from numpy.testing import assert_almost_equal
+import theano
+from theanolm import Vocabulary, Network, Architecture, FunctionCache
+from theanolm.scoring import TextScorer
+
+class TestFunctionCache(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+        self.architecture = Architecture.from_description(StringIO(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n"))
+
+        numpy.random.seed(1)
+        self.word_ids = numpy.random.randint(
+            0, self.vocabulary.num_words(), size=(6, 3)).astype('int64')
+        self.class_ids = numpy.array(
+            [[self.vocabulary.word_id_to_class_id[word_id]
+              for word_id in row]
+             for row in self.word_ids], dtype='int64')
+        self.membership_probs = numpy.ones((5, 3), dtype=theano.config.floatX)
+        self.mask = numpy.ones((5, 3), dtype='int8')
+
+    def tearDown(self):
+        pass
+
+    def _logprobs(self, scorer):
+        logprobs, _ = scorer._target_logprobs_function(
+            self.word_ids, self.class_ids, self.membership_probs, self.mask)
+        return logprobs
+
+    def test_get_functions(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            function_cache = FunctionCache(cache_dir)
+
+            # The first scorer compiles the functions and writes them to the
+            # cache. The parameter values of the network should not change.
+            network = Network(self.architecture, self.vocabulary)
+            expected = self._logprobs(TextScorer(network))
+            scorer = TextScorer(network, function_cache=function_cache)
+            assert_almost_equal(self._logprobs(scorer), expected)
+            assert_almost_equal(self._logprobs(TextScorer(network)), expected)
+            cache_files = os.listdir(cache_dir)
+            self.assertEqual(len(cache_files), 1)
+            self.assertTrue(cache_files[0].startswith('target_logprobs-'))
+
+            # A network with different parameters reads the functions from the
+            # cache.
+            network = Network(self.architecture, self.vocabulary)
+            expected = self._logprobs(TextScorer(network))
+            scorer = TextScorer(network, function_cache=function_cache)
+            assert_almost_equal(self._logprobs(scorer), expected)
+            self.assertEqual(os.listdir(cache_dir), cache_files)
+
+            # Different options create a different function.
+            scorer = TextScorer(network, log_normalizer=1.5,
+                                function_cache=function_cache)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,17 @@
 
 import unittest
 import os
+import gzip
+import tempfile
 import mmap
 import numpy
+import h5py
 from numpy.testing import assert_equal
 import theanolm
+from theanolm.parsing import ScoringBatchIterator, PrefetchingBatchIterator
+from theanolm.parsing import BinaryCorpus
 from theanolm.parsing.functions import find_sentence_starts
+from theanolm.parsing.shufflingbatchiterator import SentencePointers
 
 class TestIterators(unittest.TestCase):
     def setUp(self):
@@ -59,6 +65,53 @@ class TestIterators(unittest.TestCase):
         self.assertEqual(self.sentences2_file.readline(), 'kolme kaksi yksi\n')
         self.sentences2_file.seek(0)
 
+    def test_sentence_pointers(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            pointers = SentencePointers([self.sentences1_file,
+                                         self.sentences2_file],
+                                        cache_dir)
+            self.assertEqual(len(pointers), 10)
+            self.assertEqual(pointers.pointer_ranges, [(0, 5), (5, 10)])
+            assert_equal(pointers.file_ids, [0, 0, 0, 0, 0, 1, 1, 1, 1, 1])
+            subset_mmap, position = pointers[6]
+            subset_mmap.seek(position)
+            self.assertEqual(subset_mmap.readline().decode('utf-8'),
+                             'kahdeksan seitsemän kuusi\n')
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            cached_pointers = SentencePointers([self.sentences1_file,
+                                                self.sentences2_file],
+                                               cache_dir)
+            assert_equal(cached_pointers.offsets, pointers.offsets)
+            assert_equal(cached_pointers.file_ids, pointers.file_ids)
+
+    def test_sentence_pointers_cache_key(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, 'cache')
+            paths = [os.path.join(temp_dir, name, 'train.txt')
+                     for name in ['a', 'b']]
+            for path, text in zip(paths, ['yksi\n', 'kaksi\nkolme\n']):
+                os.makedirs(os.path.dirname(path))
+                with open(path, 'w', encoding='utf-8') as text_file:
+                    text_file.write(text)
+
+            # Files with the same name in different directories are cached
+            # separately.
+            for path, num_sentences in zip(paths, [1, 2]):
+                with open(path, encoding='utf-8') as text_file:
+                    pointers = SentencePointers([text_file], cache_dir)
+                    self.assertEqual(len(pointers), num_sentences)
+
+            # The positions are searched again when the size of the file
+            # changes, even if the modification time is the same.
+            stat = os.stat(paths[0])
+            with open(paths[0], 'w', encoding='utf-8') as text_file:
+                text_file.write('yksi\nkaksi\nkolme\n')
+            os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            with open(paths[0], encoding='utf-8') as text_file:
+                pointers = SentencePointers([text_file], cache_dir)
+                self.assertEqual(len(pointers), 3)
+
     def test_shuffling_batch_iterator(self):
         iterator = theanolm.ShufflingBatchIterator([self.sentences1_file,
                                                     self.sentences2_file],
@@ -145,6 +198,67 @@ class TestIterators(unittest.TestCase):
         self.assertEqual(numpy.count_nonzero(iterator._order <= 4), 2)
         self.assertEqual(numpy.count_nonzero(iterator._order >= 5), 4)
 
+    def test_prefetching_batch_iterator(self):
+        def create_iterator():
+            return theanolm.ShufflingBatchIterator([self.sentences1_file,
+                                                    self.sentences2_file],
+                                                   [],
+                                                   self.vocabulary,
+                                                   batch_size=2,
+                                                   max_sequence_length=3)
+
+        def read_epochs(iterator, num_epochs):
+            result = []
+            for _ in range(num_epochs):
+                result.append([batch for batch in iterator])
+            return result
+
+        # The prefetching iterator returns the same mini-batches in the same
+        # order, including a new random order on the next epoch.
+        numpy.random.seed(1)
+        expected = read_epochs(create_iterator(), 2)
+        numpy.random.seed(1)
+        iterator = PrefetchingBatchIterator(create_iterator(), self.vocabulary,
+                                            queue_size=3)
+        epochs = read_epochs(iterator, 2)
+        self.assertEqual(len(epochs[0]), 7)
+        self.assertEqual([len(batches) for batches in epochs],
+                         [len(batches) for batches in expected])
+        for batches, expected_batches in zip(epochs, expected):
+            for batch, expected_batch in zip(batches, expected_batches):
+                word_ids, class_ids, file_ids, mask = batch
+                assert_equal(word_ids, expected_batch[0])
+                assert_equal(class_ids,
+                             self.vocabulary.word_id_to_class_id[word_ids])
+                assert_equal(file_ids, expected_batch[1])
+                assert_equal(mask, expected_batch[2])
+
+        # The saved state corresponds to the mini-batches that have been
+        # returned, not to those that have been read in advance.
+        numpy.random.seed(1)
+        expected_iterator = create_iterator()
+        next(expected_iterator)
+        next(expected_iterator)
+        numpy.random.seed(1)
+        iterator = PrefetchingBatchIterator(create_iterator(), self.vocabulary,
+                                            queue_size=3)
+        next(iterator)
+        next(iterator)
+        with h5py.File('expected', 'w', driver='core',
+                       backing_store=False) as expected_state, \
+             h5py.File('state', 'w', driver='core',
+                       backing_store=False) as state:
+            expected_iterator.get_state(expected_state)
+            iterator.get_state(state)
+            assert_equal(state['iterator']['order'][()],
+                         expected_state['iterator']['order'][()])
+            self.assertEqual(state['iterator'].attrs['next_line'],
+                             expected_state['iterator'].attrs['next_line'])
+
+        # Stopping the thread rewinds to the same position.
+        iterator._stop()
+        assert_equal(next(iterator)[0], next(expected_iterator)[0])
+
     def test_linear_batch_iterator(self):
         iterator = theanolm.LinearBatchIterator(self.sentences1_file,
                                                 self.vocabulary,
@@ -204,5 +318,153 @@ class TestIterators(unittest.TestCase):
                                     1, 1, 1,
                                     1, 1, 1, 1, 1])
 
+    def test_scoring_batch_iterator(self):
+        expected_sentences = ['<s> yksi kaksi </s>',
+                              '<s> kolme neljä viisi </s>',
+                              '<s> kuusi seitsemän kahdeksan </s>',
+                              '<s> yhdeksän </s>',
+                              '<s> kymmenen </s>']
+
+        for bucket_window in [None, 1, 3, 100]:
+            iterator = ScoringBatchIterator(self.sentences1_file,
+                                            self.vocabulary,
+                                            batch_size=2,
+                                            bucket_window=bucket_window)
+            sentences = dict()
+            for word_ids, words, mask, sequence_indices in iterator:
+                self.assertEqual(word_ids.shape, mask.shape)
+                self.assertEqual(len(words), mask.shape[1])
+                self.assertEqual(len(sequence_indices), mask.shape[1])
+                self.assertLessEqual(mask.shape[1], 2)
+                for sequence in range(mask.shape[1]):
+                    sequence_mask = mask[:,sequence]
+                    sequence_word_ids = word_ids[sequence_mask != 0,sequence]
+                    sentence = ' '.join(
+                        self.vocabulary.id_to_word[sequence_word_ids])
+                    self.assertEqual(sentence, ' '.join(words[sequence]))
+                    sentences[sequence_indices[sequence]] = sentence
+            self.assertEqual(
+                [sentences[index] for index in range(len(sentences))],
+                expected_sentences)
+
+        # With a large enough window, sentences of similar length are scored
+        # together.
+        iterator = ScoringBatchIterator(self.sentences1_file,
+                                        self.vocabulary,
+                                        batch_size=2,
+                                        bucket_window=100)
+        batches = [list(sequence_indices)
+                   for _, _, _, sequence_indices in iterator]
+        self.assertEqual(batches, [[2], [0, 1], [3, 4]])
+
+    def test_binary_corpus(self):
+        def read_batches(iterator):
+            return [(word_ids.tolist(), file_ids.tolist(), mask.tolist())
+                    for word_ids, file_ids, mask in iterator]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            corpus1 = BinaryCorpus.from_cache(self.sentences1_file,
+                                              self.vocabulary, cache_dir)
+            corpus2 = BinaryCorpus.from_cache(self.sentences2_file,
+                                              self.vocabulary, cache_dir)
+            self.assertEqual(len(corpus1), 5)
+            self.assertEqual(
+                ' '.join(self.vocabulary.id_to_word[corpus1[1]]),
+                '<s> kolme neljä viisi </s>')
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+
+            # The corpus is read from the cache, if the vocabulary is the same.
+            cached_corpus = BinaryCorpus.from_cache(self.sentences1_file,
+                                                    self.vocabulary, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+            assert_equal(cached_corpus.word_ids, corpus1.word_ids)
+            assert_equal(cached_corpus.offsets, corpus1.offsets)
+
+            # The iterators produce the same mini-batches from word IDs as from
+            # text.
+            text_iterator = theanolm.LinearBatchIterator(
+                [self.sentences1_file, self.sentences2_file],
+                self.vocabulary,
+                batch_size=2,
+                max_sequence_length=4)
+            corpus_iterator = theanolm.LinearBatchIterator(
+                [corpus1, corpus2],
+                self.vocabulary,
+                batch_size=2,
+                max_sequence_length=4)
+            self.assertEqual(read_batches(corpus_iterator),
+                             read_batches(text_iterator))
+
+            numpy.random.seed(1)
+            text_iterator = theanolm.ShufflingBatchIterator(
+                [self.sentences1_file, self.sentences2_file],
+                [0.4, 0.8],
+                self.vocabulary,
+                batch_size=2,
+                max_sequence_length=3)
+            numpy.random.seed(1)
+            corpus_iterator = theanolm.ShufflingBatchIterator(
+                [corpus1, corpus2],
+                [0.4, 0.8],
+                self.vocabulary,
+                batch_size=2,
+                max_sequence_length=3)
+            self.assertEqual(len(corpus_iterator), len(text_iterator))
+            assert_equal(corpus_iterator._order, text_iterator._order)
+            self.assertEqual(read_batches(corpus_iterator),
+                             read_batches(text_iterator))
+
+    def test_binary_corpus_cache_key(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, 'cache')
+            paths = [os.path.join(temp_dir, name, 'train.txt')
+                     for name in ['a', 'b']]
+            for path, text in zip(paths, ['yksi kaksi\n', 'kolme\nneljä\n']):
+                os.makedirs(os.path.dirname(path))
+                with open(path, 'w', encoding='utf-8') as text_file:
+                    text_file.write(text)
+
+            # Files with the same name in different directories are cached
+            # separately.
+            corpora = []
+            for path in paths:
+                with open(path, encoding='utf-8') as text_file:
+                    corpora.append(BinaryCorpus.from_cache(text_file,
+                                                           self.vocabulary,
+                                                           cache_dir))
+            self.assertEqual(len(corpora[0]), 1)
+            self.assertEqual(len(corpora[1]), 2)
+
+            # The corpus is recreated when the size of the file changes, even
+            # if the modification time is the same.
+            stat = os.stat(paths[0])
+            with open(paths[0], 'w', encoding='utf-8') as text_file:
+                text_file.write('yksi kaksi\nkolme\nneljä\n')
+            os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            with open(paths[0], encoding='utf-8') as text_file:
+                corpus = BinaryCorpus.from_cache(text_file,
+                                                 self.vocabulary,
+                                                 cache_dir)
+            self.assertEqual(len(corpus), 3)
+
+    def test_compressed_corpus(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            gzip_path = os.path.join(cache_dir, 'sentences1.txt.gz')
+            with gzip.open(gzip_path, 'wt', encoding='utf-8') as gzip_file:
+                gzip_file.write(self.sentences1_file.read())
+            self.sentences1_file.seek(0)
+
+            with gzip.open(gzip_path, 'rt', encoding='utf-8') as gzip_file:
+                with self.assertRaises(ValueError):
+                    SentencePointers([gzip_file])
+                compressed_corpus = BinaryCorpus.from_cache(gzip_file,
+                                                            self.vocabulary,
+                                                            cache_dir)
+            text_corpus = BinaryCorpus.from_cache(self.sentences1_file,
+                                                  self.vocabulary,
+                                                  cache_dir)
+            assert_equal(compressed_corpus.word_ids, text_corpus.word_ids)
+            assert_equal(compressed_corpus.offsets, text_corpus.offsets)
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,9 +3,13 @@
 
 import unittest
 import os
+import io
 import math
+from numpy.testing import assert_equal
+from theanolm.exceptions import InputError
 from theanolm.scoring.lattice import Lattice
 from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.arraylattice import ArrayLattice
 
 class TestLattice(unittest.TestCase):
     def setUp(self):
@@ -25,6 +29,8 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(fields[1], 'name=va lue')
         self.assertEqual(fields[2], 'WORD="QUOTE')
         self.assertEqual(fields[3], "WORD='CAUSE")
+        fields = lattice._split_slf_line('J=1\tS=1  E=2 W=wo\'rd\n')
+        self.assertEqual(fields, ['J=1', 'S=1', 'E=2', "W=wo'rd"])
 
     def test_split_slf_field(self):
         lattice = SLFLattice(None)
@@ -71,7 +77,7 @@ class TestLattice(unittest.TestCase):
     def test_read_slf_link(self):
         lattice = SLFLattice(None)
         lattice.nodes = [Lattice.Node(id) for id in range(4)]
-        lattice.links = []
+        lattice._allocate_links(4)
         lattice._read_slf_node(0, ['t=0.0'])
         lattice._read_slf_node(1, ['t=1.0'])
         lattice._read_slf_node(2, ['t=2.0'])
@@ -80,6 +86,7 @@ class TestLattice(unittest.TestCase):
         lattice._read_slf_link(1, ['S=1', 'E=2', 'WORD=wo rd', 'acoustic=-0.1', 'language=-0.2'])
         lattice._read_slf_link(2, ['S=2', 'E=3', 'W=word', 'a=-0.3', 'l=-0.4'])
         lattice._read_slf_link(3, ['S=1', 'E=3', 'a=-0.5', 'l=-0.6'])
+        lattice._create_links()
 
         self.assertTrue(lattice.links[0].start_node is lattice.nodes[0])
         self.assertTrue(lattice.links[0].end_node is lattice.nodes[1])
@@ -179,6 +186,9 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(sorted_nodes[6].id, 6)
         self.assertEqual(sorted_nodes[7].id, 7)
         self.assertEqual(sorted_nodes[8].id, 8)
+        array_lattice = ArrayLattice(lattice)
+        self.assertEqual([node.id for node in array_lattice.sorted_nodes()],
+                         [node.id for node in sorted_nodes])
 
         with open(self.lattice_path, 'r') as lattice_file:
             lattice = SLFLattice(lattice_file)
@@ -196,6 +206,124 @@ class TestLattice(unittest.TestCase):
                 self.assertLessEqual(left_node.time, right_node.time)
                 self.assertFalse(reachable(right_node, left_node))
 
+    def test_array_lattice(self):
+        with open(self.lattice_path, 'r') as lattice_file:
+            lattice = SLFLattice(lattice_file)
+        array_lattice = ArrayLattice(lattice)
+        self.assertEqual(len(array_lattice.nodes), len(lattice.nodes))
+        self.assertEqual(len(array_lattice.links), len(lattice.links))
+        self.assertEqual(array_lattice.initial_node.id, lattice.initial_node.id)
+        self.assertEqual(array_lattice.final_node.id, lattice.final_node.id)
+        self.assertEqual(array_lattice.utterance_id, lattice.utterance_id)
+
+        for node, array_node in zip(lattice.nodes, array_lattice.nodes):
+            self.assertEqual(array_node.time, node.time)
+            self.assertIsNone(array_node.best_logprob)
+            self.assertEqual(
+                [link.end_node.id for link in array_node.out_links],
+                [link.end_node.id for link in node.out_links])
+            self.assertEqual(
+                [link.start_node.id for link in array_node.in_links],
+                [link.start_node.id for link in node.in_links])
+        for link, array_link in zip(lattice.links, array_lattice.links):
+            self.assertEqual(array_link.start_node.id, link.start_node.id)
+            self.assertEqual(array_link.end_node.id, link.end_node.id)
+            self.assertEqual(array_link.word, link.word)
+            self.assertEqual(array_link.ac_logprob, link.ac_logprob)
+            self.assertEqual(array_link.lm_logprob, link.lm_logprob)
+
+        array_lattice.nodes[3].best_logprob = -1.5
+        self.assertEqual(array_lattice.nodes[3].best_logprob, -1.5)
+        array_lattice.nodes[3].best_logprob = None
+        self.assertIsNone(array_lattice.nodes[3].best_logprob)
+
+        self.assertEqual(
+            [node.id for node in array_lattice.sorted_nodes()],
+            [node.id for node in lattice.sorted_nodes()])
+
+    def test_array_lattice_from_slf(self):
+        with open(self.lattice_path, 'r') as lattice_file:
+            lattice = ArrayLattice(SLFLattice(lattice_file))
+        with open(self.lattice_path, 'r') as lattice_file:
+            array_lattice = ArrayLattice.from_slf(lattice_file)
+        self.assertEqual(array_lattice.utterance_id, lattice.utterance_id)
+        self.assertEqual(array_lattice.lm_scale, lattice.lm_scale)
+        self.assertEqual(array_lattice.wi_penalty, lattice.wi_penalty)
+        self.assertEqual(array_lattice.initial_node.id, lattice.initial_node.id)
+        self.assertEqual(array_lattice.final_node.id, lattice.final_node.id)
+        self.assertEqual(array_lattice.words, lattice.words)
+        for name in ['node_times', 'link_starts', 'link_ends', 'link_word_ids',
+                     'link_ac_logprobs', 'link_lm_logprobs', 'out_offsets',
+                     'out_link_ids', 'in_offsets', 'in_link_ids']:
+            assert_equal(getattr(array_lattice, name), getattr(lattice, name))
+
+        # Words are moved from the nodes to the links leading to the node, and
+        # the initial and final node are found from the links.
+        lattice_file = io.StringIO(
+            "N=4 L=4\n"
+            "I=0 t=0.0\n"
+            "I=1 t=1.0 W=A\n"
+            "I=2 t=2.0 W=B\n"
+            "I=3 t=3.0 W=!NULL\n"
+            "J=0 S=0 E=1 a=-1.0 l=-2.0\n"
+            "J=1 S=0 E=2 a=-3.0\n"
+            "J=2 S=1 E=3\n"
+            "J=3 S=2 E=3\n")
+        array_lattice = ArrayLattice.from_slf(lattice_file)
+        self.assertEqual(array_lattice.initial_node.id, 0)
+        self.assertEqual(array_lattice.final_node.id, 3)
+        self.assertEqual([link.word for link in array_lattice.links],
+                         ['A', 'B', '!NULL', '!NULL'])
+        self.assertEqual(array_lattice.links[0].ac_logprob, -1.0)
+        self.assertEqual(array_lattice.links[0].lm_logprob, -2.0)
+        self.assertIsNone(array_lattice.links[1].lm_logprob)
+        self.assertEqual(
+            [link.end_node.id for link in array_lattice.nodes[0].out_links],
+            [1, 2])
+        self.assertEqual(
+            [link.start_node.id for link in array_lattice.nodes[3].in_links],
+            [1, 2])
+
+        lattice_file = io.StringIO(
+            "N=2 L=1\n"
+            "I=0\n"
+            "I=1 W=A\n"
+            "J=0 S=0 E=1 W=A\n")
+        with self.assertRaises(InputError):
+            ArrayLattice.from_slf(lattice_file)
+
+    def test_write(self):
+        with open(self.lattice_path, 'r') as lattice_file:
+            lattice = SLFLattice(lattice_file)
+        lattice.links[0].word = 'wo "rd'
+        for log_base in [None, 10]:
+            output_file = io.StringIO()
+            lattice.write(output_file, log_base)
+            output_file.seek(0)
+            written_lattice = SLFLattice(output_file)
+            self.assertEqual(written_lattice.utterance_id, lattice.utterance_id)
+            self.assertAlmostEqual(written_lattice.lm_scale, lattice.lm_scale)
+            self.assertAlmostEqual(written_lattice.wi_penalty,
+                                   lattice.wi_penalty, places=5)
+            self.assertEqual(written_lattice.initial_node.id,
+                             lattice.initial_node.id)
+            self.assertEqual(written_lattice.final_node.id,
+                             lattice.final_node.id)
+            self.assertEqual(len(written_lattice.nodes), len(lattice.nodes))
+            self.assertEqual(len(written_lattice.links), len(lattice.links))
+            for node, written_node in zip(lattice.nodes,
+                                          written_lattice.nodes):
+                self.assertEqual(written_node.time, node.time)
+            for link, written_link in zip(lattice.links,
+                                          written_lattice.links):
+                self.assertEqual(written_link.start_node.id, link.start_node.id)
+                self.assertEqual(written_link.end_node.id, link.end_node.id)
+                self.assertEqual(written_link.word, link.word)
+                self.assertAlmostEqual(written_link.ac_logprob,
+                                       link.ac_logprob, places=2)
+                self.assertAlmostEqual(written_link.lm_logprob,
+                                       link.lm_logprob, places=4)
+
     def test_init(self):
         with open(self.lattice_path, 'r') as lattice_file:
             lattice = SLFLattice(lattice_file)
@@ -4,13 +4,14 @@
 import unittest
 import math
 import os
+import io
 import numpy
 from numpy.testing import assert_equal, assert_almost_equal
 import theano
 from theano import tensor
 from theanolm import Vocabulary
 from theanolm.network import RecurrentState
-from theanolm.scoring import LatticeDecoder, SLFLattice
+from theanolm.scoring import LatticeDecoder, SLFLattice, ArrayLattice
 from theanolm.scoring.lattice import Lattice
 
 class DummyNetwork(object):
@@ -18,9 +19,11 @@ class DummyNetwork(object):
         self.vocabulary = vocabulary
         self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
         self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_word_ids = tensor.matrix('target_word_ids', dtype='int64')
         self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
         self.mask = tensor.matrix('mask', dtype='int64')
         self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.predicts_words = False
         self.recurrent_state_input = [tensor.tensor3('recurrent_state_1', dtype=theano.config.floatX)]
         self.recurrent_state_output = [self.recurrent_state_input[0] + 1]
         self.recurrent_state_size = [3]
@@ -36,6 +39,9 @@ class DummyNetwork(object):
                                 ndim=2)
         return result
 
+    def target_logprobs(self, log_normalizer=None):
+        return tensor.log(self.target_probs())
+
 class DummyLatticeDecoder(LatticeDecoder):
     def __init__(self):
         self._sorted_nodes = [Lattice.Node(id) for id in range(5)]
@@ -65,6 +71,8 @@ class DummyLatticeDecoder(LatticeDecoder):
         self._tokens[3][0].total_logprob = -100.0
         self._tokens[3][0].recombination_hash = 1
         self._sorted_nodes[3].best_logprob = -100.0
+        self._expansions = None
+        self._index_nodes()
 
 class TestLatticeDecoder(unittest.TestCase):
     def setUp(self):
@@ -102,9 +110,12 @@ class TestLatticeDecoder(unittest.TestCase):
         history = [1, 2, 3]
         token1 = LatticeDecoder.Token(history)
         token2 = LatticeDecoder.Token.copy(token1)
-        token2.history.append(4)
-        self.assertSequenceEqual(token1.history, [1, 2, 3])
-        self.assertSequenceEqual(token2.history, [1, 2, 3, 4])
+        token2.history = token2.history.extend(4)
+        self.assertSequenceEqual(list(token1.history), [1, 2, 3])
+        self.assertSequenceEqual(list(token2.history), [1, 2, 3, 4])
+        self.assertEqual(len(token1.history), 3)
+        self.assertEqual(len(token2.history), 4)
+        self.assertIs(token2.history.previous, token1.history)
 
     def test_recompute_hash(self):
         token1 = LatticeDecoder.Token(history=[1, 12, 203, 3004, 23455])
@@ -163,6 +174,37 @@ class TestLatticeDecoder(unittest.TestCase):
         # ln(exp(-1000) * (0.75 * exp(-1002) + 0.25 * exp(-1001)))
         assert_almost_equal(token.total_logprob, -2001.64263, decimal=4)
 
+    def test_recompute_totals(self):
+        def create_tokens():
+            return [
+                LatticeDecoder.Token(history=[1, 2],
+                                     ac_logprob=math.log(0.1),
+                                     lat_lm_logprob=math.log(0.2),
+                                     nn_lm_logprob=math.log(0.3)),
+                LatticeDecoder.Token(history=[1, 2, 3],
+                                     ac_logprob=-1000,
+                                     lat_lm_logprob=-1001,
+                                     nn_lm_logprob=-1002),
+                LatticeDecoder.Token(history=[1],
+                                     ac_logprob=-1.0,
+                                     lat_lm_logprob=float('-inf'),
+                                     nn_lm_logprob=-2.0)]
+
+        for nn_lm_weight in [0.0, 0.25, 1.0]:
+            for linear in [True, False]:
+                tokens = create_tokens()
+                totals = LatticeDecoder.Token.recompute_totals(
+                    tokens, nn_lm_weight, 10.0, -20.0, linear)
+                for token, total in zip(create_tokens(), totals):
+                    token.recompute_total(nn_lm_weight, 10.0, -20.0, linear)
+                    assert_almost_equal(total, token.total_logprob, decimal=3)
+                for token, expected in zip(tokens, create_tokens()):
+                    expected.recompute_total(nn_lm_weight, 10.0, -20.0, linear)
+                    assert_almost_equal(token.lm_logprob, expected.lm_logprob,
+                                        decimal=4)
+                    assert_almost_equal(token.total_logprob,
+                                        expected.total_logprob, decimal=3)
+
     def test_append_word(self):
         decoding_options = {
             'nnlm_weight': 1.0,
@@ -173,7 +215,10 @@ class TestLatticeDecoder(unittest.TestCase):
             'linear_interpolation': False,
             'max_tokens_per_node': 10,
             'beam': None,
-            'recombination_order': None
+            'recombination_order': None,
+            'max_batch_size': None,
+            'state_cache_size': 0,
+            'log_normalizer': None
         }
 
         initial_state = RecurrentState(self.network.recurrent_state_size)
@@ -181,16 +226,16 @@ class TestLatticeDecoder(unittest.TestCase):
         token2 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=initial_state)
         decoder = LatticeDecoder(self.network, decoding_options)
 
-        self.assertSequenceEqual(token1.history, [self.sos_id])
-        self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id])
+        self.assertSequenceEqual(list(token1.history), [self.sos_id])
+        self.assertSequenceEqual(list(token2.history), [self.sos_id, self.yksi_id])
         assert_equal(token1.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
         assert_equal(token2.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
         self.assertEqual(token1.nn_lm_logprob, 0.0)
         self.assertEqual(token2.nn_lm_logprob, 0.0)
 
         decoder._append_word([token1, token2], self.kaksi_id)
-        self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id])
-        self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id])
+        self.assertSequenceEqual(list(token1.history), [self.sos_id, self.kaksi_id])
+        self.assertSequenceEqual(list(token2.history), [self.sos_id, self.yksi_id, self.kaksi_id])
         assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
         assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
         token1_nn_lm_logprob = math.log(self.sos_prob + self.kaksi_prob)
@@ -199,8 +244,8 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
         decoder._append_word([token1, token2], self.eos_id)
-        self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id])
-        self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id])
+        self.assertSequenceEqual(list(token1.history), [self.sos_id, self.kaksi_id, self.eos_id])
+        self.assertSequenceEqual(list(token2.history), [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id])
         assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
         assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
         token1_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
@@ -208,12 +253,102 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
+        token3 = LatticeDecoder.Token(history=[self.sos_id], state=initial_state)
+        token4 = LatticeDecoder.Token(history=[self.sos_id], state=initial_state)
+        decoder._max_batch_size = 1
+        decoder._append_words([token3, token4], [self.yksi_id, self.kaksi_id])
+        self.assertSequenceEqual(list(token3.history), [self.sos_id, self.yksi_id])
+        self.assertSequenceEqual(list(token4.history), [self.sos_id, self.kaksi_id])
+        assert_equal(token3.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(token4.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        self.assertAlmostEqual(token3.nn_lm_logprob, math.log(self.sos_prob + self.yksi_prob))
+        self.assertAlmostEqual(token4.nn_lm_logprob, math.log(self.sos_prob + self.kaksi_prob))
+
         lm_scale = 2.0
         token1.recompute_total(1.0, lm_scale, -0.01)
         token2.recompute_total(1.0, lm_scale, -0.01)
         self.assertAlmostEqual(token1.total_logprob, token1_nn_lm_logprob * lm_scale - 0.03)
         self.assertAlmostEqual(token2.total_logprob, token2_nn_lm_logprob * lm_scale - 0.04)
 
+    def test_state_cache(self):
+        cache = LatticeDecoder.StateCache(2)
+        state = RecurrentState(self.network.recurrent_state_size)
+        self.assertIsNone(cache.get((1, 2), 3))
+        cache.add((1, 2), state, 3, -1.0)
+        cache.add((1, 2), state, 4, -2.0)
+        self.assertEqual(cache.get((1, 2), 3), (state, -1.0))
+        self.assertEqual(cache.get((1, 2), 4), (state, -2.0))
+        self.assertIsNone(cache.get((1, 2), 5))
+        cache.add((1, 3), state, 3, -3.0)
+        # (1, 2) was used more recently than (1, 3).
+        cache.get((1, 2), 3)
+        cache.add((1, 4), state, 3, -4.0)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get((1, 3), 3))
+        self.assertEqual(cache.get((1, 2), 3), (state, -1.0))
+        self.assertEqual(cache.get((1, 4), 3), (state, -4.0))
+
+        decoding_options = {
+            'nnlm_weight': 1.0,
+            'lm_scale': 1.0,
+            'wi_penalty': 0.0,
+            'ignore_unk': False,
+            'unk_penalty': None,
+            'linear_interpolation': False,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': 1,
+            'max_batch_size': None,
+            'state_cache_size': 1,
+            'log_normalizer': None
+        }
+        decoder = LatticeDecoder(self.network, decoding_options)
+        step_function = decoder.step_function
+        num_evaluated = []
+        def counting_step_function(*args):
+            num_evaluated.append(args[0].shape[1])
+            return step_function(*args)
+        decoder.step_function = counting_step_function
+
+        initial_state = RecurrentState(self.network.recurrent_state_size)
+        tokens = [LatticeDecoder.Token(history=[self.sos_id], state=initial_state),
+                  LatticeDecoder.Token(history=[self.yksi_id, self.sos_id], state=initial_state),
+                  LatticeDecoder.Token(history=[self.sos_id], state=initial_state)]
+        decoder._append_words(tokens, [self.kaksi_id, self.kaksi_id, self.yksi_id])
+        self.assertListEqual(num_evaluated, [2])
+        self.assertAlmostEqual(tokens[0].nn_lm_logprob, math.log(self.sos_prob + self.kaksi_prob))
+        self.assertAlmostEqual(tokens[1].nn_lm_logprob, math.log(self.sos_prob + self.kaksi_prob))
+        self.assertAlmostEqual(tokens[2].nn_lm_logprob, math.log(self.sos_prob + self.yksi_prob))
+        self.assertSequenceEqual(list(tokens[1].history), [self.yksi_id, self.sos_id, self.kaksi_id])
+        assert_equal(tokens[1].state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+
+        token = LatticeDecoder.Token(history=[self.sos_id], state=initial_state)
+        decoder._append_word([token], self.yksi_id)
+        self.assertListEqual(num_evaluated, [2])
+        self.assertAlmostEqual(token.nn_lm_logprob, math.log(self.sos_prob + self.yksi_prob))
+
+    def test_suffix_maximum(self):
+        suffix_max = LatticeDecoder.SuffixMaximum(6)
+        self.assertEqual(suffix_max.query(0), -numpy.inf)
+        suffix_max.update(2, -10.0)
+        suffix_max.update(4, -20.0)
+        self.assertEqual(suffix_max.query(0), -10.0)
+        self.assertEqual(suffix_max.query(2), -10.0)
+        self.assertEqual(suffix_max.query(3), -20.0)
+        self.assertEqual(suffix_max.query(5), -numpy.inf)
+        suffix_max.update(4, -30.0)
+        self.assertEqual(suffix_max.query(3), -20.0)
+        suffix_max.update(5, -5.0)
+        self.assertEqual(suffix_max.query(0), -5.0)
+        self.assertEqual(suffix_max.query(5), -5.0)
+
+        values = numpy.random.uniform(-100, 0, size=(50,))
+        suffix_max = LatticeDecoder.SuffixMaximum(len(values))
+        for position in numpy.random.permutation(len(values)):
+            suffix_max.update(position, values[position])
+        for begin in range(len(values)):
+            self.assertEqual(suffix_max.query(begin), values[begin:].max())
+
     def test_prune(self):
         # token recombination
         decoder = DummyLatticeDecoder()
@@ -260,6 +395,25 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
+        # node without time
+        decoder = DummyLatticeDecoder()
+        decoder._max_tokens_per_node = None
+        decoder._recombination_order = None
+        decoder._tokens[3].append(LatticeDecoder.Token())
+        decoder._tokens[3][1].total_logprob = -200.0
+        decoder._tokens[3][1].recombination_hash = 2
+        decoder._beam = 50
+        decoder._prune(decoder._sorted_nodes[3])
+        self.assertEqual(len(decoder._tokens[3]), 1)
+        decoder._prune(decoder._sorted_nodes[2])
+        self.assertEqual(len(decoder._tokens[2]), 2)
+        self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
+        # best_logprob = 0
+        decoder._update_best_logprob(decoder._sorted_nodes[4], 0.0)
+        decoder._prune(decoder._sorted_nodes[2])
+        self.assertEqual(len(decoder._tokens[2]), 1)
+        self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
+
         # max tokens per node
         decoder = DummyLatticeDecoder()
         decoder._beam = None
@@ -280,6 +434,57 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
+    def test_decode_batched_beam(self):
+        vocabulary = Vocabulary.from_word_counts({
+            'A': 1, 'B': 1, 'C': 1, 'D': 1, 'E': 1})
+        projection_vector = tensor.ones(shape=(vocabulary.num_words(),),
+                                        dtype=theano.config.floatX)
+        projection_vector *= 0.05
+        network = DummyNetwork(vocabulary, projection_vector)
+
+        # The token B at node 2 is outside the beam of the token that arrives
+        # at node 3 through node 1, but that is known only after the links
+        # leaving node 1 have been evaluated. The path through node 3 is pruned
+        # later, so B would survive to the final node if node 2 was pruned
+        # before evaluating them.
+        lattice = SLFLattice(io.StringIO(
+            "VERSION=1.1\n"
+            "N=5 L=6\n"
+            "I=0 t=0.00\n"
+            "I=1 t=1.00\n"
+            "I=2 t=2.00\n"
+            "I=3 t=3.00\n"
+            "I=4 t=4.00\n"
+            "J=0 S=0 E=1 W=A a=0.0 l=0.0\n"
+            "J=1 S=0 E=2 W=A a=0.0 l=-1.0\n"
+            "J=2 S=0 E=2 W=B a=0.0 l=-2.8\n"
+            "J=3 S=1 E=3 W=C a=0.0 l=0.0\n"
+            "J=4 S=3 E=4 W=D a=0.0 l=-10.0\n"
+            "J=5 S=2 E=4 W=E a=0.0 l=0.0\n"))
+
+        decoding_options = {
+            'nnlm_weight': 0.0,
+            'lm_scale': 1.0,
+            'wi_penalty': 0.0,
+            'ignore_unk': False,
+            'unk_penalty': None,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': 2.0,
+            'recombination_order': None,
+            'max_batch_size': 1,
+            'state_cache_size': 0,
+            'log_normalizer': None
+        }
+        for max_batch_size in [1, 2, 3, None]:
+            decoding_options['max_batch_size'] = max_batch_size
+            decoder = LatticeDecoder(network, decoding_options)
+            tokens = decoder.decode(lattice)
+            self.assertListEqual(
+                [token.history_words(vocabulary) for token in tokens],
+                [['<s>', 'A', 'E', '</s>']])
+            self.assertAlmostEqual(tokens[0].total_logprob, -1.0)
+
     def test_decode(self):
         vocabulary = Vocabulary.from_word_counts({
             'TO': 1,
@@ -307,11 +512,95 @@ class TestLatticeDecoder(unittest.TestCase):
             'linear_interpolation': True,
             'max_tokens_per_node': None,
             'beam': None,
-            'recombination_order': None
+            'recombination_order': None,
+            'max_batch_size': None,
+            'state_cache_size': 0,
+            'log_normalizer': None
         }
         decoder = LatticeDecoder(network, decoding_options)
         tokens = decoder.decode(self.lattice)
 
+        # Batch size and cache should not affect the result when there's no
+        # pruning.
+        for max_batch_size, state_cache_size in [(1, 0), (3, 0), (3, 1)]:
+            decoding_options['max_batch_size'] = max_batch_size
+            decoding_options['state_cache_size'] = state_cache_size
+            batch_decoder = LatticeDecoder(network, decoding_options)
+            batch_tokens = batch_decoder.decode(self.lattice)
+            self.assertListEqual(
+                [token.history_words(vocabulary) for token in batch_tokens],
+                [token.history_words(vocabulary) for token in tokens])
+            for token, batch_token in zip(tokens, batch_tokens):
+                self.assertAlmostEqual(token.total_logprob,
+                                       batch_token.total_logprob)
+
+        # The compact lattice representation should give identical results.
+        array_tokens = decoder.decode(ArrayLattice(self.lattice))
+        self.assertListEqual(
+            [token.history_words(vocabulary) for token in array_tokens],
+            [token.history_words(vocabulary) for token in tokens])
+        for token, array_token in zip(tokens, array_tokens):
+            self.assertAlmostEqual(token.total_logprob,
+                                   array_token.total_logprob)
+
+        # Dropping tokens outside the beam before evaluating the network should
+        # not change the result.
+        beam_options = dict(decoding_options)
+        beam_options['beam'] = 5.0
+        beam_options['max_tokens_per_node'] = 4
+        beam_decoder = LatticeDecoder(network, beam_options)
+        beam_tokens = beam_decoder.decode(self.lattice)
+        beam_decoder._drop_outside_beam = lambda tokens, *args: tokens
+        nodrop_tokens = beam_decoder.decode(self.lattice)
+        self.assertListEqual(
+            [token.history_words(vocabulary) for token in beam_tokens],
+            [token.history_words(vocabulary) for token in nodrop_tokens])
+        for token, nodrop_token in zip(beam_tokens, nodrop_tokens):
+            self.assertAlmostEqual(token.total_logprob,
+                                   nodrop_token.total_logprob)
+
+        # With a constant softmax normalizer or a positive <unk> penalty, the
+        # network log probabilities may be positive, and the tokens cannot be
+        # dropped before evaluating the network.
+        for option, value in [('log_normalizer', 1.0), ('unk_penalty', 2.0)]:
+            unsafe_options = dict(beam_options)
+            unsafe_options[option] = value
+            unsafe_decoder = LatticeDecoder(network, unsafe_options)
+            unsafe_decoder._drop_outside_beam = None
+            unsafe_tokens = unsafe_decoder.decode(self.lattice)
+            self.assertTrue(unsafe_tokens)
+        num_calls = 0
+        def counting_drop_outside_beam(*args):
+            nonlocal num_calls
+            num_calls += 1
+            return LatticeDecoder._drop_outside_beam(beam_decoder, *args)
+        beam_decoder._drop_outside_beam = counting_drop_outside_beam
+        beam_decoder.decode(self.lattice)
+        self.assertGreater(num_calls, 0)
+
+        # Decoding a rescored lattice using only the lattice LM scores should
+        # give the same paths and scores as decoding the original lattice.
+        rescore_options = dict(decoding_options)
+        rescore_options['nnlm_weight'] = 0.5
+        rescore_options['linear_interpolation'] = False
+        rescore_decoder = LatticeDecoder(network, rescore_options)
+        nnlm_tokens = rescore_decoder.decode(self.lattice)
+        rescored_lattice = rescore_decoder.rescore(self.lattice)
+        lattice_file = io.StringIO()
+        rescored_lattice.write(lattice_file)
+        lattice_file.seek(0)
+        rescored_lattice = SLFLattice(lattice_file)
+        rescore_options['nnlm_weight'] = 0.0
+        lattice_decoder = LatticeDecoder(network, rescore_options)
+        lattice_tokens = lattice_decoder.decode(rescored_lattice)
+        self.assertListEqual(
+            [token.history_words(vocabulary) for token in lattice_tokens],
+            [token.history_words(vocabulary) for token in nnlm_tokens])
+        for token, lattice_token in zip(nnlm_tokens, lattice_tokens):
+            self.assertAlmostEqual(token.total_logprob,
+                                   lattice_token.total_logprob,
+                                   places=3)
+
         # Compare tokens to n-best list given by SRILM lattice-tool.
         log_scale = math.log(10)
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import math
+import os
+import numpy
+import theano
+from theano import tensor
+from theanolm import Vocabulary
+from theanolm.scoring import NBestScorer
+
+class DummyNetwork(object):
+    def __init__(self, vocabulary, projection_vector):
+        self.vocabulary = vocabulary
+        self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
+        self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_word_ids = tensor.matrix('target_word_ids', dtype='int64')
+        self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
+        self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.predicts_words = False
+        self.recurrent_state_input = [tensor.tensor3('recurrent_state_1', dtype=theano.config.floatX)]
+        self.recurrent_state_output = [self.recurrent_state_input[0] + 1]
+        self.recurrent_state_size = [3]
+        self.projection_vector = projection_vector
+
+    def target_probs(self):
+        # The probability depends on the input word, the target word, and the
+        # number of time steps processed (the sum of the state vector is three
+        # times the time step).
+        num_time_steps = self.input_word_ids.shape[0]
+        num_sequences = self.input_word_ids.shape[1]
+        result = self.projection_vector[self.input_word_ids.flatten()]
+        result += self.projection_vector[self.target_class_ids.flatten()]
+        result += self.recurrent_state_input[0].sum(2).flatten() * 0.01
+        result = result.reshape([num_time_steps,
+                                 num_sequences],
+                                ndim=2)
+        return result
+
+    def target_logprobs(self, log_normalizer=None):
+        return tensor.log(self.target_probs())
+
+class TestNBestScorer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+        self.projection_vector = \
+            numpy.arange(1, self.vocabulary.num_words() + 1) * 0.02
+        self.projection_vector = \
+            self.projection_vector.astype(theano.config.floatX)
+        self.dummy_network = DummyNetwork(
+            self.vocabulary, tensor.constant(self.projection_vector))
+
+    def tearDown(self):
+        pass
+
+    def _expected_logprob(self, words, unk_penalty=None):
+        word_ids = self.vocabulary.words_to_ids(words)
+        unk_id = self.vocabulary.word_to_id['<unk>']
+        result = 0.0
+        for time_step in range(len(word_ids) - 1):
+            if (word_ids[time_step + 1] == unk_id) and \
+               (not unk_penalty is None):
+                result += unk_penalty
+                continue
+            prob = self.projection_vector[word_ids[time_step]]
+            prob += self.projection_vector[word_ids[time_step + 1]]
+            prob += 0.03 * time_step
+            result += math.log(prob)
+        return result
+
+    def test_score_hypotheses(self):
+        hypotheses = [['<s>', 'yksi', 'kaksi', 'kolme', '</s>'],
+                      ['<s>', 'yksi', 'kaksi', '</s>'],
+                      ['<s>', 'yksi', 'kaksi', 'kolme', '</s>'],
+                      ['<s>', 'neljä', 'viisi', '</s>'],
+                      ['<s>', 'yksi', 'kuusi', 'kolme', 'neljä', '</s>'],
+                      ['<s>', '</s>']]
+        scorer = NBestScorer(self.dummy_network)
+        logprobs = scorer.score_hypotheses(hypotheses)
+        self.assertEqual(len(logprobs), len(hypotheses))
+        for words, logprob in zip(hypotheses, logprobs):
+            self.assertAlmostEqual(logprob, self._expected_logprob(words),
+                                   places=4)
+        self.assertEqual(scorer.num_words, 26)
+        # Distinct prefixes: yksi, kaksi, kolme, </s> (after kolme),
+        # </s> (after kaksi), neljä, viisi, </s> (after viisi), kuusi, kolme,
+        # neljä, </s> (after neljä), and </s> (after <s>).
+        self.assertEqual(scorer.num_evaluations, 13)
+
+        # <unk> is assigned a constant logprob.
+        hypotheses = [['<s>', 'yksi', 'xxx', 'kolme', '</s>'],
+                      ['<s>', 'yksi', 'kaksi', '</s>']]
+        scorer = NBestScorer(self.dummy_network, unk_penalty=-5)
+        logprobs = scorer.score_hypotheses(hypotheses)
+        self.assertAlmostEqual(logprobs[0],
+                               self._expected_logprob(hypotheses[0], -5),
+                               places=4)
+        self.assertAlmostEqual(logprobs[1],
+                               self._expected_logprob(hypotheses[1]),
+                               places=4)
+        self.assertEqual(scorer.num_unks, 1)
+
+        # <unk> is excluded.
+        scorer = NBestScorer(self.dummy_network, ignore_unk=True)
+        logprobs = scorer.score_hypotheses(hypotheses)
+        self.assertAlmostEqual(logprobs[0],
+                               self._expected_logprob(hypotheses[0], 0),
+                               places=4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+from io import StringIO
+import numpy
+from numpy.testing import assert_almost_equal
+import h5py
+import theano
+from theanolm import Vocabulary, Network, NumpyNetwork, Architecture
+from theanolm.scoring import TextScorer, NBestScorer
+
+class TestNumpyNetwork(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+
+        numpy.random.seed(1)
+        self.word_ids = numpy.random.randint(
+            0, self.vocabulary.num_words(), size=(6, 3)).astype('int64')
+        self.class_ids = numpy.array(
+            [[self.vocabulary.word_id_to_class_id[word_id]
+              for word_id in row]
+             for row in self.word_ids], dtype='int64')
+        self.membership_probs = numpy.ones((5, 3), dtype=theano.config.floatX)
+        self.mask = numpy.ones((5, 3), dtype='int8')
+        self.mask[3:, 1] = 0
+
+    def tearDown(self):
+        pass
+
+    def _create_networks(self, description, mode=None):
+        architecture = Architecture.from_description(StringIO(description))
+        network = Network(architecture, self.vocabulary, mode=mode)
+        state = h5py.File('in-memory.h5', 'w', driver='core',
+                          backing_store=False)
+        network.get_state(state)
+        numpy_network = NumpyNetwork(architecture, self.vocabulary, state)
+        state.close()
+        return network, numpy_network
+
+    def _assert_same_logprobs(self, network, numpy_network,
+                              log_normalizer=None):
+        theano_scorer = TextScorer(network, log_normalizer=log_normalizer)
+        numpy_scorer = TextScorer(numpy_network, log_normalizer=log_normalizer)
+        args = (self.word_ids, self.class_ids, self.membership_probs, self.mask)
+        expected, _ = theano_scorer._target_logprobs_function(*args)
+        logprobs, _ = numpy_scorer._target_logprobs_function(*args)
+        assert_almost_equal(logprobs, expected, decimal=5)
+
+    def test_lstm(self):
+        network, numpy_network = self._create_networks(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n")
+        self._assert_same_logprobs(network, numpy_network)
+        self._assert_same_logprobs(network, numpy_network, log_normalizer=1.5)
+
+    def test_gru_highway(self):
+        network, numpy_network = self._create_networks(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=gru name=hidden_layer1 input=projection_layer size=6\n"
+            "layer type=highwaytanh name=hidden_layer2 input=hidden_layer1 size=6\n"
+            "layer type=dropout name=dropout_layer input=hidden_layer2 dropout_rate=0.2\n"
+            "layer type=tanh name=hidden_layer3 input=dropout_layer size=5\n"
+            "layer type=softmax name=output_layer input=hidden_layer3\n")
+        self._assert_same_logprobs(network, numpy_network)
+
+    def test_hsoftmax(self):
+        network, numpy_network = self._create_networks(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=hsoftmax name=output_layer input=hidden_layer\n")
+        self._assert_same_logprobs(network, numpy_network)
+
+    def test_step_function(self):
+        _, numpy_network = self._create_networks(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n")
+        numpy_network.forward(self.word_ids[:-1], self.class_ids[:-1])
+        expected = numpy_network.target_logprobs(self.class_ids[1:])
+
+        step_function = numpy_network.create_step_function()
+        state = [numpy.zeros((1, 3, size))
+                 for size in numpy_network.recurrent_state_size]
+        for time_step in range(5):
+            result = step_function(
+                self.word_ids[time_step:time_step + 1],
+                self.class_ids[time_step:time_step + 1],
+                self.word_ids[time_step + 1:time_step + 2],
+                self.class_ids[time_step + 1:time_step + 2],
+                *state)
+            assert_almost_equal(result[0][0], expected[time_step])
+            state = result[1:]
+
+    def test_theano_step_function(self):
+        for layer_type in ['lstm', 'gru']:
+            network, numpy_network = self._create_networks(
+                "input type=word name=word_input\n"
+                "layer type=projection name=projection_layer input=word_input size=8\n"
+                "layer type={} name=hidden_layer input=projection_layer size=6\n"
+                "layer type=softmax name=output_layer input=hidden_layer\n"
+                .format(layer_type),
+                mode=Network.Mode(minibatch=False))
+            theano_step = NBestScorer(network).step_function
+            numpy_step = numpy_network.create_step_function()
+            theano_state = [
+                numpy.zeros((1, 3, size), dtype=theano.config.floatX)
+                for size in network.recurrent_state_size]
+            numpy_state = theano_state
+            for time_step in range(5):
+                args = (self.word_ids[time_step:time_step + 1],
+                        self.class_ids[time_step:time_step + 1],
+                        self.word_ids[time_step + 1:time_step + 2],
+                        self.class_ids[time_step + 1:time_step + 2])
+                theano_result = theano_step(*args, *theano_state)
+                numpy_result = numpy_step(*args, *numpy_state)
+                assert_almost_equal(numpy_result[0], theano_result[0],
+                                    decimal=5)
+                theano_state = theano_result[1:]
+                numpy_state = numpy_result[1:]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -50,5 +50,30 @@ class TestProbFunctions(unittest.TestCase):
             interpolate_loglinear(-1001.0, float('-inf'), 1.0, 0.0),
             -1001.0)
 
+    def test_interpolate_linear_array(self):
+        logprobs1 = [math.log(0.2), float('-inf'), math.log(0.3), -1001]
+        logprobs2 = [math.log(0.3), math.log(0.3), float('-inf'), -1002]
+        for weight1 in [0.0, 0.01, 0.25, 0.99, 1.0]:
+            result = interpolate_linear_array(logprobs1, logprobs2, weight1)
+            for index, (logprob1, logprob2) in \
+                enumerate(zip(logprobs1, logprobs2)):
+                self.assertAlmostEqual(
+                    result[index],
+                    interpolate_linear(logprob1, logprob2, weight1),
+                    places=4)
+
+    def test_interpolate_loglinear_array(self):
+        logprobs1 = [-1001.0, float('-inf'), -1001.0]
+        logprobs2 = [-1002.0, -1002.0, float('-inf')]
+        for prior1 in [0.0, 0.25, 1.0]:
+            prior2 = 1.0 - prior1
+            result = interpolate_loglinear_array(logprobs1, logprobs2,
+                                                 prior1, prior2)
+            for index, (logprob1, logprob2) in \
+                enumerate(zip(logprobs1, logprobs2)):
+                self.assertEqual(
+                    result[index],
+                    interpolate_loglinear(logprob1, logprob2, prior1, prior2))
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from theanolm.commands.score import _merge_subwords
+import os
+from io import StringIO
+from theanolm import Vocabulary, Network, Architecture
+from theanolm.scoring import TextScorer
+from theanolm.commands.score import _merge_subwords, _score_utterances
 from numpy.testing import assert_almost_equal
 
 class TestScore(unittest.TestCase):
@@ -53,5 +57,41 @@ class TestScore(unittest.TestCase):
         self.assertIsNone(word_logprobs[2])
         self.assertAlmostEqual(word_logprobs[3], 0.5)
 
+    def test_score_utterances(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+        architecture = Architecture.from_description(StringIO(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n"))
+        scorer = TextScorer(Network(architecture, vocabulary))
+        lines = ['yksi kaksi\n',
+                 '\n',
+                 'kolme neljä viisi\n',
+                 '\n',
+                 '\n',
+                 'kuusi\n',
+                 'seitsemän kahdeksan yhdeksän kymmenen\n']
+        expected = [scorer.score_line(line, vocabulary) for line in lines]
+
+        # Every input line produces one output line, including the empty lines,
+        # so that the scores can be pasted next to utterance IDs.
+        for batch_size, bucket_window in [(1, None), (2, None), (3, 5)]:
+            output_file = StringIO()
+            _score_utterances(StringIO(''.join(lines)), vocabulary, scorer,
+                              output_file, batch_size=batch_size,
+                              bucket_window=bucket_window)
+            scores = output_file.getvalue().splitlines()
+            self.assertEqual(len(scores), len(lines))
+            for score, expected_score in zip(scores, expected):
+                if expected_score is None:
+                    self.assertEqual(float(score), 0.0)
+                else:
+                    self.assertAlmostEqual(float(score), expected_score,
+                                           places=4)
+
 if __name__ == '__main__':
     unittest.main()
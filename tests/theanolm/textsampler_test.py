@@ -12,9 +12,11 @@ class DummyNetwork(object):
         self.vocabulary = vocabulary
         self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
         self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_word_ids = tensor.matrix('target_word_ids', dtype='int64')
         self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
         self.mask = tensor.matrix('mask', dtype='int64')
         self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.predicts_words = False
         self.recurrent_state_input = []
         self.recurrent_state_output = []
         self.recurrent_state_size = []
@@ -3,9 +3,11 @@
 
 import unittest
 import os
+from io import StringIO
 import numpy
+import theano
 from theano import tensor
-from theanolm import Vocabulary
+from theanolm import Vocabulary, Network, Architecture
 from theanolm.scoring import TextScorer
 from numpy.testing import assert_almost_equal
 
@@ -14,13 +16,18 @@ class DummyNetwork(object):
         self.vocabulary = vocabulary
         self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
         self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_word_ids = tensor.matrix('target_word_ids', dtype='int64')
         self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
         self.mask = tensor.matrix('mask', dtype='int64')
         self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.predicts_words = False
 
     def target_probs(self):
         return self.target_class_ids.astype('float32') / 5
 
+    def target_logprobs(self, log_normalizer=None):
+        return tensor.log(self.target_probs())
+
 class TestTextScorer(unittest.TestCase):
     def setUp(self):
         script_path = os.path.dirname(os.path.realpath(__file__))
@@ -112,5 +119,76 @@ class TestTextScorer(unittest.TestCase):
         correct = numpy.log(correct).sum() - 5
         self.assertAlmostEqual(logprob, correct, places=5)
 
+    def test_score_lines(self):
+        lines = ['kaksi kolme',
+                 '',
+                 '<s> neljä </s>',
+                 'viisi kuusi seitsemän kahdeksan yhdeksän']
+        scorer = TextScorer(self.dummy_network)
+        logprobs = scorer.score_lines(lines, self.vocabulary)
+        self.assertEqual(len(logprobs), 4)
+        self.assertIsNone(logprobs[1])
+        num_words = scorer.num_words
+        scorer.num_words = 0
+        for line, logprob in zip(lines, logprobs):
+            if logprob is None:
+                continue
+            self.assertAlmostEqual(logprob,
+                                   scorer.score_line(line, self.vocabulary),
+                                   places=5)
+        self.assertEqual(num_words, scorer.num_words)
+
+        logprobs = scorer.score_lines(['', ''], self.vocabulary)
+        self.assertEqual(logprobs, [None, None])
+
+    def test_log_normalizer(self):
+        architecture = Architecture.from_description(StringIO(
+            "input type=word name=word_input\n"
+            "layer type=projection name=projection_layer input=word_input size=8\n"
+            "layer type=lstm name=hidden_layer input=projection_layer size=6\n"
+            "layer type=softmax name=output_layer input=hidden_layer\n"))
+        network = Network(architecture, self.vocabulary)
+        # Use larger weights than the initial ones, so that the normalizers are
+        # far from the vocabulary size.
+        numpy.random.seed(1)
+        for param in network.get_variables().values():
+            value = numpy.random.normal(size=param.get_value().shape)
+            param.set_value(value.astype(theano.config.floatX))
+
+        word_ids = numpy.random.randint(
+            0, self.vocabulary.num_words(), size=(6, 3)).astype('int64')
+        class_ids = self.vocabulary.word_id_to_class_id[word_ids]
+        mask = numpy.ones((6, 3), dtype='int8')
+        mask[4:, 1] = 0
+        mask[2:, 2] = 0
+
+        # Compute the preactivations of the output layer in NumPy.
+        function = theano.function(
+            [network.input_word_ids, network.input_class_ids,
+             network.target_class_ids, network.mask],
+            [network.layers['hidden_layer'].output,
+             network.unnormalized_logprobs(),
+             network.target_logprobs(1.5),
+             network.log_normalizers()],
+            givens=[(network.is_training, numpy.int8(0))],
+            on_unused_input='ignore')
+        hidden, unnormalized_logprobs, target_logprobs, log_normalizers = \
+            function(word_ids[:-1], class_ids[:-1], class_ids[1:], mask[1:])
+        weight = network.get_variables()['layers/output_layer/input/W']
+        bias = network.get_variables()['layers/output_layer/input/b']
+        preact = hidden.dot(weight.get_value()) + bias.get_value()
+        expected = numpy.log(numpy.exp(preact).sum(axis=2))
+        assert_almost_equal(log_normalizers, expected, decimal=4)
+        expected = numpy.take_along_axis(preact, class_ids[1:, :, None], 2)
+        assert_almost_equal(unnormalized_logprobs, expected[:, :, 0],
+                            decimal=4)
+        assert_almost_equal(target_logprobs, unnormalized_logprobs - 1.5)
+
+        # The estimate is the mean over the words that are not masked out.
+        scorer = TextScorer(network)
+        estimate = scorer.estimate_log_normalizer([(word_ids, None, mask)])
+        expected = (log_normalizers * mask[1:]).sum() / mask[1:].sum()
+        self.assertAlmostEqual(estimate, expected, places=4)
+
 if __name__ == '__main__':
     unittest.main()
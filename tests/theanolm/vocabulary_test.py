@@ -162,5 +162,23 @@ class TestVocabulary(unittest.TestCase):
                                     0.001,
                                     1.0])
 
+    def test_word_probs(self):
+        def assert_matches_classes(vocabulary):
+            word_ids = numpy.arange(vocabulary.num_words()).reshape([1, -1])
+            class_ids, probs = vocabulary.get_class_memberships(word_ids)
+            expected = [vocabulary._word_classes[class_id].get_prob(word_id)
+                        for word_id, class_id in zip(word_ids[0], class_ids[0])]
+            assert_almost_equal(probs[0], expected)
+            for word_id, prob in zip(word_ids[0], expected):
+                self.assertAlmostEqual(vocabulary.get_word_prob(word_id), prob)
+
+        # The dense array of membership probabilities should match the word
+        # classes after construction and after recomputing the probabilities.
+        self.classes_file.seek(0)
+        vocabulary = Vocabulary.from_file(self.classes_file, 'srilm-classes')
+        assert_matches_classes(vocabulary)
+        vocabulary.compute_probs([self.sentences1_file, self.sentences2_file])
+        assert_matches_classes(vocabulary)
+
 if __name__ == '__main__':
     unittest.main()
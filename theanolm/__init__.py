@@ -2,7 +2,8 @@ from theanolm.exceptions import *
 from theanolm.vocabulary import Vocabulary
 from theanolm.parsing import LinearBatchIterator, ShufflingBatchIterator
 from theanolm.parameters import Parameters
-from theanolm.network import Network, Architecture, RecurrentState
+from theanolm.network import Network, Architecture, RecurrentState, NumpyNetwork
 from theanolm.scoring import TextScorer
+from theanolm.functioncache import FunctionCache
 from theanolm.textsampler import TextSampler
 from theanolm.version import __version__
@@ -2,4 +2,5 @@ import theanolm.commands.train
 import theanolm.commands.score
 import theanolm.commands.decode
 import theanolm.commands.sample
+import theanolm.commands.compile
 import theanolm.commands.version
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import theano
+from theanolm import Network, TextSampler, FunctionCache
+from theanolm.scoring import TextScorer, NBestScorer, LatticeDecoder
+
+def add_arguments(parser):
+    argument_group = parser.add_argument_group("files")
+    argument_group.add_argument(
+        'model_path', metavar='MODEL-FILE', type=str,
+        help='the model file whose functions will be compiled')
+    argument_group.add_argument(
+        '--function-cache', metavar='DIR', type=str, required=True,
+        help='directory where to store the compiled Theano functions')
+
+    argument_group = parser.add_argument_group("compilation")
+    argument_group.add_argument(
+        '--functions', metavar='NAME', type=str, nargs='+',
+        default=['score', 'nbest', 'decode', 'sample'],
+        help='compile the functions used by one or more of the commands '
+             '"score" (text input), "nbest" (score with n-best input), '
+             '"decode", and "sample" (default is all)')
+    argument_group.add_argument(
+        '--unk-penalty', metavar='LOGPROB', type=float, default=None,
+        help='compile the text scoring functions for this --unk-penalty '
+             '(default is to use the network to predict <unk> probability)')
+    argument_group.add_argument(
+        '--log-normalizer', metavar='Z', type=float, default=None,
+        help='compile the functions for this --log-normalizer (default is to '
+             'normalize)')
+
+def compile(args):
+    theano.config.compute_test_value = 'off'
+
+    for name in args.functions:
+        if not name in ('score', 'nbest', 'decode', 'sample'):
+            print("Invalid function requested:", name)
+            sys.exit(1)
+
+    function_cache = FunctionCache(args.function_cache)
+
+    if args.unk_penalty is None:
+        ignore_unk = False
+        unk_penalty = None
+    elif args.unk_penalty == 0:
+        ignore_unk = True
+        unk_penalty = None
+    else:
+        ignore_unk = False
+        unk_penalty = args.unk_penalty
+
+    if 'score' in args.functions:
+        network = Network.from_file(args.model_path)
+        print("Compiling text scoring functions.")
+        sys.stdout.flush()
+        TextScorer(network, ignore_unk, unk_penalty,
+                   log_normalizer=args.log_normalizer,
+                   function_cache=function_cache)
+
+    # The other functions evaluate the network one time step at a time.
+    if ('nbest' in args.functions) or ('decode' in args.functions) or \
+       ('sample' in args.functions):
+        network = Network.from_file(args.model_path,
+                                    mode=Network.Mode(minibatch=False))
+        if 'nbest' in args.functions:
+            print("Compiling n-best scoring function.")
+            sys.stdout.flush()
+            NBestScorer(network, log_normalizer=args.log_normalizer,
+                        function_cache=function_cache)
+        if 'decode' in args.functions:
+            print("Compiling lattice decoding function.")
+            sys.stdout.flush()
+            # Only the log normalizer affects the compiled function.
+            decoding_options = {
+                'nnlm_weight': 1.0,
+                'lm_scale': None,
+                'wi_penalty': None,
+                'ignore_unk': False,
+                'unk_penalty': None,
+                'linear_interpolation': False,
+                'max_tokens_per_node': None,
+                'beam': None,
+                'recombination_order': None,
+                'max_batch_size': None,
+                'state_cache_size': 0,
+                'log_normalizer': args.log_normalizer
+            }
+            LatticeDecoder(network, decoding_options,
+                           function_cache=function_cache)
+        if 'sample' in args.functions:
+            print("Compiling text sampling function.")
+            sys.stdout.flush()
+            TextSampler(network, function_cache)
+
+    print("Compiled functions stored in {}.".format(args.function_cache))
@@ -5,11 +5,15 @@ import sys
 import os
 import logging
 import subprocess
+import multiprocessing
+import threading
+import queue
 import numpy
 import theano
-from theanolm import Network
-from theanolm.scoring import LatticeDecoder, SLFLattice
+from theanolm import Network, NumpyNetwork, FunctionCache
+from theanolm.scoring import LatticeDecoder, SLFLattice, ArrayLattice
 from theanolm.filetypes import TextFileType
+from theanolm.exceptions import InputError
 
 def add_arguments(parser):
     argument_group = parser.add_argument_group("files")
@@ -29,6 +33,11 @@ def add_arguments(parser):
         '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
         help='where to write the best paths through the lattices (default '
              'stdout, will be compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--output-dir', metavar='DIR', type=str, default=None,
+        help='with --output slf, write each rescored lattice to DIR using the '
+             'name of the input lattice file (will be compressed if the name '
+             'ends in ".gz"; the input file names have to be unique)')
     argument_group.add_argument(
         '--num-jobs', metavar='J', type=int, default=1,
         help='divide the set of lattice files into J distinct batches, and '
@@ -37,6 +46,11 @@ def add_arguments(parser):
         '--job', metavar='I', type=int, default=0,
         help='the index of the batch that this job should process, between 0 '
              'and J-1')
+    argument_group.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='decode lattices in N parallel processes that share the model '
+             'that has been loaded and compiled once (default 1, requires that '
+             'Theano uses the CPU)')
 
     argument_group = parser.add_argument_group("decoding")
     argument_group.add_argument(
@@ -44,7 +58,8 @@ def add_arguments(parser):
         help='format of the output, one of "ref" (default, utterance ID '
              'followed by words), "trn" (words followed by utterance ID in '
              'parentheses), "full" (utterance ID, acoustic score, language '
-             'score, and number of words, followed by words)')
+             'score, and number of words, followed by words), "slf" (rescored '
+             'lattices, written to --output-dir)')
     argument_group.add_argument(
         '--n-best', metavar='N', type=int, default=1,
         help='print N best paths of each lattice (default 1)')
@@ -75,6 +90,12 @@ def add_arguments(parser):
         help="if LOGPROB is zero, do not include <unk> tokens in perplexity "
              "computation; otherwise use constant LOGPROB as <unk> token score "
              "(default is to use the network to predict <unk> probability)")
+    argument_group.add_argument(
+        '--log-normalizer', metavar='Z', type=float, default=None,
+        help="compute the word probabilities of a self-normalized model (e.g. "
+             "trained using NCE or BlackOut) by subtracting the constant Z "
+             "from the output layer preactivations, instead of normalizing "
+             "the output over the vocabulary (default is to normalize)")
     argument_group.add_argument(
         '--linear-interpolation', action="store_true",
         help="use linear interpolation of language model probabilities, "
@@ -96,6 +117,38 @@ def add_arguments(parser):
              "identical (default is to recombine tokens only if the entire "
              "word history matches)")
 
+    argument_group = parser.add_argument_group("performance")
+    argument_group.add_argument(
+        '--backend', metavar='NAME', type=str, default='theano',
+        help='evaluate the neural network using "theano" (compiles the '
+             'functions before use) or "numpy" (starts immediately, but may '
+             'be slower with large networks) (default "theano")')
+    argument_group.add_argument(
+        '--function-cache', metavar='DIR', type=str, default=None,
+        help='store the compiled Theano functions in DIR and reuse them the '
+             'next time a model with the same architecture is used (the '
+             'functions can be compiled in advance using "theanolm compile")')
+    argument_group.add_argument(
+        '--max-batch-size', metavar='N', type=int, default=1024,
+        help="collect tokens from consecutive lattice nodes and evaluate at "
+             "most N tokens at a time using the neural network (default 1024)")
+    argument_group.add_argument(
+        '--state-cache-size', metavar='MB', type=float, default=0,
+        help="use at most MB megabytes of memory for caching neural network "
+             "states and predictions of word histories that have already been "
+             "evaluated (default 0, which disables the cache); histories are "
+             "limited to --recombination-order words, so with recombination "
+             "the cache may change the result")
+    argument_group.add_argument(
+        '--prefetch-lattices', metavar='N', type=int, default=2,
+        help="read and parse up to N lattices in a background thread while "
+             "decoding, when using a single worker (default 2, 0 reads the "
+             "lattices in the decoding thread)")
+    argument_group.add_argument(
+        '--compact-lattices', action="store_true",
+        help="store each lattice in compact NumPy arrays while decoding, "
+             "which reduces memory consumption with very large lattices")
+
     argument_group = parser.add_argument_group("logging and debugging")
     argument_group.add_argument(
         '--log-file', metavar='FILE', type=str, default='-',
@@ -130,7 +183,15 @@ def decode(args):
     theano.config.profile = args.profile
     theano.config.profile_memory = args.profile
 
-    network = Network.from_file(args.model_path)
+    if args.backend == 'theano':
+        # The decoder evaluates the network one time step at a time.
+        network = Network.from_file(args.model_path,
+                                    mode=Network.Mode(minibatch=False))
+    elif args.backend == 'numpy':
+        network = NumpyNetwork.from_file(args.model_path)
+    else:
+        print("Invalid backend requested:", args.backend)
+        sys.exit(1)
 
     log_scale = 1.0 if args.log_base is None else numpy.log(args.log_base)
 
@@ -156,7 +217,10 @@ def decode(args):
         'linear_interpolation': args.linear_interpolation,
         'max_tokens_per_node': args.max_tokens_per_node,
         'beam': args.beam,
-        'recombination_order': args.recombination_order
+        'recombination_order': args.recombination_order,
+        'max_batch_size': args.max_batch_size,
+        'state_cache_size': args.state_cache_size,
+        'log_normalizer': args.log_normalizer
     }
     logging.debug("DECODING OPTIONS")
     for option_name, option_value in decoding_options.items():
@@ -164,7 +228,12 @@ def decode(args):
 
     print("Building word lattice decoder.")
     sys.stdout.flush()
-    decoder = LatticeDecoder(network, decoding_options)
+    if args.function_cache is None:
+        function_cache = None
+    else:
+        function_cache = FunctionCache(args.function_cache)
+    decoder = LatticeDecoder(network, decoding_options,
+                             function_cache=function_cache)
 
     # Combine paths from command line and lattice list.
     lattices = args.lattices
@@ -173,6 +242,22 @@ def decode(args):
     lattices = [path.strip() for path in lattices]
     # Ignore empty lines in the lattice list.
     lattices = list(filter(None, lattices))
+
+    # The output paths are checked for all the jobs, since they write to the
+    # same directory.
+    if args.output == 'slf':
+        if args.output_dir is None:
+            print("--output-dir is required with --output slf.")
+            sys.exit(1)
+        try:
+            output_paths = _output_paths(lattices, args.output_dir)
+        except InputError as e:
+            print(e)
+            sys.exit(1)
+        os.makedirs(args.output_dir, exist_ok=True)
+    else:
+        output_paths = None
+
     # Pick every Ith lattice, if --num-jobs is specified and > 1.
     if args.num_jobs < 1:
         print("Invalid number of jobs specified:", args.num_jobs)
@@ -181,36 +266,272 @@ def decode(args):
         print("Invalid job specified:", args.job)
         sys.exit(1)
     lattices = lattices[args.job::args.num_jobs]
+    if not output_paths is None:
+        output_paths = output_paths[args.job::args.num_jobs]
+
+    if args.workers < 1:
+        print("Invalid number of workers specified:", args.workers)
+        sys.exit(1)
+    if (args.workers > 1) and (theano.config.device != 'cpu'):
+        print("Multiple workers can be used only when decoding on CPU.")
+        sys.exit(1)
+
+    _init_worker(decoder, network.vocabulary, log_scale, args, output_paths,
+                 len(lattices))
+    if args.workers == 1:
+        prefetched = _prefetch_lattices(lattices, args.prefetch_lattices)
+        for index, (path, lattice) in enumerate(prefetched):
+            lines = _process_lattice(index, path, lattice)
+            for line in lines:
+                args.output_file.write(line + "\n")
+        return
 
-    file_type = TextFileType('r')
-    for index, path in enumerate(lattices):
-        logging.info("Reading word lattice: %s", path)
-        lattice_file = file_type(path)
-        lattice = SLFLattice(lattice_file)
+    # Hand out the largest lattices first, so that the workers won't be left
+    # waiting for one large lattice at the end.
+    tasks = sorted(enumerate(lattices),
+                   key=lambda task: _file_size(task[1]),
+                   reverse=True)
+    # The worker processes are forked, so they inherit the compiled decoder.
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.workers) as pool:
+        # Write the results in input order, as soon as all the previous
+        # lattices have been decoded.
+        results = dict()
+        next_index = 0
+        for index, lines in pool.imap_unordered(_decode_lattice, tasks):
+            results[index] = lines
+            while next_index in results:
+                for line in results.pop(next_index):
+                    args.output_file.write(line + "\n")
+                next_index += 1
+
+# Decoding context of the current process. With multiple workers, the worker
+# processes inherit these from the parent process when they are forked.
+_worker_context = dict()
+
+def _init_worker(decoder, vocabulary, log_scale, args, output_paths,
+                 num_lattices):
+    """Sets the decoding context that ``_decode_lattice()`` uses.
+
+    :type decoder: LatticeDecoder
+    :param decoder: the decoder that will be used to decode the lattices
+
+    :type vocabulary: Vocabulary
+    :param vocabulary: mapping from word IDs to words
+
+    :type log_scale: float
+    :param log_scale: divide log probabilities by this number to convert the log
+                      base
+
+    :type args: argparse.Namespace
+    :param args: the command line arguments
+
+    :type output_paths: list of strs
+    :param output_paths: where to write the rescored lattices of this job, in
+                         the input order, or ``None`` if the output is not a
+                         lattice
+
+    :type num_lattices: int
+    :param num_lattices: total number of lattices to be decoded in this job
+    """
+
+    _worker_context['decoder'] = decoder
+    _worker_context['vocabulary'] = vocabulary
+    _worker_context['log_scale'] = log_scale
+    _worker_context['output'] = args.output
+    _worker_context['output_paths'] = output_paths
+    _worker_context['log_base'] = args.log_base
+    _worker_context['n_best'] = args.n_best
+    _worker_context['job'] = args.job
+    _worker_context['num_lattices'] = num_lattices
+    _worker_context['compact_lattices'] = args.compact_lattices
+
+def _decode_lattice(task):
+    """Reads and decodes a lattice, and formats the output lines.
+
+    :type task: tuple of (int, str)
+    :param task: index of the lattice in the input and path to the lattice file
+
+    :rtype: tuple of (int, list of strs)
+    :returns: the index of the lattice in the input and the output lines
+    """
 
-        if not lattice.utterance_id is None:
-            utterance_id = lattice.utterance_id
+    index, path = task
+    lattice = _read_lattice(path)
+    return index, _process_lattice(index, path, lattice)
+
+def _read_lattice(path):
+    """Reads a lattice file.
+
+    :type path: str
+    :param path: path to the lattice file
+
+    :rtype: Lattice
+    :returns: the lattice; if it doesn't specify an utterance ID, the file name
+              will be used as the utterance ID
+    """
+
+    logging.info("Reading word lattice: %s", path)
+    with TextFileType('r')(path) as lattice_file:
+        if _worker_context['compact_lattices']:
+            lattice = ArrayLattice.from_slf(lattice_file)
         else:
-            utterance_id = os.path.basename(lattice_file.name)
-        logging.info("Utterance `%s' -- %d/%d of job %d",
-                     utterance_id,
-                     index + 1,
-                     len(lattices),
-                     args.job)
-        tokens = decoder.decode(lattice)
-
-        for index in range(min(args.n_best, len(tokens))):
-            line = format_token(tokens[index],
-                                utterance_id,
-                                network.vocabulary,
-                                log_scale,
-                                args.output)
-            args.output_file.write(line + "\n")
+            lattice = SLFLattice(lattice_file)
+    if lattice.utterance_id is None:
+        lattice.utterance_id = os.path.basename(path)
+    return lattice
+
+def _prefetch_lattices(paths, queue_size):
+    """Reads lattice files in a background thread.
+
+    Generates the lattices in the order of ``paths``. The thread reads and
+    parses at most ``queue_size`` lattices ahead of the one that is being
+    processed, so reading the files overlaps with decoding. If reading a
+    lattice fails, the exception is raised when the lattice is requested.
+
+    :type paths: list of strs
+    :param paths: paths to the lattice files
+
+    :type queue_size: int
+    :param queue_size: maximum number of lattices to read in advance; if less
+                       than 1, reads the lattices in the calling thread
+
+    :rtype: generator of (str, Lattice) tuples
+    :returns: generates the path and the lattice read from each file
+    """
+
+    if queue_size < 1:
+        for path in paths:
+            yield path, _read_lattice(path)
+        return
+
+    lattice_queue = queue.Queue(maxsize=queue_size)
+
+    def read_lattices():
+        try:
+            for path in paths:
+                lattice_queue.put((path, _read_lattice(path), None))
+        except Exception as e:
+            lattice_queue.put((path, None, e))
+            return
+        lattice_queue.put(None)
+
+    # A daemon thread won't prevent exiting, if decoding is interrupted while
+    # the thread is waiting for space in the queue.
+    thread = threading.Thread(target=read_lattices, daemon=True)
+    thread.start()
+    while True:
+        item = lattice_queue.get()
+        if item is None:
+            break
+        path, lattice, error = item
+        if not error is None:
+            raise error
+        yield path, lattice
+    thread.join()
+
+def _process_lattice(index, path, lattice):
+    """Decodes a lattice and formats the output lines.
+
+    With ``slf`` output, writes the rescored lattice to the output directory
+    instead, and returns no output lines.
+
+    :type index: int
+    :param index: index of the lattice in the input
+
+    :type path: str
+    :param path: path to the lattice file
+
+    :type lattice: Lattice
+    :param lattice: the lattice read from ``path``
+
+    :rtype: list of strs
+    :returns: the output lines
+    """
+
+    decoder = _worker_context['decoder']
+    logging.info("Utterance `%s' -- %d/%d of job %d",
+                 lattice.utterance_id,
+                 index + 1,
+                 _worker_context['num_lattices'],
+                 _worker_context['job'])
+    if _worker_context['output'] == 'slf':
+        rescored_lattice = decoder.rescore(lattice)
+        output_path = _worker_context['output_paths'][index]
+        logging.info("Writing rescored lattice: %s", output_path)
+        with TextFileType('w')(output_path) as output_file:
+            rescored_lattice.write(output_file, _worker_context['log_base'])
+        return []
+
+    tokens = decoder.decode(lattice)
+
+    lines = []
+    for token in tokens[:_worker_context['n_best']]:
+        lines.append(format_token(token,
+                                  lattice.utterance_id,
+                                  _worker_context['vocabulary'],
+                                  _worker_context['log_scale'],
+                                  _worker_context['output']))
+    return lines
+
+def _output_paths(input_paths, output_dir):
+    """Creates the paths where the rescored lattices will be written.
+
+    Each lattice is written to ``output_dir`` using the name of the input file.
+    Raises ``InputError`` if two input files have the same name, or if an output
+    file would overwrite an input file.
+
+    :type input_paths: list of strs
+    :param input_paths: paths to the input lattice files
+
+    :type output_dir: str
+    :param output_dir: the output directory
+
+    :rtype: list of strs
+    :returns: a path for each input lattice
+    """
+
+    result = [os.path.join(output_dir, os.path.basename(path))
+              for path in input_paths]
+
+    input_files = dict()
+    for path in input_paths:
+        input_files.setdefault(os.path.realpath(path), path)
+    output_files = dict()
+    for input_path, output_path in zip(input_paths, result):
+        real_path = os.path.realpath(output_path)
+        if real_path in input_files:
+            raise InputError("Rescored lattice `{}' would overwrite input "
+                             "lattice `{}'.".format(output_path,
+                                                    input_files[real_path]))
+        if real_path in output_files:
+            raise InputError("Input lattices `{}' and `{}' would be written to "
+                             "the same output file `{}'.".format(
+                                 output_files[real_path],
+                                 input_path,
+                                 output_path))
+        output_files[real_path] = input_path
+    return result
+
+def _file_size(path):
+    """Returns the size of a file, or zero if the size cannot be determined.
+
+    :type path: str
+    :param path: path to a file
+
+    :rtype: int
+    :returns: size of the file in bytes
+    """
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 def format_token(token, utterance_id, vocabulary, log_scale, format):
     """Formats an output line from a token and an utterance ID.
 
-    Reads word IDs from the history list of ``token`` and converts them to words
+    Reads word IDs from the history of ``token`` and converts them to words
     using ``vocabulary``. The history may contain also OOV words as text, so any
     ``str`` will be printed literally.
 
@@ -7,7 +7,8 @@ import subprocess
 import numpy
 import h5py
 import theano
-from theanolm import Vocabulary, Architecture, Network, TextSampler
+from theanolm import Vocabulary, Architecture, Network, NumpyNetwork
+from theanolm import TextSampler, FunctionCache
 from theanolm.filetypes import TextFileType
 
 def add_arguments(parser):
@@ -29,6 +30,17 @@ def add_arguments(parser):
         help='seed to initialize the random state (default is to seed from a '
              'random source provided by the oprating system)')
 
+    argument_group.add_argument(
+        '--backend', metavar='NAME', type=str, default='theano',
+        help='evaluate the neural network using "theano" (compiles the '
+             'functions before use) or "numpy" (starts immediately, but may '
+             'be slower with large networks) (default "theano")')
+    argument_group.add_argument(
+        '--function-cache', metavar='DIR', type=str, default=None,
+        help='store the compiled Theano functions in DIR and reuse them the '
+             'next time a model with the same architecture is used (the '
+             'functions can be compiled in advance using "theanolm compile")')
+
     argument_group = parser.add_argument_group("debugging")
     argument_group.add_argument(
         '--debug', action="store_true",
@@ -51,13 +63,23 @@ def sample(args):
         print("Building neural network.")
         sys.stdout.flush()
         architecture = Architecture.from_state(state)
-        network = Network(architecture, vocabulary, mode=Network.Mode(minibatch=False))
-        print("Restoring neural network state.")
-        network.set_state(state)
+        if args.backend == 'numpy':
+            network = NumpyNetwork(architecture, vocabulary, state)
+        elif args.backend == 'theano':
+            network = Network(architecture, vocabulary, mode=Network.Mode(minibatch=False))
+            print("Restoring neural network state.")
+            network.set_state(state)
+        else:
+            print("Invalid backend requested:", args.backend)
+            sys.exit(1)
 
     print("Building text sampler.")
     sys.stdout.flush()
-    sampler = TextSampler(network)
+    if args.function_cache is None:
+        function_cache = None
+    else:
+        function_cache = FunctionCache(args.function_cache)
+    sampler = TextSampler(network, function_cache)
 
     sequences = sampler.generate(30, args.num_sentences)
     for sequence in sequences:
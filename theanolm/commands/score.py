@@ -4,11 +4,12 @@
 import sys
 import os
 import subprocess
+from itertools import islice
 import numpy
 import theano
-from theanolm import Network
-from theanolm.parsing import ScoringBatchIterator
-from theanolm.scoring import TextScorer
+from theanolm import Network, NumpyNetwork, LinearBatchIterator, FunctionCache
+from theanolm.parsing import ScoringBatchIterator, utterance_from_line
+from theanolm.scoring import TextScorer, NBestScorer
 from theanolm.filetypes import TextFileType
 
 def add_arguments(parser):
@@ -24,12 +25,21 @@ def add_arguments(parser):
         '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
         help='where to write the statistics (default stdout, will be '
              'compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--input-format', metavar='FORMAT', type=str, default='text',
+        help='format of the input file, either "text" (one sentence per line) '
+             'or "nbest" (n-best list where each line starts with an ID in '
+             'Kaldi archive format, utterance ID followed by a dash and the '
+             'hypothesis number, e.g. "utt-1"; requires "utterance-scores" '
+             'output) (default "text")')
 
     argument_group = parser.add_argument_group("scoring")
     argument_group.add_argument(
         '--output', metavar='DETAIL', type=str, default='perplexity',
         help='what to output, one of "perplexity", "utterance-scores", '
-             '"word-scores" (default "perplexity")')
+             '"word-scores", or "log-normalizer" (the mean of the logarithm of '
+             'the softmax normalizer, for use with --log-normalizer) (default '
+             '"perplexity")')
     argument_group.add_argument(
         '--log-base', metavar='B', type=int, default=None,
         help='convert output log probabilities to base B (default is the '
@@ -39,6 +49,31 @@ def add_arguments(parser):
         help='if LOGPROB is zero, do not include <unk> tokens in perplexity '
              'computation; otherwise use constant LOGPROB as <unk> token score '
              '(default is to use the network to predict <unk> probability)')
+    argument_group.add_argument(
+        '--log-normalizer', metavar='Z', type=float, default=None,
+        help='compute the word probabilities of a self-normalized model (e.g. '
+             'trained using NCE or BlackOut) by subtracting the constant Z '
+             'from the output layer preactivations, instead of normalizing '
+             'the output over the vocabulary (default is to normalize)')
+    argument_group.add_argument(
+        '--backend', metavar='NAME', type=str, default='theano',
+        help='evaluate the neural network using "theano" (compiles the '
+             'functions before use) or "numpy" (starts immediately, but may '
+             'be slower with large networks) (default "theano")')
+    argument_group.add_argument(
+        '--function-cache', metavar='DIR', type=str, default=None,
+        help='store the compiled Theano functions in DIR and reuse them the '
+             'next time a model with the same architecture is used (the '
+             'functions can be compiled in advance using "theanolm compile")')
+    argument_group.add_argument(
+        '--batch-size', metavar='N', type=int, default=16,
+        help='score N sentences at a time (default 16)')
+    argument_group.add_argument(
+        '--bucket-window', metavar='N', type=int, default=None,
+        help='read N sentences at a time and sort them by length before '
+             'dividing them into mini-batches, so that there is less padding '
+             'in the mini-batches; the output is still written in the input '
+             'order (default is to score the sentences in the input order)')
     argument_group.add_argument(
         '--subwords', metavar='MARKING', type=str, default=None,
         help='the subword vocabulary uses MARKING to indicate how words are '
@@ -47,10 +82,32 @@ def add_arguments(parser):
              'concatenated are prefixed or affixed with +, e.g. "cat+ +s")')
 
 def score(args):
-    network = Network.from_file(args.model_path)
+    if args.input_format == 'nbest':
+        if args.output != 'utterance-scores':
+            print("N-best input requires utterance-scores output.")
+            sys.exit(1)
+        # The hypotheses are evaluated one time step at a time.
+        mode = Network.Mode(minibatch=False)
+    elif args.input_format == 'text':
+        mode = None
+    else:
+        print("Invalid input format requested:", args.input_format)
+        sys.exit(1)
+
+    if args.backend == 'theano':
+        network = Network.from_file(args.model_path, mode=mode)
+    elif args.backend == 'numpy':
+        network = NumpyNetwork.from_file(args.model_path)
+    else:
+        print("Invalid backend requested:", args.backend)
+        sys.exit(1)
 
     print("Building text scorer.")
     sys.stdout.flush()
+    if args.function_cache is None:
+        function_cache = None
+    else:
+        function_cache = FunctionCache(args.function_cache)
     if args.unk_penalty is None:
         ignore_unk = False
         unk_penalty = None
@@ -60,24 +117,47 @@ def score(args):
     else:
         ignore_unk = False
         unk_penalty = args.unk_penalty
-    scorer = TextScorer(network, ignore_unk, unk_penalty)
+
+    if args.input_format == 'nbest':
+        scorer = NBestScorer(network, ignore_unk, unk_penalty,
+                             log_normalizer=args.log_normalizer,
+                             function_cache=function_cache)
+        print("Scoring n-best list.")
+        _score_nbest(args.input_file, scorer, args.output_file, args.log_base)
+        return
+
+    scorer = TextScorer(network, ignore_unk, unk_penalty,
+                        log_normalizer=args.log_normalizer,
+                        function_cache=function_cache)
 
     print("Scoring text.")
-    if args.output == 'perplexity':
+    if args.output == 'log-normalizer':
+        batch_iter = LinearBatchIterator(args.input_file,
+                                         network.vocabulary,
+                                         batch_size=args.batch_size,
+                                         max_sequence_length=None)
+        log_normalizer = scorer.estimate_log_normalizer(batch_iter)
+        args.output_file.write("Mean log normalizer: {}\n".format(
+            log_normalizer))
+    elif args.output == 'perplexity':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, False)
+                    args.output_file, args.log_base, args.subwords, False,
+                    args.batch_size, args.bucket_window)
     elif args.output == 'word-scores':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, True)
+                    args.output_file, args.log_base, args.subwords, True,
+                    args.batch_size, args.bucket_window)
     elif args.output == 'utterance-scores':
         _score_utterances(args.input_file, network.vocabulary, scorer,
-                          args.output_file, args.log_base)
+                          args.output_file, args.log_base, args.batch_size,
+                          args.bucket_window)
     else:
         print("Invalid output format requested:", args.output)
         sys.exit(1)
 
 def _score_text(input_file, vocabulary, scorer, output_file,
-                log_base=None, subword_marking=None, word_level=False):
+                log_base=None, subword_marking=None, word_level=False,
+                batch_size=16, bucket_window=None):
     """Reads text from ``input_file``, computes perplexity using
     ``scorer``, and writes to ``output_file``.
 
@@ -107,13 +187,23 @@ def _score_text(input_file, vocabulary, scorer, output_file,
 
     :type word_level: bool
     :param word_level: if set to True, also writes word-level statistics
+
+    :type batch_size: int
+    :param batch_size: number of sentences to score in one mini-batch
+
+    :type bucket_window: int
+    :param bucket_window: if not None, read this many sentences at a time and
+                          sort them by length before creating mini-batches;
+                          the word-level statistics are still written in the
+                          original order
     """
 
     validation_iter = \
         ScoringBatchIterator(input_file,
                              vocabulary,
-                             batch_size=16,
-                             max_sequence_length=None)
+                             batch_size=batch_size,
+                             max_sequence_length=None,
+                             bucket_window=bucket_window)
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
 
     total_logprob = 0.0
@@ -122,7 +212,11 @@ def _score_text(input_file, vocabulary, scorer, output_file,
     num_words = 0
     num_unks = 0
     num_probs = 0
-    for word_ids, words, mask in validation_iter:
+    num_written = 0
+    # Word-level statistics of sentences that have been scored before all the
+    # preceding sentences, indexed by the sentence index.
+    pending_sentences = dict()
+    for word_ids, words, mask, sequence_indices in validation_iter:
         class_ids, membership_probs = vocabulary.get_class_memberships(word_ids)
         logprobs = scorer.score_batch(word_ids, class_ids, membership_probs,
                                       mask)
@@ -151,11 +245,19 @@ def _score_text(input_file, vocabulary, scorer, output_file,
             num_sentences += 1
 
             if word_level:
-                output_file.write("# Sentence {0}\n".format(num_sentences))
-                _write_word_scores(merged_words, merged_logprobs, output_file,
-                                   log_scale)
-                output_file.write("Sentence perplexity: {0}\n\n".format(
-                    numpy.exp(-seq_logprob / len(seq_logprobs))))
+                pending_sentences[sequence_indices[seq_index]] = \
+                    (merged_words, merged_logprobs,
+                     numpy.exp(-seq_logprob / len(seq_logprobs)))
+
+        while num_written in pending_sentences:
+            merged_words, merged_logprobs, seq_perplexity = \
+                pending_sentences.pop(num_written)
+            num_written += 1
+            output_file.write("# Sentence {0}\n".format(num_written))
+            _write_word_scores(merged_words, merged_logprobs, output_file,
+                               log_scale)
+            output_file.write("Sentence perplexity: {0}\n\n".format(
+                seq_perplexity))
 
     output_file.write("Number of sentences: {0}\n".format(num_sentences))
     output_file.write("Number of words: {0}\n".format(num_words))
@@ -288,14 +390,15 @@ def _write_word_scores(words, logprobs, output_file, log_scale):
                 predicted, history, logprob))
 
 def _score_utterances(input_file, vocabulary, scorer, output_file,
-                      log_base=None):
+                      log_base=None, batch_size=16, bucket_window=None):
     """Reads utterances from ``input_file``, computes LM scores using
     ``scorer``, and writes one score per line to ``output_file``.
 
     Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
     inserted at the beginning and the end of each utterance, if they're missing.
-    Empty lines will be ignored, instead of interpreting them as the empty
-    sentence ``<s> </s>``.
+    Empty lines are not interpreted as the empty sentence ``<s> </s>``, but
+    their score is written as zero, so that the output contains one line for
+    each input line.
 
     :type input_file: file object
     :param input_file: a file that contains the input sentences in SRILM n-best
@@ -315,19 +418,48 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     :type log_base: int
     :param log_base: if set to other than None, convert log probabilities to
                      this base
+
+    :type batch_size: int
+    :param batch_size: number of sentences to score in one mini-batch
+
+    :type bucket_window: int
+    :param bucket_window: if not None, read this many sentences at a time and
+                          sort them by length before creating mini-batches
     """
 
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
-
-    for line_num, line in enumerate(input_file):
-        lm_score = scorer.score_line(line, vocabulary)
-        if lm_score is None:
-            continue
-        lm_score /= log_scale
-        output_file.write(str(lm_score) + '\n')
-        if (line_num + 1) % 1000 == 0:
-            print("{0} sentences scored.".format(line_num + 1))
-        sys.stdout.flush()
+    if bucket_window is None:
+        window_size = batch_size
+    else:
+        window_size = max(bucket_window, batch_size)
+
+    num_lines = 0
+    while True:
+        lines = list(islice(input_file, window_size))
+        if not lines:
+            break
+
+        order = list(range(len(lines)))
+        if not bucket_window is None:
+            order.sort(key=lambda index: len(lines[index].split()))
+        scores = [None] * len(lines)
+        for begin in range(0, len(order), batch_size):
+            batch = order[begin:begin + batch_size]
+            batch_scores = scorer.score_lines([lines[index] for index in batch],
+                                              vocabulary)
+            for index, lm_score in zip(batch, batch_scores):
+                scores[index] = lm_score
+
+        for lm_score in scores:
+            if lm_score is None:
+                lm_score = 0.0
+            else:
+                lm_score /= log_scale
+            output_file.write(str(lm_score) + '\n')
+        if (num_lines + len(lines)) // 1000 > num_lines // 1000:
+            print("{0} sentences scored.".format(num_lines + len(lines)))
+            sys.stdout.flush()
+        num_lines += len(lines)
 
     if scorer.num_words == 0:
         print("The input file contains no words.")
@@ -337,3 +469,79 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
               "words".format(scorer.num_words,
                              scorer.num_unks,
                              scorer.num_unks / scorer.num_words))
+
+def _score_nbest(input_file, scorer, output_file, log_base=None):
+    """Reads an n-best list from ``input_file``, computes LM scores using
+    ``scorer``, and writes the hypothesis ID and score of each hypothesis to
+    ``output_file``.
+
+    Each line of the input file starts with a hypothesis ID in Kaldi archive
+    format, i.e. an utterance ID followed by a dash and the index of the
+    hypothesis, e.g. ``utt-1``. The rest of the line is the word sequence.
+    Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
+    inserted at the beginning and the end of each hypothesis, if they're
+    missing. Consecutive lines with the same utterance ID are scored together,
+    so that the common prefixes of the hypotheses are evaluated only once.
+
+    :type input_file: file object
+    :param input_file: a file that contains the n-best list
+
+    :type scorer: NBestScorer
+    :param scorer: an n-best list scorer
+
+    :type output_file: file object
+    :param output_file: a file where to write the hypothesis IDs and log
+                        probabilities
+
+    :type log_base: int
+    :param log_base: if set to other than None, convert log probabilities to
+                     this base
+    """
+
+    log_scale = 1.0 if log_base is None else numpy.log(log_base)
+
+    def write_scores(hypothesis_ids, hypotheses):
+        logprobs = scorer.score_hypotheses(hypotheses)
+        for hypothesis_id, logprob in zip(hypothesis_ids, logprobs):
+            output_file.write("{} {}\n".format(hypothesis_id,
+                                               str(logprob / log_scale)))
+
+    utterance_id = None
+    hypothesis_ids = []
+    hypotheses = []
+    num_utterances = 0
+    for line in input_file:
+        fields = line.split(maxsplit=1)
+        if not fields:
+            continue
+        hypothesis_id = fields[0]
+        words = fields[1] if len(fields) > 1 else ''
+        words = utterance_from_line(words) or ['<s>', '</s>']
+        if '-' in hypothesis_id:
+            line_utterance_id = hypothesis_id.rsplit('-', 1)[0]
+        else:
+            line_utterance_id = hypothesis_id
+        if (line_utterance_id != utterance_id) and hypotheses:
+            write_scores(hypothesis_ids, hypotheses)
+            hypothesis_ids = []
+            hypotheses = []
+            num_utterances += 1
+            if num_utterances % 100 == 0:
+                print("{0} utterances scored.".format(num_utterances))
+                sys.stdout.flush()
+        utterance_id = line_utterance_id
+        hypothesis_ids.append(hypothesis_id)
+        hypotheses.append(words)
+    if hypotheses:
+        write_scores(hypothesis_ids, hypotheses)
+
+    if scorer.num_words == 0:
+        print("The input file contains no words.")
+    else:
+        print("{0} words processed, including start-of-sentence and "
+              "end-of-sentence tags, and {1} ({2:.1f} %) out-of-vocabulary "
+              "words. The network was evaluated for {3} words.".format(
+                  scorer.num_words,
+                  scorer.num_unks,
+                  100 * scorer.num_unks / scorer.num_words,
+                  scorer.num_evaluations))
@@ -3,12 +3,14 @@
 
 import sys
 import mmap
+import tempfile
 import logging
 import numpy
 import h5py
 import theano
 from theanolm import Vocabulary, Architecture, Network
 from theanolm import LinearBatchIterator
+from theanolm.parsing import BinaryCorpus
 from theanolm.training import Trainer, create_optimizer
 from theanolm.scoring import TextScorer
 from theanolm.filetypes import TextFileType
@@ -30,6 +32,19 @@ def add_arguments(parser):
         help='text file containing validation data for early stopping (UTF-8, '
              'one sentence per line, assumed to be compressed if the name ends '
              'in ".gz")')
+    argument_group.add_argument(
+        '--corpus-cache', metavar='DIR', type=str, default=None,
+        help='convert the training files into word IDs and store them in '
+             'memory-mapped binary files in directory DIR, or use the files '
+             'from a previous run, if they were created using the same '
+             'vocabulary (default is to read the text files on every epoch, '
+             'or use a temporary directory if the files are compressed)')
+    argument_group.add_argument(
+        '--sentence-index-cache', metavar='DIR', type=str, default=None,
+        help='store the positions of the sentences in the training files in '
+             'directory DIR, or read them from there, if the training files '
+             'have not been modified since (default is to find the positions '
+             'on every run)')
     argument_group.add_argument(
         '--vocabulary', metavar='FILE', type=str, default=None,
         help='word or class vocabulary to be used in the neural network input '
@@ -65,6 +80,11 @@ def add_arguments(parser):
     argument_group.add_argument(
         '--batch-size', metavar='N', type=int, default=16,
         help='each mini-batch will contain N sentences (default 16)')
+    argument_group.add_argument(
+        '--prefetch-batches', metavar='N', type=int, default=4,
+        help='prepare N mini-batches in advance in a background thread, so '
+             'that reading the training data overlaps with the parameter '
+             'updates; 0 disables prefetching (default 4)')
     argument_group.add_argument(
         '--validation-frequency', metavar='N', type=int, default='5',
         help='cross-validate for reducing learning rate or early stopping N '
@@ -135,6 +155,12 @@ def add_arguments(parser):
         help="if LOGPROB is zero, do not include <unk> tokens in perplexity "
              "computation; otherwise use constant LOGPROB as <unk> token score "
              "(default is to use the network to predict <unk> probability)")
+    argument_group.add_argument(
+        '--log-normalizer', metavar='Z', type=float, default=None,
+        help="compute the validation set probabilities by subtracting the "
+             "constant Z from the output layer preactivations, instead of "
+             "normalizing the output over the vocabulary (may be useful with "
+             "NCE or BlackOut; default is to normalize)")
     argument_group.add_argument(
         '--weights', metavar='LAMBDA', type=float, nargs='*', default=[],
         help='scale a mini-batch update by LAMBDA if the data is from the '
@@ -265,6 +291,8 @@ def train(args):
         training_options = {
             'batch_size': args.batch_size,
             'sequence_length': args.sequence_length,
+            'prefetch_batches': args.prefetch_batches,
+            'sentence_index_cache': args.sentence_index_cache,
             'validation_frequency': args.validation_frequency,
             'patience': args.patience,
             'stopping_criterion': args.stopping_criterion,
@@ -304,9 +332,30 @@ def train(args):
                   "files.")
             sys.exit(1)
 
+        # Compressed files cannot be accessed randomly, so they are always
+        # converted into word IDs. Without --corpus-cache the converted files
+        # are removed when the program exits.
+        corpus_cache = args.corpus_cache
+        if corpus_cache is None and \
+           any(x.name.endswith('.gz') for x in args.training_set):
+            print("Training data is compressed. The word IDs will be stored in "
+                  "a temporary directory.")
+            temp_dir = tempfile.TemporaryDirectory(prefix='theanolm-')
+            corpus_cache = temp_dir.name
+
+        if corpus_cache is None:
+            training_files = args.training_set
+        else:
+            print("Converting training data into word IDs.")
+            sys.stdout.flush()
+            training_files = [
+                BinaryCorpus.from_cache(training_file, vocabulary,
+                                        corpus_cache)
+                for training_file in args.training_set]
+
         print("Creating trainer.")
         sys.stdout.flush()
-        trainer = Trainer(training_options, vocabulary, args.training_set,
+        trainer = Trainer(training_options, vocabulary, training_files,
                           args.sampling)
         trainer.set_logging(args.log_interval)
 
@@ -338,13 +387,17 @@ def train(args):
         if not args.validation_file is None:
             print("Building text scorer for cross-validation.")
             sys.stdout.flush()
-            scorer = TextScorer(network, ignore_unk, unk_penalty, args.profile)
+            scorer = TextScorer(network, ignore_unk, unk_penalty, args.profile,
+                                args.log_normalizer)
             print("Validation text:", args.validation_file.name)
-            validation_mmap = mmap.mmap(args.validation_file.fileno(),
-                                        0,
-                                        prot=mmap.PROT_READ)
+            if args.validation_file.name.endswith('.gz'):
+                validation_data = args.validation_file
+            else:
+                validation_data = mmap.mmap(args.validation_file.fileno(),
+                                            0,
+                                            prot=mmap.PROT_READ)
             validation_iter = \
-                LinearBatchIterator(validation_mmap,
+                LinearBatchIterator(validation_data,
                                     vocabulary,
                                     batch_size=args.batch_size,
                                     max_sequence_length=None)
@@ -364,3 +417,8 @@ def train(args):
             network.set_state(state)
             perplexity = scorer.compute_perplexity(validation_iter)
             print("Best validation set perplexity:", perplexity)
+            if args.cost in ('nce', 'blackout'):
+                # Self-normalized models can be used with this constant
+                # normalizer.
+                log_normalizer = scorer.estimate_log_normalizer(validation_iter)
+                print("Mean log normalizer on validation set:", log_normalizer)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+import logging
+import tempfile
+import numpy
+import theano
+from theanolm.version import __version__
+
+class FunctionCache(object):
+    """Persistent Cache of Compiled Theano Functions
+
+    Compiling the Theano functions can take most of the time of a short
+    scoring job. This class stores the compiled functions in a directory, so
+    that they can be reused by later invocations. The functions are identified
+    by the network architecture, vocabulary size and word classes, Theano
+    configuration, and the role of the function, together with any options
+    that affect the computation graph. The parameter values are not part of
+    the key, so any model that has the same architecture can reuse the
+    functions. The values are removed from the cached functions, and copied
+    from the network when a function is loaded.
+    """
+
+    def __init__(self, cache_dir):
+        """Creates the cache directory, if it doesn't exist.
+
+        :type cache_dir: str
+        :param cache_dir: directory where the compiled functions are stored
+        """
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._cache_dir = cache_dir
+
+    def get_functions(self, network, role, options, create_functions):
+        """Returns compiled functions for a network, either from the cache or
+        by calling ``create_functions()``.
+
+        If the functions are not found in the cache, or the cache file cannot
+        be read, ``create_functions()`` is called to compile them, and they are
+        written to the cache.
+
+        :type network: Network
+        :param network: the neural network whose parameters the functions use
+
+        :type role: str
+        :param role: identifies what the functions compute, e.g.
+                     "step_predictor"
+
+        :type options: dict
+        :param options: any options that affect the computation graph
+
+        :type create_functions: callable
+        :param create_functions: a function that takes no arguments and
+                                 returns a list of compiled Theano functions
+
+        :rtype: list of theano.compile.function_module.Functions
+        :returns: the compiled functions
+        """
+
+        path = os.path.join(self._cache_dir,
+                            role + '-' + self._key(network, role, options))
+        path += '.pkl'
+
+        if os.path.exists(path):
+            try:
+                functions = self._load(path, network)
+                logging.debug("Loaded compiled functions from `%s'.", path)
+                return functions
+            except Exception as e:
+                logging.warning("Unable to read compiled functions from "
+                                "`%s': %s", path, str(e))
+
+        functions = create_functions()
+        try:
+            self._save(path, network, functions)
+            logging.debug("Wrote compiled functions to `%s'.", path)
+        except Exception as e:
+            logging.warning("Unable to write compiled functions to `%s': %s",
+                            path, str(e))
+        return functions
+
+    @staticmethod
+    def _key(network, role, options):
+        """Computes a string that identifies the computation graph of a
+        function.
+
+        :type network: Network
+        :param network: the neural network object
+
+        :type role: str
+        :param role: identifies what the function computes
+
+        :type options: dict
+        :param options: any options that affect the computation graph
+
+        :rtype: str
+        :returns: a hexadecimal SHA-1 digest
+        """
+
+        architecture = network.architecture
+        vocabulary = network.vocabulary
+        description = {
+            'inputs': architecture.inputs,
+            'layers': architecture.layers,
+            'output_layer': architecture.output_layer,
+            'num_words': vocabulary.num_words(),
+            'num_classes': vocabulary.num_classes(),
+            'word_classes': hashlib.sha1(
+                vocabulary.word_id_to_class_id.astype('int64')).hexdigest(),
+            'minibatch': network.mode.minibatch,
+            'role': role,
+            'options': options,
+            'theanolm': __version__,
+            'theano': theano.__version__,
+            'floatX': theano.config.floatX,
+            'device': theano.config.device,
+            'contexts': theano.config.contexts,
+            'mode': str(theano.config.mode),
+            'optimizer': theano.config.optimizer,
+            'linker': theano.config.linker}
+        description = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _shared_variable_ids(network, function):
+        """Identifies the shared variables used by a function.
+
+        :type network: Network
+        :param network: the neural network whose parameters the function uses
+
+        :type function: theano.compile.function_module.Function
+        :param function: a compiled Theano function
+
+        :rtype: list
+        :returns: the parameter path for network parameters, "random" for
+                  random number generator states, and ``None`` for other
+                  shared variables, in the order of ``function.get_shared()``
+        """
+
+        params = network.get_variables()
+        random_states = [update[0] for update in network.random.state_updates]
+        result = []
+        for variable in function.get_shared():
+            if params.get(variable.name) is variable:
+                result.append(variable.name)
+            elif any(variable is x for x in random_states):
+                result.append('random')
+            else:
+                result.append(None)
+        return result
+
+    def _save(self, path, network, functions):
+        """Writes compiled functions to a file without the parameter values.
+
+        :type path: str
+        :param path: path to the cache file
+
+        :type network: Network
+        :param network: the neural network whose parameters the functions use
+
+        :type functions: list of theano.compile.function_module.Functions
+        :param functions: the compiled functions
+        """
+
+        shared_ids = [self._shared_variable_ids(network, function)
+                      for function in functions]
+
+        # Replace the parameter values with empty arrays while pickling. The
+        # functions may share variables, so each value is saved only once.
+        saved_values = dict()
+        for function, ids in zip(functions, shared_ids):
+            for variable, id in zip(function.get_shared(), ids):
+                if (id is None) or (id == 'random') or (id in saved_values):
+                    continue
+                value = variable.get_value(borrow=True)
+                saved_values[id] = (variable, value)
+                empty = numpy.zeros((0,) * value.ndim, dtype=value.dtype)
+                variable.set_value(empty)
+
+        # Theano graphs are deep, and pickle needs a large recursion limit.
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 50000))
+        try:
+            with tempfile.NamedTemporaryFile(dir=self._cache_dir,
+                                             suffix='.tmp',
+                                             delete=False) as cache_file:
+                pickle.dump({'functions': functions,
+                             'shared_ids': shared_ids},
+                            cache_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file.name, path)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            for variable, value in saved_values.values():
+                variable.set_value(value, borrow=True)
+
+    @staticmethod
+    def _load(path, network):
+        """Reads compiled functions from a file and copies the parameter values
+        from the network into them.
+
+        :type path: str
+        :param path: path to the cache file
+
+        :type network: Network
+        :param network: the neural network whose parameters the functions use
+
+        :rtype: list of theano.compile.function_module.Functions
+        :returns: the compiled functions
+        """
+
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 50000))
+        reoptimize = theano.config.reoptimize_unpickled_function
+        theano.config.reoptimize_unpickled_function = False
+        try:
+            with open(path, 'rb') as cache_file:
+                cached = pickle.load(cache_file)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+            theano.config.reoptimize_unpickled_function = reoptimize
+
+        params = network.get_variables()
+        for function, ids in zip(cached['functions'], cached['shared_ids']):
+            for variable, id in zip(function.get_shared(), ids):
+                if id is None:
+                    continue
+                if id == 'random':
+                    # Seed the random number generator from the network, so
+                    # that the cached state is not reused.
+                    num_streams = variable.get_value(borrow=True).shape[0]
+                    variable.set_value(network.random.get_substream_rstates(
+                        num_streams, theano.config.floatX))
+                else:
+                    variable.set_value(params[id].get_value(borrow=True),
+                                       borrow=True)
+        return cached['functions']
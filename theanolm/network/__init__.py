@@ -1,3 +1,4 @@
 from theanolm.network.network import Network
 from theanolm.network.architecture import Architecture
 from theanolm.network.recurrentstate import RecurrentState
+from theanolm.network.numpynetwork import NumpyNetwork
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import numpy
+import theano.tensor as tensor
+from theanolm.network.basiclayer import BasicLayer
+
+class ClassSoftmaxLayer(BasicLayer):
+    """Class-Factored Softmax Output Layer
+
+    The output layer factors the word probabilities using the word classes of
+    the vocabulary: p(word | h) = p(class | h) p(word | class, h). Both factors
+    are computed by the network, so unlike with a class-based model, the
+    probabilities of the words inside a class are not fixed. The target
+    probabilities need a softmax over the classes and a softmax over the words
+    of the target class only. The classes are padded to the size of the largest
+    class, so the cost per target word is proportional to the number of classes
+    plus the size of the largest class. Classes of equal size are the most
+    efficient.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initializes the parameters used by this layer.
+        """
+
+        super().__init__(*args, **kwargs)
+
+        vocabulary = self._network.vocabulary
+        num_classes = self.output_size
+        num_words = vocabulary.num_words()
+
+        # Arrange the words of each class into a row of a matrix. The rows are
+        # padded to the size of the largest class, and the padding is masked
+        # out.
+        word_id_to_class_id = vocabulary.word_id_to_class_id.astype('int64')
+        class_sizes = numpy.bincount(word_id_to_class_id,
+                                     minlength=num_classes)
+        max_class_size = class_sizes.max()
+        class_starts = class_sizes.cumsum() - class_sizes
+        sorted_word_ids = numpy.argsort(word_id_to_class_id, kind='mergesort')
+        sorted_class_ids = word_id_to_class_id[sorted_word_ids]
+        word_positions = numpy.zeros(num_words, dtype='int64')
+        word_positions[sorted_word_ids] = \
+            numpy.arange(num_words) - class_starts[sorted_class_ids]
+        class_members = numpy.zeros((num_classes, max_class_size),
+                                    dtype='int64')
+        class_members[word_id_to_class_id, word_positions] = \
+            numpy.arange(num_words)
+        member_mask = numpy.zeros((num_classes, max_class_size), dtype='int8')
+        member_mask[word_id_to_class_id, word_positions] = 1
+        self._word_id_to_class_id = word_id_to_class_id
+        self._word_positions = word_positions
+        self._class_members = class_members
+        self._member_mask = member_mask
+        logging.debug("  num_words=%d max_class_size=%d",
+                      num_words,
+                      max_class_size)
+
+        # Create the parameters. Weight matrix and bias for the classes, and
+        # weight matrix and bias for the words.
+        input_size = sum(x.output_size for x in self.input_layers)
+        self._init_weight('input/W', (input_size, num_classes), scale=0.01)
+        if self._network.class_prior_probs is None:
+            self._init_bias('input/b', num_classes)
+        else:
+            initial_bias = numpy.log(self._network.class_prior_probs + 1e-10)
+            self._init_bias('input/b', num_classes, initial_bias)
+        self._init_weight('word/W', (input_size, num_words), scale=0.01)
+        self._init_bias('word/b', num_words)
+
+    def create_structure(self):
+        """Creates the symbolic graph of this layer.
+
+        The input is always 3-dimensional: the first dimension is the time step,
+        the second dimension are the sequences, and the third dimension is the
+        word projection. When generating text, there's just one sequence and one
+        time step in the input.
+
+        Sets ``self.output_probs`` to the word probabilities of the whole
+        vocabulary, and ``self.target_probs`` to the probabilities of the target
+        words.
+        """
+
+        layer_input = tensor.concatenate([x.output for x in self.input_layers],
+                                         axis=2)
+
+        # Combine the first two dimensions so that softmax is taken
+        # independently for each location.
+        num_time_steps = layer_input.shape[0]
+        num_sequences = layer_input.shape[1]
+        minibatch_size = num_time_steps * num_sequences
+        input_size = sum(x.output_size for x in self.input_layers)
+        layer_input = layer_input.reshape([minibatch_size, input_size])
+
+        word_weight = self._get_param('word/W')
+        word_bias = self._get_param('word/b')
+        class_members = tensor.constant(self._class_members)
+        member_mask = tensor.constant(self._member_mask)
+        # The padding preactivations are replaced with a large negative value
+        # of the same data type, so that the output is not upcast.
+        padding_preact = numpy.dtype(word_weight.dtype).type(-1e30)
+
+        class_preact = self._tensor_preact(layer_input, 'input')
+        class_logprobs = class_preact - self._log_normalizers(class_preact)
+
+        # First create the output for the whole vocabulary. The preactivations
+        # of all the words are arranged by class, normalized within each class,
+        # and then picked back in the order of word IDs.
+        word_preact = tensor.dot(layer_input, word_weight) + word_bias
+        word_preact = word_preact[:, class_members.flatten()]
+        word_preact = word_preact.reshape([minibatch_size,
+                                           self.output_size,
+                                           class_members.shape[1]])
+        word_preact = tensor.switch(member_mask, word_preact, padding_preact)
+        word_logprobs = word_preact - self._log_normalizers(word_preact)
+        word_logprobs += class_logprobs[:, :, None]
+        word_logprobs = word_logprobs.reshape([minibatch_size, -1])
+        flat_indices = self._word_id_to_class_id * self._class_members.shape[1]
+        flat_indices += self._word_positions
+        output_probs = tensor.exp(word_logprobs[:, flat_indices])
+        self.output_probs = output_probs.reshape([num_time_steps,
+                                                  num_sequences,
+                                                  -1])
+
+        # Next create the output for target words. Only the words in the target
+        # class are needed. It can only be used when
+        # self._network.target_class_ids and self._network.target_word_ids are
+        # given to the function.
+        element_ids = tensor.arange(minibatch_size)
+        target_class_ids = self._network.target_class_ids.flatten()
+        target_word_ids = self._network.target_word_ids.flatten()
+        target_members = class_members[target_class_ids]
+        target_weight = word_weight.T[target_members]
+        word_preact = tensor.batched_dot(target_weight, layer_input)
+        word_preact += word_bias[target_members]
+        word_preact = tensor.switch(member_mask[target_class_ids],
+                                    word_preact,
+                                    padding_preact)
+        target_positions = \
+            tensor.constant(self._word_positions)[target_word_ids]
+        target_logprobs = class_logprobs[(element_ids, target_class_ids)]
+        target_logprobs += word_preact[(element_ids, target_positions)]
+        target_logprobs -= self._log_normalizers(word_preact)[:, 0]
+        self.target_probs = tensor.exp(target_logprobs).reshape(
+            [num_time_steps, num_sequences])
+
+    @staticmethod
+    def _log_normalizers(preact):
+        """Computes the logarithm of the softmax normalizer over the last
+        dimension.
+
+        :type preact: TensorVariable
+        :param preact: preactivations
+
+        :rtype: TensorVariable
+        :returns: log normalizers, with the last dimension kept as size one
+        """
+
+        preact_max = preact.max(axis=-1, keepdims=True)
+        result = tensor.exp(preact - preact_max).sum(axis=-1, keepdims=True)
+        return tensor.log(result) + preact_max
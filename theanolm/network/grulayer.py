@@ -67,15 +67,15 @@ class GRULayer(BasicLayer):
         num_time_steps = layer_input.shape[0]
         num_sequences = layer_input.shape[1]
 
-        # Compute the gate and candidate state pre-activations, which don't
-        # depend on the state input from the previous time step.
-        layer_input_preact = self._tensor_preact(layer_input, 'layer_input')
-
         # Weights of the hidden state input of each time step have to be applied
         # inside the loop.
         hidden_state_weights = self._get_param('step_input/W')
 
         if self._network.mode.minibatch:
+            # Compute the gate and candidate state pre-activations, which don't
+            # depend on the state input from the previous time step.
+            layer_input_preact = self._tensor_preact(layer_input, 'layer_input')
+
             sequences = [self._network.mask, layer_input_preact]
             non_sequences = [hidden_state_weights]
             initial_hidden_state = tensor.zeros(
@@ -96,9 +96,13 @@ class GRULayer(BasicLayer):
             hidden_state_input = \
                 self._network.recurrent_state_input[self.hidden_state_index]
 
+            # There is only one time step, so the pre-activations can be
+            # computed using a matrix product, and no sequence is masked out.
+            layer_input_preact = self._tensor_preact(layer_input[0],
+                                                     'layer_input')
             hidden_state_output = self._create_time_step(
-                self._network.mask[0],
-                layer_input_preact[0],
+                None,
+                layer_input_preact,
                 hidden_state_input[0],
                 hidden_state_weights)
 
@@ -127,7 +131,7 @@ class GRULayer(BasicLayer):
 
         :type mask: TensorVariable
         :param mask: a symbolic vector that masks out sequences that are past
-                     the last word
+                     the last word, or None if no sequence is masked out
 
         :type x_preact: TensorVariable
         :param x_preact: concatenation of the input x_(t) pre-activations
@@ -168,6 +172,7 @@ class GRULayer(BasicLayer):
 
         # Apply the mask. None creates a new axis with size 1, causing the mask
         # to be broadcast to all the outputs.
-        h_out = tensor.switch(mask[:,None], h_out, h_in)
+        if not mask is None:
+            h_out = tensor.switch(mask[:,None], h_out, h_in)
 
         return h_out
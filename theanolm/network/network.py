@@ -21,6 +21,7 @@ from theanolm.network.lstmlayer import LSTMLayer
 from theanolm.network.highwaytanhlayer import HighwayTanhLayer
 from theanolm.network.softmaxlayer import SoftmaxLayer
 from theanolm.network.hsoftmaxlayer import HSoftmaxLayer
+from theanolm.network.classsoftmaxlayer import ClassSoftmaxLayer
 from theanolm.network.dropoutlayer import DropoutLayer
 from theanolm.matrixfunctions import test_value
 
@@ -46,6 +47,8 @@ def create_layer(layer_options, *args, **kwargs):
         return SoftmaxLayer(layer_options, *args, **kwargs)
     elif layer_type == 'hsoftmax':
         return HSoftmaxLayer(layer_options, *args, **kwargs)
+    elif layer_type == 'classsoftmax':
+        return ClassSoftmaxLayer(layer_options, *args, **kwargs)
     elif layer_type == 'dropout':
         return DropoutLayer(layer_options, *args, **kwargs)
     else:
@@ -186,7 +189,13 @@ class Network(object):
             self.target_class_ids.tag.test_value = test_value(
                 size=(1, 16), high=vocabulary.num_classes())
 
-        # This input variable is used only for detecting <unk> target words.
+        # A class-factored output layer computes the probabilities of the
+        # target words, instead of their classes, so the class membership
+        # probabilities should not be added to its output.
+        self.predicts_words = isinstance(self.output_layer, ClassSoftmaxLayer)
+
+        # This input variable is used for detecting <unk> target words, and by
+        # the class-factored output layer for selecting the target words.
         self.target_word_ids = tensor.matrix('network/target_word_ids',
                                              dtype='int64')
         if self.mode.minibatch:
@@ -237,8 +246,14 @@ class Network(object):
             layer.create_structure()
 
     @classmethod
-    def from_file(classname, model_path):
+    def from_file(classname, model_path, mode=None):
         """Reads a model from an HDF5 file.
+
+        :type model_path: str
+        :param model_path: path to a HDF5 model file
+
+        :type mode: Network.Mode
+        :param mode: selects mini-batch or single time step processing
         """
 
         with h5py.File(model_path, 'r') as state:
@@ -250,7 +265,7 @@ class Network(object):
             print("Building neural network.")
             sys.stdout.flush()
             architecture = Architecture.from_state(state)
-            result = classname(architecture, vocabulary)
+            result = classname(architecture, vocabulary, mode=mode)
             print("Restoring neural network state.")
             sys.stdout.flush()
             result.set_state(state)
@@ -338,6 +353,9 @@ class Network(object):
     def output_probs(self):
         """Returns the output probabilities for the whole vocabulary.
 
+        The probabilities are for the output classes, except with a
+        class-factored output layer, which outputs word probabilities.
+
         :rtype: TensorVariable
         :returns: a symbolic 3-dimensional matrix that contains a probability
                   for each time step, each sequence, and each output class
@@ -350,7 +368,8 @@ class Network(object):
     def target_probs(self):
         """Returns the output probabilities for the predicted words.
 
-        Can be used only when target_class_ids is given.
+        Can be used only when target_class_ids is given. A class-factored
+        output layer needs also target_word_ids.
 
         :rtype: TensorVariable
         :returns: a symbolic 2-dimensional matrix that contains the target word
@@ -361,6 +380,50 @@ class Network(object):
             raise RuntimeError("The final layer is not an output layer.")
         return self.output_layer.target_probs
 
+    def target_logprobs(self, log_normalizer=None):
+        """Returns the output log probabilities for the predicted words.
+
+        If ``log_normalizer`` is given, the log probabilities are computed from
+        the preactivations of the target words only, by subtracting the constant
+        ``log_normalizer``. Then the softmax over the whole vocabulary is not
+        computed. This is a good approximation with models that have been
+        trained to be self-normalized, e.g. using NCE or BlackOut.
+
+        Can be used only when target_class_ids is given. A class-factored
+        output layer needs also target_word_ids.
+
+        :type log_normalizer: float
+        :param log_normalizer: constant logarithm of the softmax normalizer, or
+                               None to normalize the output exactly
+
+        :rtype: TensorVariable
+        :returns: a symbolic 2-dimensional matrix that contains the target word
+                  log probability for each time step and each sequence
+        """
+
+        if log_normalizer is None:
+            return tensor.log(self.target_probs())
+        log_normalizer = numpy.dtype(theano.config.floatX).type(log_normalizer)
+        return self.unnormalized_logprobs() - log_normalizer
+
+    def log_normalizers(self):
+        """Returns the logarithm of the softmax normalizer.
+
+        The mean of this value over some data can be used as the constant
+        normalizer of a self-normalized model in ``target_logprobs()``.
+
+        Only computed when using softmax output.
+
+        :rtype: TensorVariable
+        :returns: a symbolic 2-dimensional matrix that contains the log
+                  normalizer for each time step and each sequence
+        """
+
+        if not hasattr(self.output_layer, 'log_normalizers'):
+            raise RuntimeError("The final layer is not a softmax layer, and "
+                               "the softmax normalizer is needed.")
+        return self.output_layer.log_normalizers
+
     def unnormalized_logprobs(self):
         """Returns the unnormalized log probabilities for the predicted words.
 
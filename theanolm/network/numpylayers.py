@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from abc import abstractmethod, ABCMeta
+import numpy
+from theanolm.network.weightfunctions import get_submatrix
+
+def sigmoid(x):
+    """Computes the logistic sigmoid function using hyperbolic tangent, which
+    does not overflow with large negative inputs.
+
+    :type x: numpy.ndarray
+    :param x: input values
+
+    :rtype: numpy.ndarray
+    :returns: sigmoid of the input values
+    """
+
+    return 0.5 * (numpy.tanh(0.5 * x) + 1.0)
+
+def log_softmax(preact):
+    """Computes the logarithm of softmax over the last dimension.
+
+    :type preact: numpy.ndarray
+    :param preact: preactivations, the last dimension being the output classes
+
+    :rtype: numpy.ndarray
+    :returns: log probabilities in the same shape as ``preact``
+    """
+
+    return preact - log_normalizer(preact)[..., None]
+
+def log_normalizer(preact):
+    """Computes the logarithm of the softmax normalizer over the last dimension.
+
+    :type preact: numpy.ndarray
+    :param preact: preactivations, the last dimension being the output classes
+
+    :rtype: numpy.ndarray
+    :returns: log normalizers, with one less dimension than ``preact``
+    """
+
+    preact_max = preact.max(axis=-1)
+    result = numpy.exp(preact - preact_max[..., None]).sum(axis=-1)
+    return numpy.log(result) + preact_max
+
+def create_numpy_layer(layer_options, network):
+    """Constructs one of the NumPy layer classes based on a layer definition.
+
+    :type layer_options: dict
+    :param layer_options: dictionary of layer options
+
+    :type network: NumpyNetwork
+    :param network: the network object creating the layer
+    """
+
+    layer_type = layer_options['type']
+    if layer_type == 'projection':
+        return NumpyProjectionLayer(layer_options, network)
+    elif layer_type == 'tanh':
+        return NumpyTanhLayer(layer_options, network)
+    elif layer_type == 'lstm':
+        return NumpyLSTMLayer(layer_options, network)
+    elif layer_type == 'gru':
+        return NumpyGRULayer(layer_options, network)
+    elif layer_type == 'highwaytanh':
+        return NumpyHighwayTanhLayer(layer_options, network)
+    elif layer_type == 'softmax':
+        return NumpySoftmaxLayer(layer_options, network)
+    elif layer_type == 'hsoftmax':
+        return NumpyHSoftmaxLayer(layer_options, network)
+    elif layer_type == 'dropout':
+        return NumpyDropoutLayer(layer_options, network)
+    else:
+        raise ValueError("Invalid layer type requested: " + layer_type)
+
+class NumpyLayer(object, metaclass=ABCMeta):
+    """Superclass for NumPy Implementations of the Layers
+
+    The NumPy layers compute the same outputs as the Theano layers at inference
+    time. The parameters are read from the network object when the layer is
+    constructed. ``forward()`` reads the outputs of the input layers and sets
+    ``self.output`` to a 3-dimensional array indexed by time step, sequence, and
+    output dimension.
+    """
+
+    def __init__(self, layer_options, network):
+        """Saves the attributes that are common to all layers.
+
+        :type layer_options: dict
+        :param layer_options: dictionary of layer options
+
+        :type network: NumpyNetwork
+        :param network: the network object creating this layer
+        """
+
+        self.name = layer_options['name']
+        self.input_layers = layer_options['input_layers']
+        self._devices = layer_options['devices']
+        self._network = network
+
+        if 'size' in layer_options:
+            self.output_size = int(layer_options['size'])
+        else:
+            self.output_size = \
+                sum([x.output_size for x in self.input_layers])
+
+        self.output = None
+
+    @abstractmethod
+    def forward(self):
+        """Computes the output of this layer from the outputs of the input
+        layers.
+        """
+
+        assert False
+
+    def _get_param(self, param_name):
+        """Returns the value of a parameter of this layer.
+
+        :type param_name: str
+        :param param_name: name of a parameter within the layer
+
+        :rtype: numpy.ndarray
+        :returns: the parameter value
+        """
+
+        path = 'layers/' + self.name + '/' + param_name
+        return self._network.get_param(path, self._devices)
+
+    def _layer_input(self):
+        """Concatenates the outputs of the input layers.
+
+        :rtype: numpy.ndarray
+        :returns: a 3-dimensional array that contains the input vector for each
+                  time step in each sequence
+        """
+
+        return numpy.concatenate([x.output for x in self.input_layers], axis=2)
+
+    def _preact(self, layer_input, param_name):
+        """Multiplies the input by a weight matrix and adds a bias.
+
+        :type layer_input: numpy.ndarray
+        :param layer_input: a 3-dimensional array of input vectors
+
+        :type param_name: str
+        :param param_name: name of a parameter group that contains a weight
+                           matrix and a bias vector
+
+        :rtype: numpy.ndarray
+        :returns: the preactivations in the shape of the input
+        """
+
+        weight = self._get_param(param_name + '/W')
+        bias = self._get_param(param_name + '/b')
+        return numpy.dot(layer_input, weight) + bias
+
+    def _initial_state(self, state_index, num_sequences):
+        """Returns the recurrent state that is the input of the first time step.
+
+        :type state_index: int
+        :param state_index: index of the state variable in the network
+
+        :type num_sequences: int
+        :param num_sequences: number of sequences in the input
+
+        :rtype: numpy.ndarray
+        :returns: a matrix that contains the state vector for each sequence;
+                  zeros, unless the network was given a recurrent state
+        """
+
+        state_input = self._network.recurrent_state_input
+        if state_input is None:
+            return numpy.zeros((num_sequences, self.output_size),
+                               dtype=self._get_param('step_input/W').dtype)
+        return state_input[state_index][0]
+
+class NumpyNetworkInput(NumpyLayer):
+    """Neural Network Input Element
+
+    Outputs the word or class IDs given to the network.
+    """
+
+    def __init__(self, input_options, network):
+        """Creates a network input of given type.
+
+        :type input_options: dict
+        :param input_options: dictionary of input options
+
+        :type network: NumpyNetwork
+        :param network: the network object which uses this input
+        """
+
+        self.input_type = input_options['type']
+        if self.input_type == 'word':
+            output_size = network.vocabulary.num_words()
+        elif self.input_type == 'class':
+            output_size = network.vocabulary.num_classes()
+        else:
+            raise ValueError(
+                "Invalid network input type: {}".format(self.input_type))
+        input_options = dict(input_options)
+        input_options['size'] = output_size
+        input_options['input_layers'] = []
+        input_options['devices'] = []
+        super().__init__(input_options, network)
+
+    def forward(self):
+        """Sets the output to the word or class ID matrix.
+        """
+
+        if self.input_type == 'word':
+            self.output = self._network.input_word_ids
+        else:
+            self.output = self._network.input_class_ids
+
+class NumpyProjectionLayer(NumpyLayer):
+    """Projection Layer
+    """
+
+    def forward(self):
+        """Looks up the projections of the input IDs.
+        """
+
+        assert len(self.input_layers) == 1
+        layer_input = self.input_layers[0].output
+        self.output = self._get_param('W')[layer_input]
+
+class NumpyTanhLayer(NumpyLayer):
+    """Layer with Hyperbolic Tangent Activation
+    """
+
+    def forward(self):
+        """Computes the hyperbolic tangent of the preactivations.
+        """
+
+        preact = self._preact(self._layer_input(), 'input')
+        self.output = numpy.tanh(preact)
+
+class NumpyHighwayTanhLayer(NumpyLayer):
+    """Highway Network Layer with Hyperbolic Tangent Activation
+    """
+
+    def forward(self):
+        """Combines the hidden state and the input using the transform gate.
+        """
+
+        layer_input = self._layer_input()
+        preact = self._preact(layer_input, 'input')
+        h = numpy.tanh(get_submatrix(preact, 0, self.output_size))
+        t = sigmoid(get_submatrix(preact, 1, self.output_size))
+        self.output = h * t + layer_input * (1 - t)
+
+class NumpyDropoutLayer(NumpyLayer):
+    """Dropout Layer
+
+    Dropout is applied only during training, so at inference time the input is
+    passed through unchanged.
+    """
+
+    def forward(self):
+        """Passes the input through.
+        """
+
+        self.output = self._layer_input()
+
+class NumpyLSTMLayer(NumpyLayer):
+    """Long Short-Term Memory Layer
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Adds the cell state and hidden state variables to the network, in the
+        same order as the Theano layer.
+        """
+
+        super().__init__(*args, **kwargs)
+
+        self.cell_state_index = self._network.add_recurrent_state(
+            self.output_size)
+        self.hidden_state_index = self._network.add_recurrent_state(
+            self.output_size)
+
+    def forward(self):
+        """Processes the input one time step at a time, and saves the state
+        after the last time step in the network.
+        """
+
+        layer_input_preact = self._preact(self._layer_input(), 'layer_input')
+        hidden_state_weights = self._get_param('step_input/W')
+        num_time_steps, num_sequences, _ = layer_input_preact.shape
+        size = self.output_size
+        mask = self._network.mask
+
+        C = self._initial_state(self.cell_state_index, num_sequences)
+        h = self._initial_state(self.hidden_state_index, num_sequences)
+        self.output = numpy.empty((num_time_steps, num_sequences, size),
+                                  dtype=h.dtype)
+        for time_step in range(num_time_steps):
+            preact = numpy.dot(h, hidden_state_weights)
+            preact += layer_input_preact[time_step]
+            i = sigmoid(get_submatrix(preact, 0, size))
+            f = sigmoid(get_submatrix(preact, 1, size))
+            o = sigmoid(get_submatrix(preact, 2, size))
+            C_candidate = numpy.tanh(get_submatrix(preact, 3, size))
+            C_out = f * C + i * C_candidate
+            h_out = o * numpy.tanh(C_out)
+            step_mask = mask[time_step, :, None] != 0
+            C = numpy.where(step_mask, C_out, C)
+            h = numpy.where(step_mask, h_out, h)
+            self.output[time_step] = h
+
+        state_output = self._network.recurrent_state_output
+        state_output[self.cell_state_index] = C[None, :, :]
+        state_output[self.hidden_state_index] = h[None, :, :]
+
+class NumpyGRULayer(NumpyLayer):
+    """Gated Recurrent Unit Layer
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Adds the hidden state variable to the network.
+        """
+
+        super().__init__(*args, **kwargs)
+
+        self.hidden_state_index = self._network.add_recurrent_state(
+            self.output_size)
+
+    def forward(self):
+        """Processes the input one time step at a time, and saves the state
+        after the last time step in the network.
+        """
+
+        layer_input_preact = self._preact(self._layer_input(), 'layer_input')
+        hidden_state_weights = self._get_param('step_input/W')
+        num_time_steps, num_sequences, _ = layer_input_preact.shape
+        size = self.output_size
+        mask = self._network.mask
+
+        h = self._initial_state(self.hidden_state_index, num_sequences)
+        self.output = numpy.empty((num_time_steps, num_sequences, size),
+                                  dtype=h.dtype)
+        for time_step in range(num_time_steps):
+            x_preact = layer_input_preact[time_step]
+            h_preact = numpy.dot(h, hidden_state_weights)
+            preact_gates = get_submatrix(h_preact, 0, size, 1)
+            preact_gates += get_submatrix(x_preact, 0, size, 1)
+            r = sigmoid(get_submatrix(preact_gates, 0, size))
+            u = sigmoid(get_submatrix(preact_gates, 1, size))
+            preact_candidate = get_submatrix(h_preact, 2, size) * r
+            preact_candidate += get_submatrix(x_preact, 2, size)
+            h_candidate = numpy.tanh(preact_candidate)
+            h_out = (1.0 - u) * h + u * h_candidate
+            step_mask = mask[time_step, :, None] != 0
+            h = numpy.where(step_mask, h_out, h)
+            self.output[time_step] = h
+
+        state_output = self._network.recurrent_state_output
+        state_output[self.hidden_state_index] = h[None, :, :]
+
+class NumpySoftmaxLayer(NumpyLayer):
+    """Softmax Output Layer
+
+    ``forward()`` only saves the layer input. The output probabilities are
+    computed when requested, so that the full distribution is not computed when
+    only the target word probabilities are needed.
+    """
+
+    def forward(self):
+        """Saves the input of the layer.
+        """
+
+        self.output = self._layer_input()
+
+    def output_probs(self):
+        """Computes the probabilities of all the output classes.
+
+        :rtype: numpy.ndarray
+        :returns: a 3-dimensional array that contains a probability for each
+                  time step, each sequence, and each output class
+        """
+
+        return numpy.exp(log_softmax(self._preact(self.output, 'input')))
+
+    def target_logprobs(self, target_class_ids, log_normalizer=None):
+        """Computes the log probabilities of the target classes.
+
+        :type target_class_ids: numpy.ndarray
+        :param target_class_ids: a 2-dimensional array that contains the target
+                                 class ID for each time step in each sequence
+
+        :type log_normalizer: float
+        :param log_normalizer: if not None, subtracts this constant from the
+                               target preactivations instead of normalizing the
+                               output over the vocabulary
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional array of target log probabilities
+        """
+
+        if log_normalizer is None:
+            logprobs = log_softmax(self._preact(self.output, 'input'))
+            return numpy.take_along_axis(logprobs,
+                                         target_class_ids[:, :, None],
+                                         axis=2)[:, :, 0]
+
+        weight = self._get_param('input/W')
+        bias = self._get_param('input/b')
+        target_weights = weight.T[target_class_ids]
+        preact = numpy.einsum('tsi,tsi->ts', self.output, target_weights)
+        preact += bias[target_class_ids]
+        return preact - log_normalizer
+
+    def log_normalizers(self):
+        """Computes the logarithm of the softmax normalizer.
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional array that contains the log normalizer for
+                  each time step and each sequence
+        """
+
+        return log_normalizer(self._preact(self.output, 'input'))
+
+class NumpyHSoftmaxLayer(NumpyLayer):
+    """Two-Level Hierarchical Softmax Output Layer
+
+    Computes the same probabilities as ``theano.tensor.nnet.h_softmax()``. The
+    output classes are divided into ``level1_size`` groups of ``level2_size``
+    classes.
+    """
+
+    def forward(self):
+        """Saves the input of the layer.
+        """
+
+        self.output = self._layer_input()
+
+    def output_probs(self):
+        """Computes the probabilities of all the output classes.
+
+        :rtype: numpy.ndarray
+        :returns: a 3-dimensional array that contains a probability for each
+                  time step, each sequence, and each output class
+        """
+
+        level1_probs = numpy.exp(log_softmax(self._preact(self.output,
+                                                          'input')))
+        level2_weight = self._get_param('level1/W')
+        level2_bias = self._get_param('level1/b')
+        level2_preact = numpy.einsum('tsi,cik->tsck', self.output,
+                                     level2_weight)
+        level2_preact += level2_bias
+        level2_probs = numpy.exp(log_softmax(level2_preact))
+        probs = level1_probs[:, :, :, None] * level2_probs
+        num_time_steps, num_sequences = probs.shape[:2]
+        probs = probs.reshape([num_time_steps, num_sequences, -1])
+        return probs[:, :, :self.output_size]
+
+    def target_logprobs(self, target_class_ids, log_normalizer=None):
+        """Computes the log probabilities of the target classes.
+
+        Only the second level distributions of the groups that contain a target
+        class are computed.
+
+        :type target_class_ids: numpy.ndarray
+        :param target_class_ids: a 2-dimensional array that contains the target
+                                 class ID for each time step in each sequence
+
+        :type log_normalizer: float
+        :param log_normalizer: not supported by hierarchical softmax; has to be
+                               None
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional array of target log probabilities
+        """
+
+        if not log_normalizer is None:
+            raise RuntimeError("The final layer is not a softmax layer, and "
+                               "unnormalized probabilities are needed.")
+
+        level2_weight = self._get_param('level1/W')
+        level2_bias = self._get_param('level1/b')
+        level2_size = level2_weight.shape[2]
+        layer_input = self.output.reshape([-1, self.output.shape[2]])
+        target_class_ids = target_class_ids.flatten()
+        groups = target_class_ids // level2_size
+        group_class_ids = target_class_ids % level2_size
+
+        logprobs = log_softmax(self._preact(layer_input, 'input'))
+        result = logprobs[numpy.arange(groups.size), groups]
+        for group in numpy.unique(groups):
+            elements = numpy.flatnonzero(groups == group)
+            preact = numpy.dot(layer_input[elements], level2_weight[group])
+            preact += level2_bias[group]
+            logprobs = log_softmax(preact)
+            result[elements] += logprobs[numpy.arange(elements.size),
+                                         group_class_ids[elements]]
+        return result.reshape(self.output.shape[:2])
+
+    def log_normalizers(self):
+        """Hierarchical softmax output is always normalized.
+        """
+
+        raise RuntimeError("The final layer is not a softmax layer, and "
+                           "the softmax normalizer is needed.")
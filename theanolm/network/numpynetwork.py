@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import sys
+import h5py
+import numpy
+from theanolm import Vocabulary
+from theanolm.exceptions import IncompatibleStateError, InputError
+from theanolm.network.architecture import Architecture
+from theanolm.network.numpylayers import NumpyNetworkInput, create_numpy_layer
+
+class NumpyNetwork(object):
+    """Neural Network Inference Using NumPy
+
+    Computes the forward pass of a trained neural network using NumPy, so that
+    no Theano functions need to be compiled. This gives a fast startup for
+    small scoring jobs. The recurrent state variables are in the same order as
+    in ``Network``, so ``RecurrentState`` objects can be used with both.
+
+    ``forward()`` computes the outputs of all the layers for a mini-batch. After
+    that, the output probabilities can be read using ``output_probs()``,
+    ``target_logprobs()``, and ``log_normalizers()``.
+    """
+
+    def __init__(self, architecture, vocabulary, state):
+        """Reads the network parameters from a state and creates the layers.
+
+        :type architecture: Architecture
+        :param architecture: an object that describes the network architecture
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: mapping between word IDs and word classes
+
+        :type state: h5py.File
+        :param state: HDF5 file that contains the neural network parameters
+        """
+
+        self.vocabulary = vocabulary
+        self.architecture = architecture
+
+        try:
+            architecture.check_state(state)
+        except IncompatibleStateError as error:
+            raise IncompatibleStateError(
+                "Attempting to restore state of a network that is incompatible "
+                "with this architecture. " + str(error))
+
+        self._params = dict()
+        if 'layers' in state:
+            def read_param(path, value):
+                if isinstance(value, h5py.Dataset):
+                    self._params['layers/' + path] = value[()]
+            state['layers'].visititems(read_param)
+
+        # Recurrent layers will add the sizes of their state variables to this
+        # list.
+        self.recurrent_state_size = []
+
+        # These are set by forward().
+        self.input_word_ids = None
+        self.input_class_ids = None
+        self.mask = None
+        self.recurrent_state_input = None
+        self.recurrent_state_output = []
+
+        self.layers = OrderedDict()
+        for input_options in architecture.inputs:
+            input = NumpyNetworkInput(input_options, self)
+            self.layers[input.name] = input
+        for layer_description in architecture.layers:
+            layer_options = self._layer_options_from_description(
+                layer_description)
+            if layer_options['name'] == architecture.output_layer:
+                layer_options['size'] = vocabulary.num_classes()
+            if not layer_options['devices']:
+                layer_options['devices'] = [None]
+            layer = create_numpy_layer(layer_options, self)
+            self.layers[layer.name] = layer
+        self.output_layer = self.layers[architecture.output_layer]
+
+        # Class-factored output is not implemented in NumPy, so the output is
+        # always for the classes.
+        self.predicts_words = False
+
+    @classmethod
+    def from_file(classname, model_path):
+        """Reads a model from an HDF5 file.
+
+        :type model_path: str
+        :param model_path: path to a HDF5 model file
+        """
+
+        with h5py.File(model_path, 'r') as state:
+            print("Reading vocabulary from network state.")
+            sys.stdout.flush()
+            vocabulary = Vocabulary.from_state(state)
+            print("Number of words in vocabulary:", vocabulary.num_words())
+            print("Number of word classes:", vocabulary.num_classes())
+            print("Reading neural network state.")
+            sys.stdout.flush()
+            architecture = Architecture.from_state(state)
+            return classname(architecture, vocabulary, state)
+
+    def get_param(self, path, devices=None):
+        """Returns the value of a parameter.
+
+        If the parameter has been split to several devices, concatenates the
+        parts on the last dimension, in the order of ``devices``.
+
+        :type path: str
+        :param path: full path of the parameter in the HDF5 file
+
+        :type devices: list of strs
+        :param devices: the devices that the layer was assigned to
+
+        :rtype: numpy.ndarray
+        :returns: the parameter value
+        """
+
+        if path in self._params:
+            return self._params[path]
+
+        if devices and not None in devices:
+            device_paths = [path + '/' + device for device in devices]
+        else:
+            # The layer was placed on the default device, whose name is not
+            # stored in the architecture.
+            device_paths = [x for x in self._params
+                            if x.startswith(path + '/')]
+            if len(device_paths) != 1:
+                device_paths = []
+        if device_paths and all(x in self._params for x in device_paths):
+            value = numpy.concatenate([self._params[x] for x in device_paths],
+                                      axis=-1)
+            self._params[path] = value
+            return value
+
+        raise IncompatibleStateError(
+            "Parameter `%s' is missing from state." % path)
+
+    def add_recurrent_state(self, size):
+        """Adds a recurrent state variable and returns its index.
+
+        :type size: int
+        :param size: size of the state vector
+
+        :rtype: int
+        :returns: index of the new recurrent state variable
+        """
+
+        index = len(self.recurrent_state_size)
+        self.recurrent_state_size.append(size)
+        self.recurrent_state_output.append(None)
+        return index
+
+    def forward(self, word_ids, class_ids, mask=None, recurrent_state=None):
+        """Computes the outputs of all the layers.
+
+        The inputs have the shape of a mini-batch: the first dimension is the
+        time step and the second dimension is the sequence. After the call,
+        ``self.recurrent_state_output`` contains the state of the recurrent
+        layers after the last time step.
+
+        :type word_ids: numpy.ndarray
+        :param word_ids: a 2-dimensional matrix of input word IDs
+
+        :type class_ids: numpy.ndarray
+        :param class_ids: a 2-dimensional matrix of input class IDs
+
+        :type mask: numpy.ndarray
+        :param mask: a 2-dimensional matrix that masks out elements past the
+                     sequence ends (default is no masking)
+
+        :type recurrent_state: list of numpy.ndarrays
+        :param recurrent_state: if not None, the state of the recurrent layers
+                                before the first time step, one matrix for each
+                                state variable as in ``RecurrentState.get()``;
+                                otherwise the state is initialized to zeros
+        """
+
+        self.input_word_ids = word_ids
+        self.input_class_ids = class_ids
+        if mask is None:
+            mask = numpy.ones(word_ids.shape, dtype='int8')
+        self.mask = mask
+        self.recurrent_state_input = recurrent_state
+        for layer in self.layers.values():
+            layer.forward()
+
+    def output_probs(self):
+        """Returns the output probabilities for the whole vocabulary, computed
+        by the previous call to ``forward()``.
+
+        :rtype: numpy.ndarray
+        :returns: a 3-dimensional matrix that contains a probability for each
+                  time step, each sequence, and each output class
+        """
+
+        if not hasattr(self.output_layer, 'output_probs'):
+            raise RuntimeError("The final layer is not an output layer.")
+        return self.output_layer.output_probs()
+
+    def target_logprobs(self, target_class_ids, log_normalizer=None):
+        """Returns the output log probabilities for the predicted words,
+        computed by the previous call to ``forward()``.
+
+        If ``log_normalizer`` is given, the output is not normalized over the
+        vocabulary, as in ``Network.target_logprobs()``.
+
+        :type target_class_ids: numpy.ndarray
+        :param target_class_ids: a 2-dimensional matrix of target class IDs
+
+        :type log_normalizer: float
+        :param log_normalizer: constant logarithm of the softmax normalizer, or
+                               None to normalize the output exactly
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional matrix that contains the target word log
+                  probability for each time step and each sequence
+        """
+
+        if not hasattr(self.output_layer, 'target_logprobs'):
+            raise RuntimeError("The final layer is not an output layer.")
+        return self.output_layer.target_logprobs(target_class_ids,
+                                                 log_normalizer)
+
+    def log_normalizers(self):
+        """Returns the logarithm of the softmax normalizer, computed by the
+        previous call to ``forward()``.
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional matrix that contains the log normalizer for
+                  each time step and each sequence
+        """
+
+        if not hasattr(self.output_layer, 'log_normalizers'):
+            raise RuntimeError("The final layer is not a softmax layer, and "
+                               "the softmax normalizer is needed.")
+        return self.output_layer.log_normalizers()
+
+    def create_step_function(self, log_normalizer=None):
+        """Creates a function that computes the target word log probabilities
+        for a single time step.
+
+        The function takes the same arguments and returns the same outputs as
+        the Theano step function of ``LatticeDecoder`` and ``NBestScorer``:
+        input word IDs, input class IDs, target word IDs, target class IDs, and
+        the recurrent state variables. It returns a list that contains the
+        target word log probabilities followed by the new recurrent state
+        variables.
+
+        :type log_normalizer: float
+        :param log_normalizer: constant logarithm of the softmax normalizer, or
+                               None to normalize the output exactly
+
+        :rtype: callable
+        :returns: the step function
+        """
+
+        def step_function(word_ids, class_ids, target_word_ids,
+                          target_class_ids, *state):
+            self.forward(word_ids, class_ids, recurrent_state=list(state))
+            result = [self.target_logprobs(target_class_ids, log_normalizer)]
+            result.extend(self.recurrent_state_output)
+            return result
+
+        return step_function
+
+    def _layer_options_from_description(self, description):
+        """Creates layer options based on textual architecture description.
+
+        :type description: dict
+        :param description: dictionary of textual layer fields
+
+        :rtype: dict
+        :result: layer options
+        """
+
+        result = dict()
+        for variable, value in description.items():
+            if variable == 'inputs':
+                try:
+                    result['input_layers'] = [self.layers[x] for x in value]
+                except KeyError as e:
+                    raise InputError("Input layer `{}' does not exist, when "
+                                     "creating layer `{}'.".format(
+                                     e.args[0],
+                                     description['name']))
+            else:
+                result[variable] = value
+        return result
@@ -59,6 +59,14 @@ class SoftmaxLayer(SamplingOutputLayer):
                                                   num_sequences,
                                                   self.output_size])
 
+        # Logarithm of the softmax normalizer at each location. Self-normalized
+        # models can use the mean of this value as a constant normalizer.
+        preact_max = preact.max(axis=1, keepdims=True)
+        log_normalizers = tensor.log(tensor.exp(preact - preact_max).sum(1))
+        log_normalizers += preact_max.flatten()
+        self.log_normalizers = log_normalizers.reshape([num_time_steps,
+                                                        num_sequences])
+
         # The following variables can only be used when
         # self._network.target_class_ids is given to the function.
         element_ids = tensor.arange(num_time_steps * num_sequences)
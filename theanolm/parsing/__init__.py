@@ -1,4 +1,6 @@
 from theanolm.parsing.linearbatchiterator import LinearBatchIterator
 from theanolm.parsing.shufflingbatchiterator import ShufflingBatchIterator
 from theanolm.parsing.scoringbatchiterator import ScoringBatchIterator
+from theanolm.parsing.prefetchingbatchiterator import PrefetchingBatchIterator
+from theanolm.parsing.binarycorpus import BinaryCorpus
 from theanolm.parsing.functions import utterance_from_line
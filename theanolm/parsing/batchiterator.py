@@ -9,6 +9,66 @@ class BatchIterator(object, metaclass=ABCMeta):
     """Iterator for Reading Mini-Batches
     """
 
+    class Sequence(object):
+        """A word sequence read from the input, converted to word IDs.
+
+        The file ID is stored once for the entire sequence, since a sequence is
+        always read from a single file. The words are not available when the
+        sequence is read from a ``BinaryCorpus``.
+        """
+
+        __slots__ = ('word_ids', 'words', 'file_id')
+
+        def __init__(self, word_ids, words, file_id):
+            """Constructs a sequence.
+
+            :type word_ids: numpy.ndarray
+            :param word_ids: a vector of word IDs
+
+            :type words: list of strs
+            :param words: the words in plain text, or None if not available
+
+            :type file_id: int
+            :param file_id: index of the file that the sequence was read from
+            """
+
+            self.word_ids = word_ids
+            self.words = words
+            self.file_id = file_id
+
+        def __len__(self):
+            """Returns the number of words in the sequence.
+
+            :rtype: int
+            :returns: the number of words in the sequence
+            """
+
+            return len(self.word_ids)
+
+        def split(self, length):
+            """Splits the sequence in two.
+
+            :type length: int
+            :param length: number of words in the first part
+
+            :rtype: tuple of two BatchIterator.Sequences
+            :returns: the first ``length`` words and the rest of the words (or
+                      None if nothing is left)
+            """
+
+            words = self.words
+            head = BatchIterator.Sequence(
+                self.word_ids[:length],
+                None if words is None else words[:length],
+                self.file_id)
+            if len(self) <= length:
+                return head, None
+            tail = BatchIterator.Sequence(
+                self.word_ids[length:],
+                None if words is None else words[length:],
+                self.file_id)
+            return head, tail
+
     def __init__(self,
                  vocabulary,
                  batch_size=1,
@@ -32,7 +92,7 @@ class BatchIterator(object, metaclass=ABCMeta):
         self.vocabulary = vocabulary
         self.batch_size = batch_size
         self.max_sequence_length = max_sequence_length
-        self.buffer = []
+        self.buffer = None
         self.end_of_file = False
 
     def __iter__(self):
@@ -122,35 +182,71 @@ class BatchIterator(object, metaclass=ABCMeta):
 
         Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
         inserted at the beginning and the end of the sequence, if they're
-        missing. If an empty line is encountered, returns an empty list (instead
-        of an empty sentence ``['<s>', '</s>']``).
+        missing. If an empty line is encountered, returns an empty sequence
+        (instead of an empty sentence ``['<s>', '</s>']``).
 
         If buffer is not empty, returns a sequence from the buffer. Otherwise
-        reads a line to the buffer first.
+        reads an utterance to the buffer first.
 
-        :rtype: list
-        :returns: a sequence of (word, file_id) tuples (may be empty), or None
-                  if no more data
+        :rtype: BatchIterator.Sequence
+        :returns: the next sequence (may be empty), or None if no more data
         """
 
-        if not self.buffer:
-            line_and_file_id = self._readline()
-            if line_and_file_id is None:
+        if self.buffer is None:
+            self.buffer = self._read_utterance()
+            if self.buffer is None:
                 # end of data
                 return None
-            line = line_and_file_id[0]
-            file_id = line_and_file_id[1]
-            self.buffer = [(word, file_id)
-                           for word in utterance_from_line(line)]
 
         if self.max_sequence_length is None:
             result = self.buffer
-            self.buffer = []
+            self.buffer = None
         else:
-            result = self.buffer[:self.max_sequence_length]
-            self.buffer = self.buffer[self.max_sequence_length:]
+            result, self.buffer = self.buffer.split(self.max_sequence_length)
         return result
 
+    def _read_utterance(self):
+        """Reads the next input line and converts it to word IDs.
+
+        Subclasses that read pre-tokenized data override this method.
+
+        :rtype: BatchIterator.Sequence
+        :returns: the next utterance (empty if an empty line was read), or None
+                  if no more data
+        """
+
+        line_and_file_id = self._readline()
+        if line_and_file_id is None:
+            return None
+        line, file_id = line_and_file_id
+        words = utterance_from_line(line)
+        return self.Sequence(self.vocabulary.words_to_ids(words),
+                             words,
+                             file_id)
+
+    def _get_position(self):
+        """Returns the current read position, so that the iterator can be
+        rewound to this position using ``_set_position()``.
+
+        The position has to be saved after each mini-batch, when mini-batches
+        are read in advance. The returned object should not be modified by the
+        iterator after this call.
+
+        :rtype: tuple
+        :returns: the iterator state that defines the next mini-batch
+        """
+
+        return (self.buffer, self.end_of_file)
+
+    def _set_position(self, position):
+        """Rewinds the iterator to a position returned by ``_get_position()``.
+
+        :type position: tuple
+        :param position: the iterator state that defines the next mini-batch
+        """
+
+        self.buffer, self.end_of_file = position
+
     @abstractmethod
     def _readline(self):
         """Reads the next input line.
@@ -178,35 +274,41 @@ class BatchIterator(object, metaclass=ABCMeta):
         selects the sequence. In other words, the first row is the first word of
         each sequence and so on.
 
-        :type sequences: list of lists
-        :param sequences: list of sequences, each of which is a list of word
-                          IDs
+        :type sequences: list of BatchIterator.Sequences
+        :param sequences: list of sequences
 
         :rtype: three ndarrays
         :returns: word ID, file ID, and mask matrix
         """
 
-        num_sequences = len(sequences)
-        batch_length = numpy.max([len(s) for s in sequences])
+        word_ids, mask = self._pad_sequences(sequences)
+        sequence_file_ids = numpy.array(
+            [sequence.file_id for sequence in sequences], numpy.int8)
+        file_ids = mask * sequence_file_ids[numpy.newaxis, :]
+        return word_ids, file_ids, mask
 
-        unk_id = self.vocabulary.word_to_id['<unk>']
-        shape = (batch_length, num_sequences)
-        word_ids = numpy.ones(shape, numpy.int64) * unk_id
-        mask = numpy.zeros(shape, numpy.int8)
-        file_ids = numpy.zeros(shape, numpy.int8)
+    def _pad_sequences(self, sequences):
+        """Creates a word ID matrix and a mask matrix from a list of sequences.
 
-        for i, sequence in enumerate(sequences):
-            length = len(sequence)
+        The word IDs of all the sequences are copied into the matrix in one
+        operation. Elements past the sequence ends contain the ``<unk>`` word
+        ID and zero in the mask.
 
-            sequence_word_ids = numpy.ones(length, numpy.int64) * unk_id
-            sequence_file_ids = numpy.zeros(length, numpy.int8)
-            for index, (word, file_id) in enumerate(sequence):
-                if word in self.vocabulary.word_to_id:
-                    sequence_word_ids[index] = self.vocabulary.word_to_id[word]
-                sequence_file_ids[index] = file_id
+        :type sequences: list of BatchIterator.Sequences
+        :param sequences: list of sequences
 
-            word_ids[:length, i] = sequence_word_ids
-            mask[:length, i] = 1
-            file_ids[:length, i] = sequence_file_ids
+        :rtype: two ndarrays
+        :returns: word ID and mask matrix, indexed by time step and sequence
+        """
 
-        return word_ids, file_ids, mask
+        lengths = numpy.array([len(sequence) for sequence in sequences])
+        batch_length = lengths.max()
+
+        unk_id = self.vocabulary.word_to_id['<unk>']
+        mask = numpy.arange(batch_length)[:, numpy.newaxis] < lengths
+        word_ids = numpy.full(mask.shape, unk_id, numpy.int64)
+        # Boolean indexing of the transposes fills the matrix one sequence at a
+        # time, in the same order as the concatenated word IDs.
+        word_ids.T[mask.T] = numpy.concatenate(
+            [sequence.word_ids for sequence in sequences])
+        return word_ids, mask.astype(numpy.int8)
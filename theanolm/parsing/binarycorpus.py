@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import numpy
+from theanolm.parsing.functions import utterance_from_line, cache_source
+
+class BinaryCorpus(object):
+    """Pre-Tokenized Corpus of Word IDs
+
+    Stores a text corpus as word IDs in two memory-mapped files, so that the
+    sentences can be read without any text processing. ``<prefix>.ids``
+    contains the word IDs of all the sentences as a flat array of 32-bit
+    integers, including the start-of-sentence and end-of-sentence tags.
+    ``<prefix>.offsets.npy`` contains the index to the first word of each
+    sentence, followed by the total number of words, so that the word IDs of
+    sentence ``i`` are ``word_ids[offsets[i]:offsets[i+1]]``. Empty lines are
+    stored as empty sentences.
+
+    The word IDs are only valid with the vocabulary that was used to create the
+    corpus. When the corpus is created in a cache directory, the file names
+    include a checksum of the vocabulary and of the path of the text file, and
+    ``<prefix>.source.json`` records the size and modification time of the text
+    file.
+    """
+
+    def __init__(self, path_prefix, name=None):
+        """Opens a corpus that has been created using ``from_text()``.
+
+        :type path_prefix: str
+        :param path_prefix: path to the corpus files, without the suffixes
+
+        :type name: str
+        :param name: a name for the corpus, used in log messages (default is to
+                     use the path prefix)
+        """
+
+        self.name = path_prefix if name is None else name
+        ids_path = path_prefix + '.ids'
+        if os.path.getsize(ids_path) > 0:
+            self.word_ids = numpy.memmap(ids_path, dtype='int32', mode='r')
+        else:
+            self.word_ids = numpy.zeros(0, dtype='int32')
+        self.offsets = numpy.load(path_prefix + '.offsets.npy', mmap_mode='r')
+
+    @classmethod
+    def from_text(classname, input_file, vocabulary, path_prefix):
+        """Converts a text file into word IDs and writes the corpus files. The
+        file is read from the beginning.
+
+        The files are first written under temporary names and then renamed, so
+        that an interrupted conversion won't leave an incomplete corpus.
+
+        :type input_file: file object
+        :param input_file: a text file, one sentence per line
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary that provides mapping between words and
+                           word IDs
+
+        :type path_prefix: str
+        :param path_prefix: path to the corpus files, without the suffixes
+
+        :rtype: BinaryCorpus
+        :returns: the created corpus
+        """
+
+        name = getattr(input_file, 'name', path_prefix)
+        logging.debug("Converting %s into word IDs.", name)
+
+        ids_path = path_prefix + '.ids'
+        offsets_path = path_prefix + '.offsets.npy'
+        offsets = [0]
+        input_file.seek(0)
+        with open(ids_path + '.tmp', 'wb') as ids_file:
+            for line in input_file:
+                words = utterance_from_line(line)
+                word_ids = vocabulary.words_to_ids(words).astype('int32')
+                ids_file.write(word_ids.tobytes())
+                offsets.append(offsets[-1] + word_ids.size)
+        # numpy.save() would append .npy to a name that doesn't end with it.
+        with open(offsets_path + '.tmp', 'wb') as offsets_file:
+            numpy.save(offsets_file, numpy.array(offsets, dtype='int64'))
+        os.replace(ids_path + '.tmp', ids_path)
+        os.replace(offsets_path + '.tmp', offsets_path)
+        return classname(path_prefix, name)
+
+    @classmethod
+    def from_cache(classname, input_file, vocabulary, cache_dir):
+        """Opens a corpus from a cache directory, or creates it from a text
+        file, if the cache doesn't contain an up-to-date corpus.
+
+        The corpus file names are derived from the name and the absolute path
+        of the text file, and the checksum of the vocabulary. The cached corpus
+        is used only if the size and the modification time of the text file
+        are the same as when the corpus was created.
+
+        :type input_file: file object
+        :param input_file: a text file, one sentence per line
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary that provides mapping between words and
+                           word IDs
+
+        :type cache_dir: str
+        :param cache_dir: directory where the corpus files are stored
+
+        :rtype: BinaryCorpus
+        :returns: the cached or created corpus
+        """
+
+        name, source = cache_source(input_file.name)
+        path_prefix = os.path.join(
+            cache_dir, '{}.{}'.format(name, vocabulary.checksum()[:16]))
+        source_path = path_prefix + '.source.json'
+        if os.path.exists(source_path) and \
+           os.path.exists(path_prefix + '.offsets.npy') and \
+           os.path.exists(path_prefix + '.ids'):
+            with open(source_path) as source_file:
+                cached_source = json.load(source_file)
+            if cached_source == source:
+                logging.debug("Using cached word IDs of %s.", input_file.name)
+                return classname(path_prefix, input_file.name)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        result = classname.from_text(input_file, vocabulary, path_prefix)
+        # The source information is written last, so that it exists only if the
+        # corpus is complete.
+        with open(source_path + '.tmp', 'w') as source_file:
+            json.dump(source, source_file)
+        os.replace(source_path + '.tmp', source_path)
+        return result
+
+    def __len__(self):
+        """Returns the number of sentences.
+
+        :rtype: int
+        :returns: the number of sentences in the corpus
+        """
+
+        return self.offsets.size - 1
+
+    def __getitem__(self, sentence_index):
+        """Returns the word IDs of a sentence.
+
+        :type sentence_index: int
+        :param sentence_index: index of a sentence in the corpus
+
+        :rtype: numpy.ndarray
+        :returns: a view to the word IDs of the sentence
+        """
+
+        begin = self.offsets[sentence_index]
+        end = self.offsets[sentence_index + 1]
+        return self.word_ids[begin:end]
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import hashlib
+import numpy
+
 def utterance_from_line(line):
     """Converts a line of text, read from an input file, into a list of words.
 
@@ -28,30 +32,60 @@ def utterance_from_line(line):
 
     return result
 
-def find_sentence_starts(data):
+def find_sentence_starts(data, chunk_size=2**26):
     """Finds the positions inside a memory-mapped file, where the sentences
     (lines) start.
 
     TextIOWrapper disables tell() when readline() is called, so search for
-    sentence starts in memory-mapped data.
+    sentence starts in memory-mapped data. The data is scanned for newline
+    characters using NumPy, one chunk at a time, so that the memory used for
+    the comparison results stays bounded.
 
     :type data: mmap.mmap
     :param data: memory-mapped data of the input file
 
-    :rtype: list of ints
-    :returns: a list of file offsets pointing to the next character from a
-              newline (including file start and excluding file end)
-    """
+    :type chunk_size: int
+    :param chunk_size: number of bytes to scan at a time
 
-    result = [0]
+    :rtype: numpy.ndarray
+    :returns: an int64 array of file offsets pointing to the next character
+              from a newline (including file start and excluding file end)
+    """
 
-    pos = 0
-    while True:
-        pos = data.find(b'\n', pos)
-        if pos == -1:
-            break;
-        pos += 1
-        if pos < len(data):
-            result.append(pos)
+    data_size = len(data)
+    if data_size == 0:
+        return numpy.zeros(1, dtype='int64')
 
+    buffer = numpy.frombuffer(data, dtype='uint8')
+    result = [numpy.zeros(1, dtype='int64')]
+    for chunk_start in range(0, data_size, chunk_size):
+        chunk = buffer[chunk_start:chunk_start + chunk_size]
+        newlines = numpy.flatnonzero(chunk == ord('\n'))
+        result.append(newlines.astype('int64') + (chunk_start + 1))
+    result = numpy.concatenate(result)
+    if result[-1] >= data_size:
+        result = result[:-1]
     return result
+
+def cache_source(path):
+    """Identifies a text file, for caching data that is derived from it.
+
+    The cache file name contains the base name of the text file and a checksum
+    of its absolute path, so that files with the same name in different
+    directories are cached separately. The cached data should be used only if
+    the source information, which contains the size and modification time of
+    the file, is the same as when the data was created.
+
+    :type path: str
+    :param path: path to a text file
+
+    :rtype: tuple of a str and a dict
+    :returns: a name for the cache files, and the source information
+    """
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    checksum = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    name = '{}.{}'.format(os.path.basename(path), checksum[:16])
+    source = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    return name, source
@@ -2,9 +2,13 @@
 # -*- coding: utf-8 -*-
 
 from theanolm.parsing.batchiterator import BatchIterator
+from theanolm.parsing.binarycorpus import BinaryCorpus
 
 class LinearBatchIterator(BatchIterator):
     """Iterator for Reading Mini-Batches from a Single File in a Linear Order
+
+    If the input is given as ``BinaryCorpus`` objects, the word IDs of the
+    sentences are read directly from the corpora.
     """
 
     def __init__(self,
@@ -15,8 +19,9 @@ class LinearBatchIterator(BatchIterator):
         """Constructs an iterator for reading mini-batches from given file or
         memory map.
 
-        :type input_files: file or mmap object, or a list
-        :param input_files: input text files or their memory-mapped data
+        :type input_files: file, mmap, or BinaryCorpus object, or a list
+        :param input_files: input text files, their memory-mapped data, or
+                            pre-tokenized corpora
 
         :type vocabulary: Vocabulary
         :param vocabulary: vocabulary that provides mapping between words and
@@ -38,6 +43,8 @@ class LinearBatchIterator(BatchIterator):
                                  "least one input file.")
         else:
             self._input_files = [input_files]
+        self._is_binary = all(isinstance(x, BinaryCorpus)
+                              for x in self._input_files)
         self._reset()
 
         super().__init__(vocabulary, batch_size, max_sequence_length)
@@ -52,7 +59,60 @@ class LinearBatchIterator(BatchIterator):
 
         self._file_id = 0
         self._input_file = self._input_files[self._file_id]
-        self._input_file.seek(0)
+        if self._is_binary:
+            self._next_sentence = 0
+        else:
+            self._input_file.seek(0)
+
+    def _get_position(self):
+        """Returns the current read position, including the file position.
+
+        :rtype: tuple
+        :returns: the iterator state that defines the next mini-batch
+        """
+
+        if self._is_binary:
+            file_position = self._next_sentence
+        else:
+            file_position = self._input_file.tell()
+        return super()._get_position() + (self._file_id, file_position)
+
+    def _set_position(self, position):
+        """Rewinds the iterator to a position returned by ``_get_position()``.
+
+        :type position: tuple
+        :param position: the iterator state that defines the next mini-batch
+        """
+
+        super()._set_position(position[:-2])
+        self._file_id, file_position = position[-2:]
+        self._input_file = self._input_files[self._file_id]
+        if self._is_binary:
+            self._next_sentence = file_position
+        else:
+            self._input_file.seek(file_position)
+
+    def _read_utterance(self):
+        """Reads the word IDs of the next sentence from the pre-tokenized
+        corpora, or the next input line, if the input is text.
+
+        :rtype: BatchIterator.Sequence
+        :returns: the next utterance (empty if an empty line was read), or None
+                  if no more data
+        """
+
+        if not self._is_binary:
+            return super()._read_utterance()
+
+        while self._next_sentence >= len(self._input_file):
+            self._file_id += 1
+            if self._file_id >= len(self._input_files):
+                return None
+            self._input_file = self._input_files[self._file_id]
+            self._next_sentence = 0
+        word_ids = self._input_file[self._next_sentence]
+        self._next_sentence += 1
+        return self.Sequence(word_ids, None, self._file_id)
 
     def _readline(self):
         """Reads the next input line.
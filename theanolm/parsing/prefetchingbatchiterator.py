@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import queue
+
+class PrefetchingBatchIterator(object):
+    """Iterator That Prepares Mini-Batches in a Background Thread
+
+    Wraps a ``BatchIterator`` and reads mini-batches from it in a background
+    thread, so that reading and preparing the next mini-batches overlaps with
+    the parameter update. Class IDs are computed in the background thread too,
+    so each returned mini-batch is a tuple of word IDs, class IDs, file IDs, and
+    mask.
+
+    The background thread continues to the next epoch when the end of the data
+    is reached, but ``StopIteration`` is raised at the same point as with the
+    wrapped iterator. After each mini-batch the thread records the position of
+    the wrapped iterator, so that ``get_state()`` saves the position that
+    corresponds to the mini-batches that have been returned, instead of the
+    ones that have been prepared in advance.
+    """
+
+    def __init__(self, batch_iter, vocabulary, queue_size=4):
+        """Wraps a mini-batch iterator. The background thread is started when
+        the first mini-batch is requested.
+
+        :type batch_iter: BatchIterator
+        :param batch_iter: the iterator that creates the mini-batches; it has to
+                           support ``_get_position()`` and ``_set_position()``
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary that provides mapping from word IDs to
+                           class IDs
+
+        :type queue_size: int
+        :param queue_size: maximum number of mini-batches to prepare in advance;
+                           if less than 1, the mini-batches are read in the
+                           calling thread
+        """
+
+        self._batch_iter = batch_iter
+        self._vocabulary = vocabulary
+        self._queue_size = queue_size
+        # Prevents the background thread from reading while the position of the
+        # wrapped iterator is being changed.
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = None
+        self._batch_queue = None
+        # Position of the wrapped iterator after the last returned mini-batch.
+        self._position = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Returns the next mini-batch prepared by the background thread.
+
+        :rtype: tuple of ndarrays
+        :returns: word ID, class ID, file ID, and mask matrix
+        """
+
+        if self._queue_size < 1:
+            word_ids, file_ids, mask = next(self._batch_iter)
+            class_ids = self._vocabulary.word_id_to_class_id[word_ids]
+            return word_ids, class_ids, file_ids, mask
+
+        if self._thread is None:
+            self._start()
+
+        batch, position, error = self._batch_queue.get()
+        if not error is None:
+            self._thread = None
+            raise error
+        self._position = position
+        if batch is None:
+            raise StopIteration
+        return batch
+
+    def get_state(self, state):
+        """Saves the state of the wrapped iterator in a HDF5 file.
+
+        The saved position is after the last mini-batch that has been returned,
+        even if the background thread has already read further.
+
+        :type state: h5py.File
+        :param state: HDF5 file for storing the iterator state
+        """
+
+        with self._lock:
+            if self._thread is None:
+                self._batch_iter.get_state(state)
+                return
+            current_position = self._batch_iter._get_position()
+            self._batch_iter._set_position(self._position)
+            try:
+                self._batch_iter.get_state(state)
+            finally:
+                self._batch_iter._set_position(current_position)
+
+    def set_state(self, state):
+        """Restores the state of the wrapped iterator. Mini-batches that have
+        been prepared in advance are discarded.
+
+        :type state: h5py.File
+        :param state: HDF5 file that contains the iterator state
+        """
+
+        self._stop()
+        self._batch_iter.set_state(state)
+
+    def _start(self):
+        """Starts the background thread from the current position of the
+        wrapped iterator.
+        """
+
+        self._position = self._batch_iter._get_position()
+        self._stop_event = threading.Event()
+        self._batch_queue = queue.Queue(maxsize=self._queue_size)
+        # A daemon thread won't prevent exiting, if training is stopped while
+        # the thread is waiting for space in the queue.
+        self._thread = threading.Thread(
+            target=self._prefetch,
+            args=(self._stop_event, self._batch_queue),
+            daemon=True)
+        self._thread.start()
+
+    def _stop(self):
+        """Stops the background thread and discards the prepared mini-batches.
+
+        The wrapped iterator is rewound to the position after the last
+        mini-batch that has been returned.
+        """
+
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        # The thread may be waiting for space in the queue.
+        while self._thread.is_alive():
+            try:
+                self._batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+        self._thread = None
+        self._batch_iter._set_position(self._position)
+
+    def _prefetch(self, stop_event, batch_queue):
+        """Reads mini-batches from the wrapped iterator until stopped.
+
+        Puts in the queue a tuple of the mini-batch (or ``None`` at the end of
+        an epoch), the position of the wrapped iterator after the mini-batch,
+        and an exception if one was raised.
+
+        :type stop_event: threading.Event
+        :param stop_event: signals the thread to stop
+
+        :type batch_queue: queue.Queue
+        :param batch_queue: queue where to put the mini-batches
+        """
+
+        while not stop_event.is_set():
+            error = None
+            with self._lock:
+                try:
+                    word_ids, file_ids, mask = next(self._batch_iter)
+                    class_ids = self._vocabulary.word_id_to_class_id[word_ids]
+                    batch = (word_ids, class_ids, file_ids, mask)
+                except StopIteration:
+                    batch = None
+                except Exception as e:
+                    batch = None
+                    error = e
+                position = self._batch_iter._get_position()
+
+            item = (batch, position, error)
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not error is None:
+                return
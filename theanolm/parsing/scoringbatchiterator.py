@@ -9,14 +9,127 @@ class ScoringBatchIterator(LinearBatchIterator):
 
     Returns the actual words in addition to the word IDs. These are needed for
     subword combination. Only one file can be read.
+
+    Optionally reads a window of sentences at a time and sorts them by length
+    before dividing them into mini-batches, so that the mini-batches contain
+    less padding. The index of each sentence in the input is returned, so that
+    the original order can be restored.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self,
+                 input_files,
+                 vocabulary,
+                 batch_size=1,
+                 max_sequence_length=None,
+                 bucket_window=None):
         """Constructs an iterator for reading mini-batches from given file or
         memory map.
+
+        :type input_files: file or mmap object, or a list
+        :param input_files: input text files or their memory-mapped data
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary that provides mapping between words and
+                           word IDs
+
+        :type batch_size: int
+        :param batch_size: number of sentences in one mini-batch (unless the end
+                           of file is encountered earlier)
+
+        :type max_sequence_length: int
+        :param max_sequence_length: if not None, limit to sequences shorter than
+                                    this
+
+        :type bucket_window: int
+        :param bucket_window: if not None, read this many sentences at a time
+                              and sort them by length before creating
+                              mini-batches
+        """
+
+        self._bucket_window = bucket_window
+        super().__init__(input_files, vocabulary, batch_size,
+                         max_sequence_length)
+
+    def __next__(self):
+        """Returns the next mini-batch read from the file.
+
+        If no mini-batches are left from the current window, reads the next
+        window of sentences (or just one mini-batch, if bucketing is not
+        used). Empty lines are skipped, and not counted in the sentence
+        indices.
+
+        :rtype: tuple of ndarrays, list, and ndarray
+        :returns: word ID matrix, words, mask matrix, and the index of each
+                  sequence in the input
+        """
+
+        if not self._pending_batches:
+            if self._bucket_window is None:
+                window_size = self.batch_size
+            else:
+                window_size = max(self._bucket_window, self.batch_size)
+            sequences = []
+            while len(sequences) < window_size:
+                sequence = self._read_sequence()
+                if sequence is None:
+                    break
+                if len(sequence) < 2:
+                    continue
+                sequences.append((self._num_sequences_read, sequence))
+                self._num_sequences_read += 1
+
+            if not sequences:
+                self._reset()
+                raise StopIteration
+
+            if not self._bucket_window is None:
+                sequences.sort(key=lambda x: len(x[1]))
+            self._pending_batches = [
+                sequences[begin:begin + self.batch_size]
+                for begin in range(0, len(sequences), self.batch_size)]
+            # The batches are popped from the end of the list, so the longest
+            # sentences will be returned first.
+
+        batch = self._pending_batches.pop()
+        sequence_indices = numpy.array([index for index, _ in batch],
+                                       dtype='int64')
+        word_ids, words, mask = \
+            self._prepare_batch([sequence for _, sequence in batch])
+        return word_ids, words, mask, sequence_indices
+
+    def _reset(self, shuffle=True):
+        """Resets the read pointer back to the beginning of the file.
+
+        :type shuffle: bool
+        :param shuffle: also shuffles the input sentences, unless set to False
+                        (not supported by this class)
         """
 
-        super().__init__(*args, **kwargs)
+        super()._reset(shuffle)
+        self._pending_batches = []
+        self._num_sequences_read = 0
+
+    def _get_position(self):
+        """Returns the current read position, including the mini-batches that
+        are waiting to be returned from the current window.
+
+        :rtype: tuple
+        :returns: the iterator state that defines the next mini-batch
+        """
+
+        return super()._get_position() + \
+               (list(self._pending_batches), self._num_sequences_read)
+
+    def _set_position(self, position):
+        """Rewinds the iterator to a position returned by ``_get_position()``.
+
+        :type position: tuple
+        :param position: the iterator state that defines the next mini-batch
+        """
+
+        super()._set_position(position[:-2])
+        pending_batches, self._num_sequences_read = position[-2:]
+        self._pending_batches = list(pending_batches)
 
     def _prepare_batch(self, sequences):
         """Transposes a list of sequences into a list of time steps. Then
@@ -34,35 +147,13 @@ class ScoringBatchIterator(LinearBatchIterator):
         each sequence and so on. However the plain text words are returned as a
         list of list of strs.
 
-        :type sequences: list of lists
-        :param sequences: list of sequences, each of which is a list of word
-                          IDs
+        :type sequences: list of BatchIterator.Sequences
+        :param sequences: list of sequences
 
         :rtype: three ndarrays
         :returns: word ID, word, and mask structures
         """
 
-        num_sequences = len(sequences)
-        batch_length = numpy.max([len(s) for s in sequences])
-
-        unk_id = self.vocabulary.word_to_id['<unk>']
-        shape = (batch_length, num_sequences)
-        word_ids = numpy.ones(shape, numpy.int64) * unk_id
-        words = []
-        mask = numpy.zeros(shape, numpy.int8)
-
-        for i, sequence in enumerate(sequences):
-            length = len(sequence)
-
-            sequence_word_ids = numpy.ones(length, numpy.int64) * unk_id
-            sequence_words = []
-            for index, (word, file_id) in enumerate(sequence):
-                if word in self.vocabulary.word_to_id:
-                    sequence_word_ids[index] = self.vocabulary.word_to_id[word]
-                sequence_words.append(word)
-
-            word_ids[:length, i] = sequence_word_ids
-            words.append(sequence_words)
-            mask[:length, i] = 1
-
+        word_ids, mask = self._pad_sequences(sequences)
+        words = [sequence.words for sequence in sequences]
         return word_ids, words, mask
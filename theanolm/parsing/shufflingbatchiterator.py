@@ -2,54 +2,129 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
+import json
 import mmap
+import gzip
 import logging
 import numpy
 from numpy import random
 from theanolm.parsing.batchiterator import BatchIterator
-from theanolm.parsing.functions import find_sentence_starts
+from theanolm.parsing.binarycorpus import BinaryCorpus
+from theanolm.parsing.functions import find_sentence_starts, cache_source
 
 class SentencePointers(object):
     """A class that creates a memory map of text files and stores pointers to
     the beginning of each line in each file.
     """
 
-    def __init__(self, files):
+    def __init__(self, files, cache_dir=None):
         """Creates a memory map of the given files and finds the sentence
         starts.
 
-        The pointers to sentence starts will be saved in a structure where each
-        element is a tuple of two indices - the first index will select the file
-        from the mmaps list and the second index points to the position inside
-        the file.
+        The pointers to sentence starts will be saved in two arrays: ``offsets``
+        contains the position of each sentence inside its file, and
+        ``file_ids`` selects the file from the mmaps list.
 
         Also saves in ``pointer_ranges`` an index to the first pointer and one
         past the last pointer of each file.
 
         :type files: list of file objects
-        :param files: input text files
+        :param files: input text files (not compressed)
+
+        :type cache_dir: str
+        :param cache_dir: if not None, the sentence start positions of each file
+                          are saved in this directory, and read from there on
+                          later runs if the size and modification time of the
+                          file have not changed
         """
 
         self.mmaps = []
-        self.pointers = []
         self.pointer_ranges = []
+        offsets = []
+        file_ids = []
+        num_pointers = 0
 
         for subset_file in files:
+            if isinstance(getattr(subset_file, 'buffer', subset_file),
+                          gzip.GzipFile):
+                raise ValueError("Cannot access compressed file {} randomly. "
+                                 "Convert it into a BinaryCorpus first."
+                                 .format(subset_file.name))
             subset_index = len(self.mmaps)
             subset_mmap = mmap.mmap(subset_file.fileno(),
                                     0,
                                     prot=mmap.PROT_READ)
             self.mmaps.append(subset_mmap)
 
-            logging.debug("Finding sentence start positions in %s.",
-                          subset_file.name)
-            sys.stdout.flush()
-            pointers = [(subset_index, x)
-                        for x in find_sentence_starts(subset_mmap)]
-            pointers_start = len(self.pointers)
-            self.pointers.extend(pointers)
-            pointers_stop = len(self.pointers)
-            self.pointer_ranges.append((pointers_start, pointers_stop))
+            subset_offsets = self._sentence_starts(subset_file, subset_mmap,
+                                                   cache_dir)
+            offsets.append(subset_offsets)
+            file_ids.append(numpy.full(subset_offsets.size, subset_index,
+                                       dtype='int16'))
+            pointers_start = num_pointers
+            num_pointers += subset_offsets.size
+            self.pointer_ranges.append((pointers_start, num_pointers))
+
+        if offsets:
+            self.offsets = numpy.concatenate(offsets)
+            self.file_ids = numpy.concatenate(file_ids)
+        else:
+            self.offsets = numpy.zeros(0, dtype='int64')
+            self.file_ids = numpy.zeros(0, dtype='int16')
+
+    @staticmethod
+    def _sentence_starts(subset_file, subset_mmap, cache_dir):
+        """Finds the sentence start positions in a file, or reads them from the
+        cache directory.
+
+        :type subset_file: file object
+        :param subset_file: an input text file
+
+        :type subset_mmap: mmap.mmap
+        :param subset_mmap: memory-mapped data of the input file
+
+        :type cache_dir: str
+        :param cache_dir: directory for the cached positions, or None to always
+                          scan the file
+
+        :rtype: numpy.ndarray
+        :returns: an int64 array of sentence start positions
+        """
+
+        if cache_dir is None:
+            cache_path = None
+        else:
+            name, source = cache_source(subset_file.name)
+            cache_path = os.path.join(cache_dir, name + '.starts.npy')
+            source_path = os.path.join(cache_dir, name + '.starts.json')
+            if os.path.exists(cache_path) and os.path.exists(source_path):
+                with open(source_path) as source_file:
+                    cached_source = json.load(source_file)
+                if cached_source == source:
+                    logging.debug("Reading sentence start positions of %s "
+                                  "from %s.", subset_file.name, cache_path)
+                    return numpy.load(cache_path)
+
+        logging.debug("Finding sentence start positions in %s.",
+                      subset_file.name)
+        sys.stdout.flush()
+        result = find_sentence_starts(subset_mmap)
+
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            if os.path.exists(source_path):
+                os.remove(source_path)
+            # numpy.save() would append .npy to a name that doesn't end with it.
+            with open(cache_path + '.tmp', 'wb') as cache_file:
+                numpy.save(cache_file, result)
+            os.replace(cache_path + '.tmp', cache_path)
+            # The source information is written last, so that it exists only
+            # if the positions have been saved.
+            with open(source_path + '.tmp', 'w') as source_file:
+                json.dump(source, source_file)
+            os.replace(source_path + '.tmp', source_path)
+        return result
 
     def __len__(self):
         """Returns the number of sentences.
@@ -58,7 +133,7 @@ class SentencePointers(object):
         :returns: the number of sentences found
         """
 
-        return len(self.pointers)
+        return self.offsets.size
 
     def __getitem__(self, sentence_index):
         """Returns a pointer to sentence with given index.
@@ -71,15 +146,16 @@ class SentencePointers(object):
         :returns: a file object and a pointer to the file
         """
 
-        subset_index, sentence_start = self.pointers[sentence_index]
-        subset_mmap = self.mmaps[subset_index]
-        return (subset_mmap, sentence_start)
+        subset_mmap = self.mmaps[self.file_ids[sentence_index]]
+        return (subset_mmap, int(self.offsets[sentence_index]))
 
 class ShufflingBatchIterator(BatchIterator):
     """Iterator for Reading Mini-Batches in a Random Order
 
     Receives the positions of the line starts in the constructor, and shuffles
-    the array whenever the end is reached.
+    the array whenever the end is reached. If the input is given as
+    ``BinaryCorpus`` objects, the word IDs of the sentences are read directly
+    from the corpora.
     """
 
     def __init__(self,
@@ -87,11 +163,12 @@ class ShufflingBatchIterator(BatchIterator):
                  sampling,
                  vocabulary,
                  batch_size=128,
-                 max_sequence_length=None):
+                 max_sequence_length=None,
+                 sentence_index_cache=None):
         """Initializes the iterator to read sentences in linear order.
 
-        :type input_files: list of file objects
-        :param input_files: input text files
+        :type input_files: list of file objects or BinaryCorpus objects
+        :param input_files: input text files or pre-tokenized corpora
 
         :type sampling: list of floats
         :param sampling: specifies a fraction for each input file, how much to
@@ -108,13 +185,32 @@ class ShufflingBatchIterator(BatchIterator):
         :type max_sequence_length: int
         :param max_sequence_length: if not None, limit to sequences shorter than
                                     this
+
+        :type sentence_index_cache: str
+        :param sentence_index_cache: if not None, a directory where the
+                                     sentence start positions of the text files
+                                     are stored for later runs
         """
 
-        self._sentence_pointers = SentencePointers(input_files)
+        if input_files and \
+           all(isinstance(x, BinaryCorpus) for x in input_files):
+            self._corpora = input_files
+            self._sentence_pointers = None
+            self._corpus_starts = numpy.zeros(len(input_files) + 1,
+                                              dtype='int64')
+            self._corpus_starts[1:] = numpy.cumsum(
+                [len(corpus) for corpus in input_files])
+            self._pointer_ranges = list(zip(self._corpus_starts[:-1],
+                                            self._corpus_starts[1:]))
+        else:
+            self._corpora = None
+            self._sentence_pointers = SentencePointers(input_files,
+                                                      sentence_index_cache)
+            self._pointer_ranges = self._sentence_pointers.pointer_ranges
 
         self._sample_sizes = []
         fraction_iter = iter(sampling)
-        for (start, stop) in self._sentence_pointers.pointer_ranges:
+        for (start, stop) in self._pointer_ranges:
             fraction = next(fraction_iter, 1.0)
             sample_size = round(fraction * (stop - start))
             self._sample_sizes.append(sample_size)
@@ -180,6 +276,28 @@ class ShufflingBatchIterator(BatchIterator):
                       self._next_line,
                       self._order.size)
 
+    def _get_position(self):
+        """Returns the current read position, including the iteration order.
+
+        A new array is created for the iteration order when the input is
+        shuffled, so the returned array will not be modified.
+
+        :rtype: tuple
+        :returns: the iterator state that defines the next mini-batch
+        """
+
+        return super()._get_position() + (self._order, self._next_line)
+
+    def _set_position(self, position):
+        """Rewinds the iterator to a position returned by ``_get_position()``.
+
+        :type position: tuple
+        :param position: the iterator state that defines the next mini-batch
+        """
+
+        super()._set_position(position[:-2])
+        self._order, self._next_line = position[-2:]
+
     def _reset(self, shuffle=True):
         """Resets the read pointer back to the beginning of the data set. If
         ``shuffle`` is set to True, also creates a new random order for
@@ -195,7 +313,7 @@ class ShufflingBatchIterator(BatchIterator):
 
             samples = []
             for (start, stop), sample_size in \
-                zip(self._sentence_pointers.pointer_ranges, self._sample_sizes):
+                zip(self._pointer_ranges, self._sample_sizes):
 
                 population = numpy.arange(start, stop, dtype='int64')
                 # No duplicates, unless we need more sentences than there are
@@ -221,8 +339,31 @@ class ShufflingBatchIterator(BatchIterator):
 
         sentence_index = self._order[self._next_line]
         input_file, position = self._sentence_pointers[sentence_index]
-        subset_index, _ = self._sentence_pointers.pointers[sentence_index]
+        subset_index = int(self._sentence_pointers.file_ids[sentence_index])
         input_file.seek(position)
         line = input_file.readline()
         self._next_line += 1
         return line, subset_index
+
+    def _read_utterance(self):
+        """Reads the word IDs of the next sentence from the pre-tokenized
+        corpora, or the next input line, if the input is text.
+
+        :rtype: BatchIterator.Sequence
+        :returns: the next utterance (empty if an empty line was read), or None
+                  if no more data
+        """
+
+        if self._corpora is None:
+            return super()._read_utterance()
+
+        if self._next_line >= self._order.size:
+            return None
+
+        sentence_index = self._order[self._next_line]
+        subset_index = numpy.searchsorted(self._corpus_starts, sentence_index,
+                                          side='right') - 1
+        corpus = self._corpora[subset_index]
+        word_ids = corpus[sentence_index - self._corpus_starts[subset_index]]
+        self._next_line += 1
+        return self.Sequence(word_ids, None, int(subset_index))
@@ -84,3 +84,67 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
         result += prior2 * logprob2;
     assert not numpy.isnan(result)
     return result
+
+def interpolate_linear_array(logprobs1, logprobs2, weight1):
+    """Performs linear interpolation of two arrays of probabilities.
+
+    Computes the same result as ``interpolate_linear()`` for each pair of
+    elements, but without Python overhead. The sum is computed in the log
+    domain, so underflows are not an issue. If a weight is zero, the
+    corresponding log probabilities will be ignored.
+
+    :type logprobs1: numpy.ndarray
+    :param logprobs1: logarithms of the first input probabilities
+
+    :type logprobs2: numpy.ndarray
+    :param logprobs2: logarithms of the second input probabilities
+
+    :type weight1: logprob_type
+    :param weight1: interpolation weight for the first probabilities
+
+    :rtype: numpy.ndarray
+    :returns: logarithms of the weighted sums of the input probabilities
+    """
+
+    logprobs1 = numpy.asarray(logprobs1, dtype='float64')
+    logprobs2 = numpy.asarray(logprobs2, dtype='float64')
+    weight2 = 1.0 - weight1
+    if weight1 == 0:
+        result = logprobs2
+    elif weight2 == 0:
+        result = logprobs1
+    else:
+        result = numpy.logaddexp(logprobs1 + numpy.log(weight1),
+                                 logprobs2 + numpy.log(weight2))
+    return result.astype(logprob_type)
+
+def interpolate_loglinear_array(logprobs1, logprobs2, prior1, prior2):
+    """Performs log-linear interpolation of two arrays of probabilities.
+
+    Computes the same result as ``interpolate_loglinear()`` for each pair of
+    elements, but without Python overhead. If a prior is zero, the
+    corresponding log probabilities will be ignored.
+
+    :type logprobs1: numpy.ndarray
+    :param logprobs1: first input log probabilities
+
+    :type logprobs2: numpy.ndarray
+    :param logprobs2: second input log probabilities
+
+    :type prior1: logprob_type
+    :param prior1: weight for the first log probabilities
+
+    :type prior2: logprob_type
+    :param prior2: weight for the second log probabilities
+
+    :rtype: numpy.ndarray
+    :returns: weighted sums of the input log probabilities
+    """
+
+    result = numpy.zeros(len(logprobs1), dtype=logprob_type)
+    if prior1 != 0:
+        result += prior1 * numpy.asarray(logprobs1, dtype=logprob_type)
+    if prior2 != 0:
+        result += prior2 * numpy.asarray(logprobs2, dtype=logprob_type)
+    assert not numpy.any(numpy.isnan(result))
+    return result
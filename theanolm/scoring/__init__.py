@@ -1,3 +1,5 @@
 from theanolm.scoring.textscorer import TextScorer
+from theanolm.scoring.nbestscorer import NBestScorer
 from theanolm.scoring.latticedecoder import LatticeDecoder
 from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.arraylattice import ArrayLattice
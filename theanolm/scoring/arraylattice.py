@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import numpy
+from theanolm.exceptions import InputError
+from theanolm.probfunctions import logprob_type
+from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.slflattice import SLFLattice
+
+class ArrayLattice(Lattice):
+    """Compact Array-Based Word Lattice
+
+    Stores the lattice in NumPy arrays instead of node and link objects. The
+    start and end node, word ID, and acoustic and language model log
+    probability of each link are stored in arrays indexed by link ID. The word
+    IDs refer to the list of distinct words in the lattice, ``self.words``.
+    Node times are stored in an array indexed by node ID, ``nan`` meaning that
+    the time is not known. The outgoing and incoming links of each node are
+    stored in compressed sparse row format: the IDs of the outgoing links of
+    node ``i`` are ``out_link_ids[out_offsets[i]:out_offsets[i+1]]``.
+
+    ``self.nodes``, ``self.links``, and the link lists of the nodes are
+    sequences that create lightweight views to the arrays when they are
+    accessed. The views implement the same interface as ``Lattice.Node`` and
+    ``Lattice.Link``, so that the lattice can be used wherever a ``Lattice``
+    is expected.
+    """
+
+    class Link(object):
+        """A view to a link in an ``ArrayLattice``.
+        """
+
+        __slots__ = ('_lattice', 'id')
+
+        def __init__(self, lattice, id):
+            """Constructs a view to a link.
+
+            :type lattice: ArrayLattice
+            :param lattice: the lattice that contains the link
+
+            :type id: int
+            :param id: index of the link in the link arrays
+            """
+
+            self._lattice = lattice
+            self.id = id
+
+        @property
+        def start_node(self):
+            return ArrayLattice.Node(self._lattice,
+                                     int(self._lattice.link_starts[self.id]))
+
+        @property
+        def end_node(self):
+            return ArrayLattice.Node(self._lattice,
+                                     int(self._lattice.link_ends[self.id]))
+
+        @property
+        def word(self):
+            word_id = self._lattice.link_word_ids[self.id]
+            if word_id < 0:
+                return None
+            return self._lattice.words[word_id]
+
+        @property
+        def ac_logprob(self):
+            result = self._lattice.link_ac_logprobs[self.id]
+            return None if numpy.isnan(result) else result
+
+        @property
+        def lm_logprob(self):
+            result = self._lattice.link_lm_logprobs[self.id]
+            return None if numpy.isnan(result) else result
+
+    class Node(object):
+        """A view to a node in an ``ArrayLattice``.
+        """
+
+        __slots__ = ('_lattice', 'id')
+
+        def __init__(self, lattice, id):
+            """Constructs a view to a node.
+
+            :type lattice: ArrayLattice
+            :param lattice: the lattice that contains the node
+
+            :type id: int
+            :param id: index of the node in the node arrays
+            """
+
+            self._lattice = lattice
+            self.id = id
+
+        @property
+        def out_links(self):
+            lattice = self._lattice
+            begin = lattice.out_offsets[self.id]
+            end = lattice.out_offsets[self.id + 1]
+            return ArrayLattice.Views(lattice, ArrayLattice.Link,
+                                      lattice.out_link_ids[begin:end])
+
+        @property
+        def in_links(self):
+            lattice = self._lattice
+            begin = lattice.in_offsets[self.id]
+            end = lattice.in_offsets[self.id + 1]
+            return ArrayLattice.Views(lattice, ArrayLattice.Link,
+                                      lattice.in_link_ids[begin:end])
+
+        @property
+        def time(self):
+            result = self._lattice.node_times[self.id]
+            return None if numpy.isnan(result) else result
+
+        @property
+        def best_logprob(self):
+            result = self._lattice.node_best_logprobs[self.id]
+            return None if numpy.isnan(result) else result
+
+        @best_logprob.setter
+        def best_logprob(self, value):
+            if value is None:
+                value = numpy.nan
+            self._lattice.node_best_logprobs[self.id] = value
+
+    class Views(object):
+        """A sequence of node or link views.
+
+        The views are created when they are accessed, so the sequence takes
+        only as much memory as the IDs, which may be a slice of an ID array.
+        """
+
+        __slots__ = ('_lattice', '_view_type', '_ids')
+
+        def __init__(self, lattice, view_type, ids):
+            """Constructs a sequence of views.
+
+            :type lattice: ArrayLattice
+            :param lattice: the lattice that contains the nodes or links
+
+            :type view_type: type
+            :param view_type: ``ArrayLattice.Node`` or ``ArrayLattice.Link``
+
+            :type ids: range or numpy.ndarray
+            :param ids: IDs of the nodes or links in the sequence
+            """
+
+            self._lattice = lattice
+            self._view_type = view_type
+            self._ids = ids
+
+        def __len__(self):
+            return len(self._ids)
+
+        def __getitem__(self, index):
+            return self._view_type(self._lattice, int(self._ids[index]))
+
+        def __iter__(self):
+            lattice = self._lattice
+            view_type = self._view_type
+            for id in self._ids:
+                yield view_type(lattice, int(id))
+
+    def __init__(self, lattice=None):
+        """Creates a compact copy of a lattice.
+
+        The node IDs of the source lattice have to be the indices of the nodes
+        in its node list. Links of each node will be in the same order as in
+        the source lattice. If ``lattice`` is ``None``, creates an empty
+        lattice.
+
+        :type lattice: Lattice
+        :param lattice: the lattice to be copied
+        """
+
+        super().__init__()
+
+        self.words = []
+        if lattice is None:
+            self._set_arrays(numpy.zeros(0),
+                             numpy.zeros(0, dtype='int64'),
+                             numpy.zeros(0, dtype='int64'),
+                             numpy.zeros(0, dtype='int64'),
+                             numpy.zeros(0, dtype=logprob_type),
+                             numpy.zeros(0, dtype=logprob_type))
+            return
+
+        self.utterance_id = lattice.utterance_id
+        self.lm_scale = lattice.lm_scale
+        self.wi_penalty = lattice.wi_penalty
+
+        num_nodes = len(lattice.nodes)
+        num_links = len(lattice.links)
+        word_ids = dict()
+        link_starts = numpy.empty(num_links, dtype='int64')
+        link_ends = numpy.empty(num_links, dtype='int64')
+        link_word_ids = numpy.empty(num_links, dtype='int64')
+        link_ac_logprobs = numpy.full(num_links, numpy.nan, dtype=logprob_type)
+        link_lm_logprobs = numpy.full(num_links, numpy.nan, dtype=logprob_type)
+        for link_id, link in enumerate(lattice.links):
+            link_starts[link_id] = link.start_node.id
+            link_ends[link_id] = link.end_node.id
+            link_word_ids[link_id] = self._word_id(link.word, word_ids)
+            if not link.ac_logprob is None:
+                link_ac_logprobs[link_id] = link.ac_logprob
+            if not link.lm_logprob is None:
+                link_lm_logprobs[link_id] = link.lm_logprob
+
+        node_times = numpy.full(num_nodes, numpy.nan)
+        for node in lattice.nodes:
+            if not node.time is None:
+                node_times[node.id] = node.time
+
+        self._set_arrays(node_times, link_starts, link_ends, link_word_ids,
+                         link_ac_logprobs, link_lm_logprobs)
+        if not lattice.initial_node is None:
+            self.initial_node = self.nodes[lattice.initial_node.id]
+        if not lattice.final_node is None:
+            self.final_node = self.nodes[lattice.final_node.id]
+
+    @classmethod
+    def from_slf(cls, lattice_file):
+        """Reads an SLF lattice file directly into the arrays.
+
+        The links are read into arrays by ``SLFLattice``, and the arrays are
+        indexed without creating the link objects. Words are moved from the
+        nodes to the links that lead to the node, like ``SLFLattice`` does.
+
+        :type lattice_file: file object
+        :param lattice_file: a file in SLF lattice format
+
+        :rtype: ArrayLattice
+        :returns: the lattice read from ``lattice_file``
+        """
+
+        reader = SLFLattice(None)
+        reader._read_slf(lattice_file)
+        link_ac_logprobs, link_lm_logprobs = reader._link_logprobs()
+        link_starts = reader._link_starts
+        link_ends = reader._link_ends
+
+        result = cls()
+        result.utterance_id = reader.utterance_id
+        result.lm_scale = reader.lm_scale
+        result.wi_penalty = reader.wi_penalty
+
+        node_words = [getattr(node, 'word', None) for node in reader.nodes]
+        word_ids = dict()
+        link_word_ids = numpy.empty(len(reader._link_words), dtype='int64')
+        for link_id, word in enumerate(reader._link_words):
+            node_word = node_words[link_ends[link_id]]
+            if not node_word is None:
+                if not word is None:
+                    raise InputError("SLF lattice contains words both in nodes "
+                                     "and links.")
+                word = node_word
+            if word is None:
+                raise InputError("SLF lattice does not contain word identity "
+                                 "in link {} or in the following node.".format(
+                                 link_id))
+            link_word_ids[link_id] = result._word_id(word, word_ids)
+
+        node_times = numpy.full(len(reader.nodes), numpy.nan)
+        for node in reader.nodes:
+            if not node.time is None:
+                node_times[node.id] = node.time
+
+        result._set_arrays(node_times, link_starts, link_ends, link_word_ids,
+                           link_ac_logprobs, link_lm_logprobs)
+
+        # Without explicit IDs, the initial node is the first node with no
+        # incoming links, and the final node is the first node with no outgoing
+        # links.
+        initial_node_id = reader._initial_node_id
+        if initial_node_id is None:
+            candidates = numpy.flatnonzero(numpy.diff(result.in_offsets) == 0)
+            if len(candidates) == 0:
+                raise InputError("Could not find initial node in SLF lattice.")
+            initial_node_id = candidates[0]
+        result.initial_node = result.nodes[initial_node_id]
+        final_node_id = reader._final_node_id
+        if final_node_id is None:
+            candidates = numpy.flatnonzero(numpy.diff(result.out_offsets) == 0)
+            if len(candidates) == 0:
+                raise InputError("Could not find final node in SLF lattice.")
+            final_node_id = candidates[0]
+        result.final_node = result.nodes[final_node_id]
+        return result
+
+    def sorted_node_ids(self):
+        """Sorts nodes topologically, then by time, using the arrays.
+
+        Picks the nodes in the same order as ``Lattice.sorted_nodes()``, but
+        uses a heap for finding the node with the lowest time stamp from the
+        queue.
+
+        :rtype: numpy.ndarray
+        :returns: IDs of the nodes in sorted order
+        """
+
+        num_nodes = len(self.nodes)
+        times = self.node_times.tolist()
+        has_time = numpy.logical_not(numpy.isnan(self.node_times)).tolist()
+        out_offsets = self.out_offsets.tolist()
+        successors = self.link_ends[self.out_link_ids].tolist()
+        in_degrees = numpy.diff(self.in_offsets).tolist()
+
+        def key(node_id, count):
+            # Nodes without time go last. Of the nodes with equal time, the one
+            # that was added to the queue last is picked first.
+            if has_time[node_id]:
+                return (False, times[node_id], -count, node_id)
+            else:
+                return (True, 0.0, -count, node_id)
+
+        result = []
+        count = 0
+        node_queue = [key(self.initial_node.id, count)]
+        while node_queue:
+            node_id = heapq.heappop(node_queue)[3]
+            result.append(node_id)
+            for position in range(out_offsets[node_id],
+                                  out_offsets[node_id + 1]):
+                next_id = successors[position]
+                in_degrees[next_id] -= 1
+                if in_degrees[next_id] == 0:
+                    count += 1
+                    heapq.heappush(node_queue, key(next_id, count))
+                elif in_degrees[next_id] < 0:
+                    raise InputError("Word lattice contains a cycle.")
+
+        if len(result) < num_nodes:
+            logging.warning("Word lattice contains unreachable nodes.")
+        else:
+            assert len(result) == num_nodes
+
+        return numpy.array(result, dtype='int64')
+
+    def sorted_nodes(self):
+        """Sorts nodes topologically, then by time.
+
+        :rtype: list of ArrayLattice.Nodes
+        :returns: the nodes in sorted order
+        """
+
+        return [self.nodes[node_id] for node_id in self.sorted_node_ids()]
+
+    def _word_id(self, word, word_ids):
+        """Finds the ID of a word in ``self.words``, adding the word if it's not
+        there yet.
+
+        :type word: str
+        :param word: the word, or ``None`` for no word
+
+        :type word_ids: dict
+        :param word_ids: mapping from the words in ``self.words`` to their IDs
+
+        :rtype: int
+        :returns: index of the word in ``self.words``, or -1 for ``None``
+        """
+
+        if word is None:
+            return -1
+        result = word_ids.get(word)
+        if result is None:
+            result = len(self.words)
+            word_ids[word] = result
+            self.words.append(word)
+        return result
+
+    def _set_arrays(self, node_times, link_starts, link_ends, link_word_ids,
+                    link_ac_logprobs, link_lm_logprobs):
+        """Stores the node and link arrays and indexes the links by node.
+
+        :type node_times: numpy.ndarray
+        :param node_times: time of each node, ``nan`` if not known
+
+        :type link_starts: numpy.ndarray
+        :param link_starts: start node ID of each link
+
+        :type link_ends: numpy.ndarray
+        :param link_ends: end node ID of each link
+
+        :type link_word_ids: numpy.ndarray
+        :param link_word_ids: index of the word of each link in ``self.words``,
+                              -1 for no word
+
+        :type link_ac_logprobs: numpy.ndarray
+        :param link_ac_logprobs: acoustic log probability of each link, ``nan``
+                                 if not known
+
+        :type link_lm_logprobs: numpy.ndarray
+        :param link_lm_logprobs: language model log probability of each link,
+                                 ``nan`` if not known
+        """
+
+        num_nodes = len(node_times)
+        num_links = len(link_starts)
+        self.node_times = node_times
+        self.node_best_logprobs = numpy.full(num_nodes, numpy.nan,
+                                             dtype=logprob_type)
+        self.link_starts = link_starts
+        self.link_ends = link_ends
+        self.link_word_ids = link_word_ids
+        self.link_ac_logprobs = link_ac_logprobs
+        self.link_lm_logprobs = link_lm_logprobs
+
+        self.out_offsets, self.out_link_ids = \
+            self._link_index(link_starts, num_nodes)
+        self.in_offsets, self.in_link_ids = \
+            self._link_index(link_ends, num_nodes)
+
+        self.nodes = self.Views(self, self.Node, range(num_nodes))
+        self.links = self.Views(self, self.Link, range(num_links))
+
+    @staticmethod
+    def _link_index(node_ids, num_nodes):
+        """Creates a compressed sparse row index of the links by node.
+
+        :type node_ids: numpy.ndarray
+        :param node_ids: start or end node ID of each link
+
+        :type num_nodes: int
+        :param num_nodes: number of nodes in the lattice
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: the offset of the first link of each node, followed by the
+                  total number of links, and the link IDs sorted by node
+        """
+
+        link_ids = numpy.argsort(node_ids, kind='mergesort')
+        offsets = numpy.zeros(num_nodes + 1, dtype='int64')
+        offsets[1:] = numpy.cumsum(numpy.bincount(node_ids,
+                                                  minlength=num_nodes))
+        return offsets, link_ids
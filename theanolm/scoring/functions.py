@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+import theano
+from theanolm.network import NumpyNetwork
+
+def create_step_function(network, log_normalizer=None, profile=False,
+                         function_cache=None):
+    """Creates the function that computes the target word log probabilities
+    for a single time step.
+
+    The same function is used by ``NBestScorer`` and ``LatticeDecoder``. It
+    takes as input the input word IDs, input class IDs, target word IDs, target
+    class IDs, and the recurrent state variables. It returns a list that
+    contains the target word log probabilities followed by the new recurrent
+    state variables. The network has to be created in single time step mode.
+
+    :type network: Network or NumpyNetwork
+    :param network: the neural network object
+
+    :type log_normalizer: float
+    :param log_normalizer: constant logarithm of the softmax normalizer, or
+                           None to normalize the output exactly
+
+    :type profile: bool
+    :param profile: if set to True, creates a Theano profile object (the
+                    function cache is not used then)
+
+    :type function_cache: FunctionCache
+    :param function_cache: if set to other than None, the compiled function
+                           is read from and written to this cache
+
+    :rtype: callable
+    :returns: the step function
+    """
+
+    # A NumPy network is evaluated directly, without compiling a function.
+    if isinstance(network, NumpyNetwork):
+        return network.create_step_function(log_normalizer)
+
+    def compile_function():
+        inputs = [network.input_word_ids,
+                  network.input_class_ids,
+                  network.target_word_ids,
+                  network.target_class_ids]
+        inputs.extend(network.recurrent_state_input)
+
+        outputs = [network.target_logprobs(log_normalizer)]
+        outputs.extend(network.recurrent_state_output)
+
+        # Ignore unused input, because is_training is only used by dropout
+        # layer.
+        return theano.function(
+            inputs,
+            outputs,
+            givens=[(network.is_training, numpy.int8(0))],
+            name='step_predictor',
+            on_unused_input='ignore',
+            profile=profile)
+
+    if (function_cache is None) or profile:
+        return compile_function()
+    options = {'log_normalizer': log_normalizer}
+    result, = function_cache.get_functions(
+        network, 'step_predictor', options, lambda: [compile_function()])
+    return result
@@ -1,20 +1,138 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from copy import deepcopy
+from collections import OrderedDict
+from bisect import bisect_left
+import heapq
 import math
 import logging
 import numpy
 import theano
-from theano import tensor
 from theanolm.network import RecurrentState
 from theanolm.probfunctions import *
 from theanolm.exceptions import InputError
+from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.functions import create_step_function
 
 class LatticeDecoder(object):
     """Word Lattice Decoding Using a Neural Network Language Model
     """
 
+    class WordHistory:
+        """Word History of a Decoding Token
+
+        The word histories of the tokens form a prefix tree. Each node stores
+        one word and a pointer to the node of the previous word. The nodes are
+        never modified, so a token can be copied without copying its history,
+        and extending the history creates only one new node.
+
+        The hash of the entire history is computed when a node is created from
+        the hash of the previous node. The hash of a limited number of previous
+        words is computed when requested, and the last such value is cached.
+        """
+
+        __slots__ = ('word', 'previous', 'length', '_full_hash',
+                     '_hash_order', '_hash')
+
+        def __init__(self, word, previous=None):
+            """Creates a history node that extends ``previous`` by ``word``.
+
+            :type word: int or str
+            :param word: word ID, or an OOV word as text
+
+            :type previous: LatticeDecoder.WordHistory
+            :param previous: history of the previous words, or ``None`` if this
+                             is the first word
+            """
+
+            self.word = word
+            self.previous = previous
+            if previous is None:
+                self.length = 1
+                self._full_hash = hash((None, word))
+            else:
+                self.length = previous.length + 1
+                self._full_hash = hash((previous._full_hash, word))
+            self._hash_order = None
+            self._hash = None
+
+        @classmethod
+        def from_words(classname, words):
+            """Creates a history from a list of words.
+
+            :type words: list of ints and strs
+            :param words: word IDs, or OOV words as text
+
+            :rtype: LatticeDecoder.WordHistory
+            :returns: the node of the last word, or ``None`` if ``words`` is
+                      empty
+            """
+
+            result = None
+            for word in words:
+                result = classname(word, result)
+            return result
+
+        def extend(self, word):
+            """Creates a new history that contains the words of this history
+            followed by ``word``. This history is not modified.
+
+            :type word: int or str
+            :param word: word ID, or an OOV word as text
+
+            :rtype: LatticeDecoder.WordHistory
+            :returns: the node of the new word
+            """
+
+            return type(self)(word, self)
+
+        def hash(self, order=None):
+            """Computes a hash of the last ``order`` words.
+
+            :type order: int
+            :param order: number of words to consider, or ``None`` for the
+                          entire history
+
+            :rtype: int
+            :returns: the hash value
+            """
+
+            if order is None:
+                return self._full_hash
+            if order != self._hash_order:
+                words = []
+                node = self
+                while (not node is None) and (len(words) < order):
+                    words.append(node.word)
+                    node = node.previous
+                self._hash_order = order
+                self._hash = hash(tuple(words))
+            return self._hash
+
+        def __len__(self):
+            """Returns the number of words in the history.
+
+            :rtype: int
+            :returns: length of the history
+            """
+
+            return self.length
+
+        def __iter__(self):
+            """Iterates the words from the first one to the last one.
+
+            :rtype: iterator
+            :returns: an iterator over the word IDs and OOV words
+            """
+
+            words = []
+            node = self
+            while not node is None:
+                words.append(node.word)
+                node = node.previous
+            return reversed(words)
+
     class Token:
         """Decoding Token
 
@@ -23,7 +141,7 @@ class LatticeDecoder(object):
         """
 
         def __init__(self,
-                     history=[],
+                     history=None,
                      state=[],
                      ac_logprob=logprob_type(0.0),
                      lat_lm_logprob=logprob_type(0.0),
@@ -35,10 +153,13 @@ class LatticeDecoder(object):
             overhead.
 
             New tokens will not have recombination hash and total log
-            probability set.
+            probability set. When the decoder records an expanded lattice,
+            ``origin`` will be set to identify the token and link that this
+            token was propagated from.
 
-            :type history: list of ints
-            :param history: word IDs that the token has passed
+            :type history: LatticeDecoder.WordHistory or list
+            :param history: word IDs that the token has passed, either as a
+                            history node or a list
 
             :type state: RecurrentState
             :param state: the state of the recurrent layers for a single
@@ -57,21 +178,27 @@ class LatticeDecoder(object):
                                   lattice links
             """
 
-            self.history = history
+            if isinstance(history, LatticeDecoder.WordHistory) or \
+               (history is None):
+                self.history = history
+            else:
+                self.history = LatticeDecoder.WordHistory.from_words(history)
             self.state = state
             self.ac_logprob = ac_logprob
             self.lat_lm_logprob = lat_lm_logprob
             self.nn_lm_logprob = nn_lm_logprob
             self.recombination_hash = None
             self.total_logprob = None
+            self.origin = None
 
         @classmethod
         def copy(classname, token):
             """Creates a copy of a token.
 
-            The recurrent layer states will not be copied - a pointer will be
-            copied instead. There's no need to copy the structure, since we
-            never modify the state of a token, but replace it if necessary.
+            The recurrent layer states and the word history will not be
+            copied - a pointer will be copied instead. There's no need to copy
+            the structures, since we never modify the state or the history of a
+            token, but replace them if necessary.
 
             Recombination hash and total log probability will not be copied.
 
@@ -82,7 +209,7 @@ class LatticeDecoder(object):
             :returns: a copy of ``token``
             """
 
-            return classname(deepcopy(token.history),
+            return classname(token.history,
                              token.state,
                              token.ac_logprob,
                              token.lat_lm_logprob,
@@ -97,11 +224,11 @@ class LatticeDecoder(object):
                 recombining tokens, or ``None`` for the entire history
             """
 
-            if recombination_order is None:
-                limited_history = self.history
+            if self.history is None:
+                self.recombination_hash = hash(())
             else:
-                limited_history = self.history[-recombination_order:]
-            self.recombination_hash = hash(tuple(limited_history))
+                self.recombination_hash = \
+                    self.history.hash(recombination_order)
 
         def recompute_total(self, nn_lm_weight, lm_scale, wi_penalty,
                             linear=False):
@@ -139,7 +266,71 @@ class LatticeDecoder(object):
                     nn_lm_weight, (1.0 - nn_lm_weight))
             self.total_logprob = self.ac_logprob
             self.total_logprob += self.lm_logprob * lm_scale
-            self.total_logprob += wi_penalty * len(self.history)
+            if not self.history is None:
+                self.total_logprob += wi_penalty * len(self.history)
+
+        @staticmethod
+        def recompute_totals(tokens, nn_lm_weight, lm_scale, wi_penalty,
+                             linear=False):
+            """Computes the interpolated language model log probability and
+            the total log probability of several tokens at once.
+
+            Gives the same result as calling ``recompute_total()`` for each
+            token, but collects the log probabilities into arrays and performs
+            the interpolation and the computation of the total log
+            probabilities as vectorized operations.
+
+            :type tokens: list of LatticeDecoder.Tokens
+            :param tokens: the tokens whose log probabilities will be updated
+
+            :type nn_lm_weight: logprob_type
+            :param nn_lm_weight: weight of the neural network LM probability
+                                 when interpolating with the lattice probability
+
+            :type lm_scale: logprob_type
+            :param lm_scale: scaling factor for LM probability when computing
+                             the total probability
+
+            :type wi_penalty: logprob_type
+            :param wi_penalty: penalize each word in the history by adding this
+                               value as many times as there are words
+
+            :type linear: bool
+            :param linear: if set to ``True`` performs linear interpolation
+                           instead of (pseudo) log-linear
+
+            :rtype: numpy.ndarray
+            :returns: the total log probabilities of the tokens
+            """
+
+            num_tokens = len(tokens)
+            ac_logprobs = numpy.empty(num_tokens, dtype=logprob_type)
+            lat_lm_logprobs = numpy.empty(num_tokens, dtype=logprob_type)
+            nn_lm_logprobs = numpy.empty(num_tokens, dtype=logprob_type)
+            lengths = numpy.empty(num_tokens, dtype=logprob_type)
+            for index, token in enumerate(tokens):
+                ac_logprobs[index] = token.ac_logprob
+                lat_lm_logprobs[index] = token.lat_lm_logprob
+                nn_lm_logprobs[index] = token.nn_lm_logprob
+                lengths[index] = \
+                    0 if token.history is None else len(token.history)
+
+            if linear:
+                lm_logprobs = interpolate_linear_array(
+                    nn_lm_logprobs, lat_lm_logprobs, nn_lm_weight)
+            else:
+                lm_logprobs = interpolate_loglinear_array(
+                    nn_lm_logprobs, lat_lm_logprobs,
+                    nn_lm_weight, (1.0 - nn_lm_weight))
+            total_logprobs = ac_logprobs
+            total_logprobs += lm_logprobs * logprob_type(lm_scale)
+            total_logprobs += lengths * logprob_type(wi_penalty)
+
+            for token, lm_logprob, total_logprob in \
+                zip(tokens, lm_logprobs, total_logprobs):
+                token.lm_logprob = lm_logprob
+                token.total_logprob = total_logprob
+            return total_logprobs
 
         def history_words(self, vocabulary):
             """Converts the word IDs in the history to words using
@@ -153,6 +344,8 @@ class LatticeDecoder(object):
             :returns: the token's history as list of words
             """
 
+            if self.history is None:
+                return []
             return [vocabulary.id_to_word[word] if isinstance(word, int)
                     else word
                     for word in self.history]
@@ -169,7 +362,7 @@ class LatticeDecoder(object):
             """
 
             if vocabulary is None:
-                history = ' '.join(str(x) for x in self.history)
+                history = ' '.join(str(x) for x in self.history or [])
             else:
                 history = ' '.join(self.history_words(vocabulary))
 
@@ -189,14 +382,153 @@ class LatticeDecoder(object):
                            self.nn_lm_logprob,
                            self.total_logprob)
 
-    def __init__(self, network, decoding_options, profile=False):
+    class StateCache:
+        """Cache of Neural Network States
+
+        When the same word history is propagated to several links, the neural
+        network would be evaluated repeatedly for identical input. The cache
+        maps a word history to the recurrent state that results from feeding
+        the last word of the history to the network, and the log probabilities
+        of the words that have been predicted after the history.
+
+        When the cache is full, the least recently used history is removed.
+        """
+
+        def __init__(self, max_entries):
+            """Creates an empty cache.
+
+            :type max_entries: int
+            :param max_entries: maximum number of word histories to store
+            """
+
+            self.max_entries = max_entries
+            self._entries = OrderedDict()
+
+        def get(self, context, target_word_id):
+            """Looks up the output state and the log probability of a target
+            word after given word history.
+
+            :type context: int
+            :param context: hash of the word history
+
+            :type target_word_id: int
+            :param target_word_id: ID of the predicted word
+
+            :rtype: tuple of (RecurrentState, float)
+            :returns: the output state and the log probability of the target
+                      word, or ``None`` if not found from the cache
+            """
+
+            try:
+                state, logprobs = self._entries[context]
+                logprob = logprobs[target_word_id]
+            except KeyError:
+                return None
+            self._entries.move_to_end(context)
+            return state, logprob
+
+        def add(self, context, state, target_word_id, logprob):
+            """Stores the output state and the log probability of a target word
+            after given word history.
+
+            :type context: int
+            :param context: hash of the word history
+
+            :type state: RecurrentState
+            :param state: the recurrent state after the word history
+
+            :type target_word_id: int
+            :param target_word_id: ID of the predicted word
+
+            :type logprob: float
+            :param logprob: log probability of the target word
+            """
+
+            if self.max_entries < 1:
+                return
+            if context in self._entries:
+                self._entries[context][1][target_word_id] = logprob
+                self._entries.move_to_end(context)
+                return
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[context] = (state, {target_word_id: logprob})
+
+        def __len__(self):
+            """Returns the number of word histories stored in the cache.
+
+            :rtype: int
+            :returns: number of entries in the cache
+            """
+
+            return len(self._entries)
+
+    class SuffixMaximum:
+        """Maximum of Array Suffixes
+
+        Keeps track of the maximum value in ``values[begin:]`` for any
+        ``begin``, when the values are only increased. Uses a Fenwick tree over
+        the reversed array, so that both updating a value and finding the
+        maximum of a suffix take O(log N) time.
+        """
+
+        def __init__(self, size):
+            """Creates an array of given size, initialized to negative infinity.
+
+            :type size: int
+            :param size: number of elements in the array
+            """
+
+            self._size = size
+            self._tree = [-numpy.inf] * (size + 1)
+
+        def update(self, position, value):
+            """Increases the value at given position, if ``value`` is larger
+            than the current value.
+
+            :type position: int
+            :param position: index to the array
+
+            :type value: float
+            :param value: the new value
+            """
+
+            index = self._size - position
+            while index <= self._size:
+                if self._tree[index] < value:
+                    self._tree[index] = value
+                index += index & -index
+
+        def query(self, begin):
+            """Finds the maximum value in the suffix that starts from given
+            position.
+
+            :type begin: int
+            :param begin: index of the first element in the suffix
+
+            :rtype: float
+            :returns: the maximum value, or negative infinity if none of the
+                      values in the suffix have been set
+            """
+
+            result = -numpy.inf
+            index = self._size - begin
+            while index > 0:
+                if self._tree[index] > result:
+                    result = self._tree[index]
+                index -= index & -index
+            return result
+
+    def __init__(self, network, decoding_options, profile=False,
+                 function_cache=None):
         """Creates a Theano function that computes the output probabilities for
         a single time step.
 
         Creates the function self.step_function that takes as input a set of
         word sequences and the current recurrent states. It uses the previous
         states and word IDs to compute the output distributions, and computes
-        the probabilities of the target words.
+        the probabilities of the target words. The network has to be created in
+        single time step mode.
 
         All invocations of ``decode()`` will use the given NNLM weight and LM
         scale when computing the total probability. If LM scale is not given,
@@ -240,6 +572,22 @@ class LatticeDecoder(object):
           number of words to consider when deciding whether two tokens should be
           recombined, or ``None`` for the entire word history
 
+        max_batch_size : int
+          collect token expansions from consecutive lattice nodes and evaluate
+          at most this many tokens in one call to the neural network, or
+          ``None`` for no limit
+
+        state_cache_size : float
+          maximum amount of memory in megabytes used for caching the neural
+          network states and predictions of word histories that have already
+          been evaluated, or 0 to disable the cache; the history is limited to
+          ``recombination_order`` words
+
+        log_normalizer : float
+          if set to other than None, the neural network output is not normalized
+          over the vocabulary, but this constant is subtracted from the target
+          preactivations (only for self-normalized softmax models)
+
         :type network: Network
         :param network: the neural network object
 
@@ -248,6 +596,10 @@ class LatticeDecoder(object):
 
         :type profile: bool
         :param profile: if set to True, creates a Theano profile object
+
+        :type function_cache: FunctionCache
+        :param function_cache: if set to other than None, the compiled function
+                               is read from and written to this cache
         """
 
         self._network = network
@@ -263,27 +615,38 @@ class LatticeDecoder(object):
         if not self._beam is None:
             self._beam = logprob_type(self._beam)
         self._recombination_order = decoding_options['recombination_order']
+        # Tokens can be dropped before evaluating the network only if the log
+        # probability of the next word cannot be positive. With a constant
+        # softmax normalizer, or a positive <unk> penalty, it can.
+        log_normalizer = decoding_options['log_normalizer']
+        self._drop_early = (log_normalizer is None) and \
+                           ((self._unk_penalty is None) or
+                            (self._unk_penalty <= 0) or
+                            self._ignore_unk)
+        self._max_batch_size = decoding_options['max_batch_size']
+        cache_size = decoding_options['state_cache_size']
+        if cache_size:
+            # Approximate the memory used by one entry from the size of the
+            # state vectors and the overhead of the Python objects.
+            entry_size = sum(network.recurrent_state_size)
+            entry_size *= numpy.dtype(theano.config.floatX).itemsize
+            entry_size += 1024
+            max_entries = int(cache_size * 1024 * 1024 / entry_size)
+            self._state_cache = self.StateCache(max_entries)
+        else:
+            self._state_cache = None
+
+        # Expansions of the lattice links that will be written to a rescored
+        # lattice. Recorded only when called through rescore().
+        self._expansions = None
 
         self._sos_id = self._vocabulary.word_to_id['<s>']
         self._eos_id = self._vocabulary.word_to_id['</s>']
         self._unk_id = self._vocabulary.word_to_id['<unk>']
 
-        inputs = [network.input_word_ids,
-                  network.input_class_ids,
-                  network.target_class_ids]
-        inputs.extend(network.recurrent_state_input)
-
-        outputs = [tensor.log(network.target_probs())]
-        outputs.extend(network.recurrent_state_output)
-
-        # Ignore unused input, because is_training is only used by dropout
-        # layer.
-        self.step_function = theano.function(
-            inputs,
-            outputs,
-            givens=[(network.is_training, numpy.int8(0))],
-            name='step_predictor',
-            on_unused_input='ignore')
+        self.step_function = create_step_function(
+            network, decoding_options['log_normalizer'],
+            function_cache=function_cache)
 
     def decode(self, lattice):
         """Propagates tokens through given lattice and returns a list of tokens
@@ -292,6 +655,13 @@ class LatticeDecoder(object):
         Propagates tokens at a node to every outgoing link by creating a copy of
         each token and updating the language model scores according to the link.
 
+        The neural network is not evaluated separately for each link. The
+        expansions of consecutive nodes are collected, and evaluated in one
+        batch when the batch size limit is reached, or when an expansion that
+        has not been evaluated yet ends at a node that affects the beam pruning
+        threshold of the next node in topological order. That includes the
+        next node itself, so the result does not depend on the batch size.
+
         :type lattice: Lattice
         :param lattice: a word lattice to be decoded
 
@@ -314,6 +684,11 @@ class LatticeDecoder(object):
         else:
             wi_penalty = logprob_type(0.0)
 
+        self._sorted_nodes = lattice.sorted_nodes()
+        for node in lattice.nodes:
+            node.best_logprob = None
+        self._index_nodes()
+
         self._tokens = [list() for _ in lattice.nodes]
         initial_state = RecurrentState(self._network.recurrent_state_size)
         initial_token = self.Token(history=[self._sos_id], state=initial_state)
@@ -321,11 +696,31 @@ class LatticeDecoder(object):
         initial_token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
                                       self._linear_interpolation)
         self._tokens[lattice.initial_node.id].append(initial_token)
-        lattice.initial_node.best_logprob = initial_token.total_logprob
+        if not self._expansions is None:
+            self._expansions = []
+            self._expanded_initial_node = \
+                (lattice.initial_node.id, initial_token.recombination_hash)
+        self._update_best_logprob(lattice.initial_node,
+                                  initial_token.total_logprob)
+
+        # Expansions whose neural network scores have not been computed yet, as
+        # (tokens, link, word) tuples, and the last position of their end nodes
+        # in the sorted node list.
+        pending = []
+        pending_end = -1
+        num_pending_tokens = 0
 
-        self._sorted_nodes = lattice.sorted_nodes()
         nodes_processed = 0
         for node in self._sorted_nodes:
+            # The pruning threshold is the best log probability in the nodes
+            # starting from the time of this node. The pending expansions have
+            # to be evaluated first, if they end at any of those nodes.
+            if pending_end >= self._time_begins[node.id]:
+                self._propagate_pending(pending, lm_scale, wi_penalty)
+                pending = []
+                pending_end = -1
+                num_pending_tokens = 0
+
             node_tokens = self._tokens[node.id]
             assert node_tokens
             num_pruned_tokens = len(node_tokens)
@@ -337,16 +732,37 @@ class LatticeDecoder(object):
             if node.id == lattice.final_node.id:
                 new_tokens = self._propagate(
                     node_tokens, None, lm_scale, wi_penalty)
+                if not self._expansions is None:
+                    for token, new_token in zip(node_tokens, new_tokens):
+                        self._expansions.append(
+                            ((node.id, token.recombination_hash),
+                             None,
+                             None,
+                             new_token.nn_lm_logprob - token.nn_lm_logprob))
                 return sorted(new_tokens,
                               key=lambda token: token.total_logprob,
                               reverse=True)
 
             num_new_tokens = 0
             for link in node.out_links:
-                new_tokens = self._propagate(
+                new_tokens, word = self._traverse_link(
                     node_tokens, link, lm_scale, wi_penalty)
-                self._tokens[link.end_node.id].extend(new_tokens)
                 num_new_tokens += len(new_tokens)
+                if word is None:
+                    self._update_tokens(new_tokens, link, lm_scale, wi_penalty)
+                    self._tokens[link.end_node.id].extend(new_tokens)
+                else:
+                    pending.append((new_tokens, link, word))
+                    pending_end = max(pending_end,
+                                      self._node_positions[link.end_node.id])
+                    num_pending_tokens += len(new_tokens)
+
+            if (not self._max_batch_size is None) and \
+               (num_pending_tokens >= self._max_batch_size):
+                self._propagate_pending(pending, lm_scale, wi_penalty)
+                pending = []
+                pending_end = -1
+                num_pending_tokens = 0
 
             nodes_processed += 1
             if nodes_processed % math.ceil(len(self._sorted_nodes) / 20) == 0:
@@ -359,6 +775,122 @@ class LatticeDecoder(object):
 
         raise InputError("Could not reach the final node of word lattice.")
 
+    def rescore(self, lattice):
+        """Decodes a lattice and creates a new lattice with the neural network
+        language model scores.
+
+        The nodes are expanded so that each node of the new lattice corresponds
+        to a node of the original lattice and a word history, as far as the
+        history is considered in recombination. The pruning options limit the
+        number of histories at each node, and parts of the lattice that don't
+        lead to the final node are removed. The language model score of each
+        link is the interpolation of the neural network and lattice LM scores
+        of the link. An extra final node is added, and the links leading to it
+        contain the end of sentence scores.
+
+        :type lattice: Lattice
+        :param lattice: a word lattice to be rescored
+
+        :rtype: SLFLattice
+        :returns: the expanded and rescored lattice
+        """
+
+        self._expansions = []
+        try:
+            self.decode(lattice)
+            return self._create_expanded_lattice(lattice)
+        finally:
+            self._expansions = None
+
+    def _create_expanded_lattice(self, lattice):
+        """Creates a lattice from the link expansions that were recorded while
+        decoding.
+
+        :type lattice: Lattice
+        :param lattice: the lattice that was decoded
+
+        :rtype: SLFLattice
+        :returns: the expanded and rescored lattice
+        """
+
+        expansions = self._expansions
+
+        # Find the expansions from which the final node can be reached. The
+        # links to the end of sentence have None as the end node.
+        predecessors = dict()
+        for index, (_, end_key, _, _) in enumerate(expansions):
+            predecessors.setdefault(end_key, []).append(index)
+        reachable = set([None])
+        used = [False] * len(expansions)
+        stack = [None]
+        while stack:
+            for index in predecessors.get(stack.pop(), []):
+                used[index] = True
+                start_key = expansions[index][0]
+                if not start_key in reachable:
+                    reachable.add(start_key)
+                    stack.append(start_key)
+
+        # Order the expanded nodes by the position of the original node in the
+        # topological order, and then by the order of creation.
+        first_seen = dict()
+        first_seen[self._expanded_initial_node] = 0
+        for start_key, end_key, _, _ in expansions:
+            first_seen.setdefault(start_key, len(first_seen))
+            first_seen.setdefault(end_key, len(first_seen))
+        reachable.discard(None)
+        keys = sorted(reachable,
+                      key=lambda key: (self._node_positions[key[0]],
+                                       first_seen[key]))
+
+        result = SLFLattice(None)
+        result.utterance_id = lattice.utterance_id
+        if not self._lm_scale is None:
+            result.lm_scale = self._lm_scale
+        else:
+            result.lm_scale = lattice.lm_scale
+        if not self._wi_penalty is None:
+            result.wi_penalty = self._wi_penalty
+        else:
+            result.wi_penalty = lattice.wi_penalty
+
+        expanded_nodes = dict()
+        for key in keys:
+            node = Lattice.Node(len(result.nodes))
+            node.time = lattice.nodes[key[0]].time
+            result.nodes.append(node)
+            expanded_nodes[key] = node
+        final_node = Lattice.Node(len(result.nodes))
+        final_node.time = lattice.final_node.time
+        result.nodes.append(final_node)
+        expanded_nodes[None] = final_node
+        result.initial_node = expanded_nodes[self._expanded_initial_node]
+        result.final_node = final_node
+
+        for index, (start_key, end_key, link, nn_lm_logprob) in \
+            enumerate(expansions):
+            if not used[index]:
+                continue
+            new_link = result._add_link(expanded_nodes[start_key],
+                                        expanded_nodes[end_key])
+            if link is None:
+                new_link.word = '!NULL'
+                lat_lm_logprob = logprob_type(0.0)
+            else:
+                new_link.word = link.word
+                new_link.ac_logprob = link.ac_logprob
+                lat_lm_logprob = link.lm_logprob
+                if lat_lm_logprob is None:
+                    lat_lm_logprob = logprob_type(0.0)
+            if self._linear_interpolation:
+                new_link.lm_logprob = interpolate_linear(
+                    nn_lm_logprob, lat_lm_logprob, self._nnlm_weight)
+            else:
+                new_link.lm_logprob = interpolate_loglinear(
+                    nn_lm_logprob, lat_lm_logprob,
+                    self._nnlm_weight, (1.0 - self._nnlm_weight))
+        return result
+
     def _propagate(self, tokens, link, lm_scale, wi_penalty):
         """Propagates tokens to given link or to end of sentence.
 
@@ -390,33 +922,247 @@ class LatticeDecoder(object):
         :returns: the propagated tokens
         """
 
-        new_tokens = [self.Token.copy(token) for token in tokens]
-
         if link is None:
-            self._append_word(new_tokens, self._eos_id)
+            new_tokens = [self.Token.copy(token) for token in tokens]
+            word = self._eos_id
+        else:
+            new_tokens, word = self._traverse_link(
+                tokens, link, lm_scale, wi_penalty)
+        if not word is None:
+            self._append_word(new_tokens, word)
+        self._update_tokens(new_tokens, link, lm_scale, wi_penalty)
+        return new_tokens
+
+    def _propagate_pending(self, pending, lm_scale, wi_penalty):
+        """Computes the neural network scores of pending link expansions and
+        moves the tokens to the end nodes of the links.
+
+        The expansions may originate from different nodes and may predict
+        different words. All the tokens are evaluated together, in batches of
+        at most ``max_batch_size`` tokens.
+
+        :type pending: list of tuples
+        :param pending: a list of (tokens, link, word) tuples, where ``tokens``
+                        have been created by ``_traverse_link()`` for ``link``,
+                        and ``word`` is the word that will be appended to them
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+        """
+
+        if not pending:
+            return
+
+        tokens = []
+        target_words = []
+        for new_tokens, _, word in pending:
+            tokens.extend(new_tokens)
+            target_words.extend([word] * len(new_tokens))
+        self._append_words(tokens, target_words)
+
+        for new_tokens, link, _ in pending:
+            self._update_tokens(new_tokens, link, lm_scale, wi_penalty)
+            self._tokens[link.end_node.id].extend(new_tokens)
+
+    def _traverse_link(self, tokens, link, lm_scale, wi_penalty):
+        """Creates copies of the tokens and adds the acoustic and lattice LM
+        scores of a link to them.
+
+        If beam pruning is enabled, tokens that would certainly be pruned at
+        the end node of the link are not returned.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens
+
+        :type link: Lattice.Link
+        :param link: the link whose scores will be added
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :rtype: tuple of (list of LatticeDecoder.Tokens, int or str)
+        :returns: the new tokens, and the word ID (or an OOV word as text) that
+                  should be appended to their history using the neural network,
+                  or ``None`` if the link is a null link
+        """
+
+        ac_logprob = link.ac_logprob
+        if ac_logprob is None:
+            ac_logprob = logprob_type(0.0)
+        lm_logprob = link.lm_logprob
+        if lm_logprob is None:
+            lm_logprob = logprob_type(0.0)
+        Token = self.Token
+        new_tokens = [Token(token.history,
+                            token.state,
+                            token.ac_logprob + ac_logprob,
+                            token.lat_lm_logprob + lm_logprob,
+                            token.nn_lm_logprob)
+                      for token in tokens]
+
+        if link.word.startswith('!'):
+            word = None
         else:
-            for token in new_tokens:
-                if not link.ac_logprob is None:
-                    token.ac_logprob += link.ac_logprob
-                if not link.lm_logprob is None:
-                    token.lat_lm_logprob += link.lm_logprob
-            if not link.word.startswith('!'):
-                try:
-                    word = self._vocabulary.word_to_id[link.word]
-                except KeyError:
-                    word = link.word
-                self._append_word(new_tokens, word)
-
-        for token in new_tokens:
+            try:
+                word = self._vocabulary.word_to_id[link.word]
+            except KeyError:
+                word = link.word
+
+        if not self._expansions is None:
+            for token, new_token in zip(tokens, new_tokens):
+                new_token.origin = ((link.start_node.id,
+                                     token.recombination_hash),
+                                    link,
+                                    token.nn_lm_logprob)
+
+        # When recording an expanded lattice, tokens whose history survives
+        # at the end node are needed even if the token itself is pruned.
+        if (not self._beam is None) and (self._expansions is None) and \
+           self._drop_early and new_tokens:
+            new_tokens = self._drop_outside_beam(
+                new_tokens, link.end_node, not word is None, lm_scale,
+                wi_penalty)
+        return new_tokens, word
+
+    def _drop_outside_beam(self, tokens, node, add_word, lm_scale, wi_penalty):
+        """Drops tokens that will certainly be pruned at given node, before
+        evaluating the neural network on them.
+
+        When the output is normalized exactly and ``<unk>`` penalty is not
+        positive, the neural network log probability of the next word cannot be
+        positive, so an upper bound for the total log probability of a token is
+        obtained by computing the total without the next word. (Otherwise this
+        function is not called.) A token is dropped if the bound is not better
+        than the current beam pruning threshold of ``node``, and there's
+        already a better token in ``node``. The threshold can only increase, so
+        ``_prune()`` would remove such a token anyway. Expansions that are still
+        waiting for the network evaluation can only make the threshold looser,
+        so the batch size affects how many tokens are dropped, but not the
+        result.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: tokens that are being propagated to ``node``
+
+        :type node: Lattice.Node
+        :param node: the node where the tokens are propagated
+
+        :type add_word: bool
+        :param add_word: ``True`` if a word will still be appended to the
+                         tokens, ``False`` for a null link
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :rtype: list of LatticeDecoder.Tokens
+        :returns: the tokens that may survive pruning
+        """
+
+        if node.best_logprob is None:
+            return tokens
+        time_begin = self._time_begins[node.id]
+        threshold = self._best_logprobs.query(time_begin) - self._beam
+
+        bounds = self.Token.recompute_totals(
+            tokens, self._nnlm_weight, lm_scale, wi_penalty,
+            self._linear_interpolation)
+        if add_word:
+            bounds += wi_penalty
+        keep = (bounds > threshold) | (bounds >= node.best_logprob)
+        if keep.all():
+            return tokens
+        return [tokens[index] for index in numpy.flatnonzero(keep)]
+
+    def _update_tokens(self, tokens, link, lm_scale, wi_penalty):
+        """Recomputes the recombination hash and total log probability of
+        propagated tokens, and updates ``best_logprob`` of the end node.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: tokens that have been propagated to ``link``
+
+        :type link: Lattice.Link
+        :param link: the link where the tokens were propagated, or ``None`` for
+                     end of sentence
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+        """
+
+        if not tokens:
+            return
+        for token in tokens:
             token.recompute_hash(self._recombination_order)
-            token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
-                                  self._linear_interpolation)
-            if not link is None:
-                if (link.end_node.best_logprob is None) or \
-                   (token.total_logprob > link.end_node.best_logprob):
-                    link.end_node.best_logprob = token.total_logprob
+        total_logprobs = self.Token.recompute_totals(
+            tokens, self._nnlm_weight, lm_scale, wi_penalty,
+            self._linear_interpolation)
+        if not link is None:
+            self._update_best_logprob(link.end_node, total_logprobs.max())
+
+    def _index_nodes(self):
+        """Creates the data structures that are needed for finding the beam
+        pruning threshold of a node efficiently.
+
+        For each node, finds the position of the first node in
+        ``self._sorted_nodes`` whose time is equal to or greater than the time
+        of the node. If the node time is not known, uses the position of the
+        node itself. Initializes a data structure for finding the best log
+        probability in the nodes starting from such a position from the
+        current ``best_logprob`` values of the nodes.
+        """
 
-        return new_tokens
+        # Maximum time up to each position in the sorted node list is
+        # non-decreasing, so it can be searched using bisection.
+        max_times = []
+        max_time = -numpy.inf
+        for node in self._sorted_nodes:
+            if (not node.time is None) and (node.time > max_time):
+                max_time = node.time
+            max_times.append(max_time)
+
+        self._node_positions = dict()
+        self._time_begins = dict()
+        self._best_logprobs = self.SuffixMaximum(len(self._sorted_nodes))
+        for position, node in enumerate(self._sorted_nodes):
+            self._node_positions[node.id] = position
+            if node.time is None:
+                self._time_begins[node.id] = position
+            else:
+                self._time_begins[node.id] = bisect_left(max_times, node.time)
+            assert self._time_begins[node.id] < len(self._sorted_nodes)
+            if not node.best_logprob is None:
+                self._best_logprobs.update(position, node.best_logprob)
+
+    def _update_best_logprob(self, node, logprob):
+        """Updates ``best_logprob`` of a node, if ``logprob`` is better than
+        the current value.
+
+        :type node: Lattice.Node
+        :param node: the node to update
+
+        :type logprob: logprob_type
+        :param logprob: total log probability of a token in the node
+        """
+
+        if (node.best_logprob is None) or (logprob > node.best_logprob):
+            node.best_logprob = logprob
+            position = self._node_positions.get(node.id)
+            if not position is None:
+                self._best_logprobs.update(position, logprob)
 
     def _prune(self, node):
         """Prunes tokens from a node according to beam and the maximum number of
@@ -426,45 +1172,58 @@ class LatticeDecoder(object):
         :param node: perform pruning on this node
         """
 
-        new_tokens = dict()
-        for token in self._tokens[node.id]:
+        arrived_tokens = self._tokens[node.id]
+        recombined_tokens = dict()
+        for token in arrived_tokens:
             key = token.recombination_hash
-            if (not key in new_tokens) or \
-               (token.total_logprob > new_tokens[key].total_logprob):
-                new_tokens[key] = token
-
-        # Sort the tokens by descending log probability.
-        new_tokens = sorted(new_tokens.values(),
-                            key=lambda token: token.total_logprob, reverse=True)
+            if (not key in recombined_tokens) or \
+               (token.total_logprob > recombined_tokens[key].total_logprob):
+                recombined_tokens[key] = token
+        new_tokens = list(recombined_tokens.values())
 
-        # Compare to the best probability at the same or later time.
+        # Compare to the best probability at the same or later time, before
+        # sorting. The best token is kept even if it's outside the beam.
         if not self._beam is None:
-            if node.time is None:
-                node_ids = [iter_node.id for iter_node in self._sorted_nodes]
-                time_begin = node_ids.index(node.id)
-            else:
-                for time_begin, iter_node in enumerate(self._sorted_nodes):
-                    if (not iter_node.time is None) and \
-                       (iter_node.time >= node.time):
-                        break
-            assert time_begin < len(self._sorted_nodes)
-
-            best_logprob = max(iter_node.best_logprob
-                               for iter_node in self._sorted_nodes[time_begin:]
-                               if not iter_node.best_logprob is None)
+            time_begin = self._time_begins[node.id]
+            best_logprob = self._best_logprobs.query(time_begin)
             threshold = best_logprob - self._beam
-            token_index = len(new_tokens) - 1
-            while (token_index >= 1) and \
-                  (new_tokens[token_index].total_logprob <= threshold):
-                del new_tokens[token_index]
-                token_index -= 1
-
-        # Enforce limit on number of tokens at each node.
-        if not self._max_tokens_per_node is None:
-            new_tokens[self._max_tokens_per_node:] = []
+            beam_tokens = [token for token in new_tokens
+                           if token.total_logprob > threshold]
+            if beam_tokens:
+                new_tokens = beam_tokens
+            else:
+                new_tokens = [max(new_tokens,
+                                  key=lambda token: token.total_logprob)]
+
+        # Sort the tokens by descending log probability. If there's a limit on
+        # the number of tokens at each node, select only the best tokens.
+        key = lambda token: token.total_logprob
+        if (not self._max_tokens_per_node is None) and \
+           (len(new_tokens) > self._max_tokens_per_node):
+            new_tokens = heapq.nlargest(self._max_tokens_per_node, new_tokens,
+                                        key=key)
+        else:
+            new_tokens.sort(key=key, reverse=True)
 
         self._tokens[node.id] = new_tokens
 
+        if not self._expansions is None:
+            # Every token that arrived at the node through a link creates a
+            # link in the expanded lattice, if a token with the same
+            # recombination hash survived pruning.
+            surviving_hashes = set(token.recombination_hash
+                                   for token in new_tokens)
+            for token in arrived_tokens:
+                if (token.origin is None) or \
+                   (not token.recombination_hash in surviving_hashes):
+                    continue
+                start_key, link, nn_lm_logprob = token.origin
+                self._expansions.append(
+                    (start_key,
+                     (node.id, token.recombination_hash),
+                     link,
+                     token.nn_lm_logprob - nn_lm_logprob))
+
     def _append_word(self, tokens, target_word):
         """Appends a word to each of the given tokens, and updates their scores.
 
@@ -479,43 +1238,153 @@ class LatticeDecoder(object):
                             used in the resulting transcript
         """
 
-        def str_to_unk(self, word):
-            if isinstance(word, int):
-                return word
-            else:
-                return self._unk_id
+        self._append_words(tokens, [target_word] * len(tokens))
+
+    def _append_words(self, tokens, target_words):
+        """Appends a word to each of the given tokens, and updates their scores.
+        Each token may be extended with a different word.
+
+        If the state cache is enabled, the results are looked up from the cache
+        using the word history of each token, limited to
+        ``recombination_order`` words. Tokens that are not found from the cache
+        are evaluated using the neural network, but only once per distinct
+        word history and target word. The neural network is evaluated for at
+        most ``max_batch_size`` tokens at a time.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens
+
+        :type target_words: list of ints and strs
+        :param target_words: the word ID or word to be appended to the history
+                             of each input token; if not an integer, the word
+                             will be considered ``<unk>`` and this variable will
+                             be taken literally as the word that will be used
+                             in the resulting transcript
+        """
+
+        assert len(tokens) == len(target_words)
+
+        target_word_ids = [self._str_to_unk(word) for word in target_words]
+        results = [None] * len(tokens)
+        if self._state_cache is None:
+            requests = [(index,) for index in range(len(tokens))]
+        else:
+            requests = OrderedDict()
+            contexts = [self._history_context(token) for token in tokens]
+            for index, context in enumerate(contexts):
+                key = (context, target_word_ids[index])
+                results[index] = self._state_cache.get(*key)
+                if results[index] is None:
+                    requests.setdefault(key, []).append(index)
+            requests = list(requests.values())
+
+        if self._max_batch_size is None:
+            batch_size = max(len(requests), 1)
+        else:
+            batch_size = self._max_batch_size
+        for begin in range(0, len(requests), batch_size):
+            batch = requests[begin:begin + batch_size]
+            batch_tokens = [tokens[indices[0]] for indices in batch]
+            batch_word_ids = [target_word_ids[indices[0]] for indices in batch]
+            batch_results = self._compute_step(batch_tokens, batch_word_ids)
+            for indices, result in zip(batch, batch_results):
+                for index in indices:
+                    results[index] = result
+                if not self._state_cache is None:
+                    self._state_cache.add(contexts[indices[0]],
+                                          result[0],
+                                          target_word_ids[indices[0]],
+                                          result[1])
 
-        input_word_ids = [[str_to_unk(self, token.history[-1])
+        for index, token in enumerate(tokens):
+            token.history = token.history.extend(target_words[index])
+            token.state, logprob = results[index]
+            if target_word_ids[index] == self._unk_id:
+                if self._ignore_unk:
+                    continue
+                if not self._unk_penalty is None:
+                    token.nn_lm_logprob += self._unk_penalty
+                    continue
+            token.nn_lm_logprob += logprob
+
+    def _compute_step(self, tokens, target_word_ids):
+        """Evaluates the neural network for one time step of the given tokens.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens; the last word of the history of each token
+                       will be used as input
+
+        :type target_word_ids: list of ints
+        :param target_word_ids: ID of the word to be predicted for each token
+
+        :rtype: list of tuples
+        :returns: a list that contains for each token the recurrent state after
+                  the input word (RecurrentState) and the log probability of the
+                  target word
+        """
+
+        input_word_ids = [[self._str_to_unk(token.history.word)
                            for token in tokens]]
         input_word_ids = numpy.asarray(input_word_ids).astype('int64')
-        input_class_ids, membership_probs = \
-            self._vocabulary.get_class_memberships(input_word_ids)
+        input_class_ids = self._vocabulary.word_id_to_class_id[input_word_ids]
         recurrent_state = [token.state for token in tokens]
         recurrent_state = RecurrentState.combine_sequences(recurrent_state)
-        target_word_id = str_to_unk(self, target_word)
-        target_class_ids = numpy.ones(shape=(1, len(tokens))).astype('int64')
-        target_class_ids *= self._vocabulary.word_id_to_class_id[target_word_id]
+        target_word_ids = numpy.asarray([target_word_ids]).astype('int64')
+        target_class_ids, membership_probs = \
+            self._vocabulary.get_class_memberships(target_word_ids)
         step_result = self.step_function(input_word_ids,
                                          input_class_ids,
+                                         target_word_ids,
                                          target_class_ids,
                                          *recurrent_state.get())
         logprobs = step_result[0]
-        # Add logprobs from the class membership of the predicted words.
-        logprobs += numpy.log(membership_probs)
+        # Add logprobs from the class membership of the predicted words, unless
+        # the network predicts the words directly.
+        if not self._network.predicts_words:
+            logprobs += numpy.log(membership_probs)
         output_state = step_result[1:]
 
-        for index, token in enumerate(tokens):
-            token.history.append(target_word)
-            token.state = RecurrentState(self._network.recurrent_state_size)
-            # Slice the sequence that corresponds to this token.
-            token.state.set([layer_state[:,index:index+1]
-                             for layer_state in output_state])
-
-            if target_word_id == self._unk_id:
-                if self._ignore_unk:
-                    continue
-                if not self._unk_penalty is None:
-                    token.nn_lm_logprob += self._unk_penalty
-                    continue
+        result = []
+        for index in range(len(tokens)):
+            state = RecurrentState(self._network.recurrent_state_size)
+            # Slice the sequence that corresponds to this token. If the state
+            # may be stored in the cache, copy it so that the slice won't keep
+            # the entire matrix in memory.
+            if self._state_cache is None:
+                state.set([layer_state[:,index:index+1]
+                           for layer_state in output_state])
+            else:
+                state.set([layer_state[:,index:index+1].copy()
+                           for layer_state in output_state])
             # logprobs matrix contains only one time step.
-            token.nn_lm_logprob += logprobs[0,index]
+            result.append((state, logprobs[0,index]))
+        return result
+
+    def _history_context(self, token):
+        """Returns the word history of a token that is used as a key in the
+        state cache.
+
+        :type token: LatticeDecoder.Token
+        :param token: a token
+
+        :rtype: int
+        :returns: hash of the word history limited to ``recombination_order``
+                  words
+        """
+
+        return token.history.hash(self._recombination_order)
+
+    def _str_to_unk(self, word):
+        """Maps OOV words to the <unk> word ID.
+
+        :type word: int or str
+        :param word: a word ID, or an OOV word as text
+
+        :rtype: int
+        :returns: ``word`` if it is a word ID, otherwise the ID of <unk>
+        """
+
+        if isinstance(word, int):
+            return word
+        else:
+            return self._unk_id
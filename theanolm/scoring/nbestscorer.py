@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+from theanolm.network import RecurrentState
+from theanolm.scoring.functions import create_step_function
+from theanolm.exceptions import NumberError
+
+class NBestScorer(object):
+    """N-best List Scoring Using Shared Prefixes
+
+    The hypotheses of an utterance in an n-best list typically share long
+    common prefixes. The scorer builds a prefix tree from the hypotheses of one
+    utterance and evaluates the neural network one time step at a time, so that
+    every distinct prefix is evaluated only once. The recurrent state after
+    each prefix is passed to the extensions of the prefix. All the prefixes
+    that have the same length are evaluated in one call to the neural network.
+    """
+
+    class PrefixNode(object):
+        """A node in the prefix tree. Represents the word sequence from the root
+        to this node.
+        """
+
+        def __init__(self, word_id):
+            """Constructs a prefix tree node.
+
+            :type word_id: int
+            :param word_id: ID of the last word of the prefix
+            """
+
+            self.word_id = word_id
+            self.children = dict()
+            self.hypothesis_indices = []
+            self.logprob = 0.0
+
+    def __init__(self, network, ignore_unk=False, unk_penalty=None,
+                 profile=False, log_normalizer=None, function_cache=None):
+        """Creates a Theano function that computes the output probabilities for
+        a single time step.
+
+        Creates the function ``self.step_function`` that takes as input a set of
+        word sequences and the current recurrent states. It uses the previous
+        states and word IDs to compute the output distributions, and computes
+        the probabilities of the target words. The network has to be created in
+        single time step mode.
+
+        :type network: Network
+        :param network: the neural network object
+
+        :type ignore_unk: bool
+        :param ignore_unk: if set to True, <unk> tokens are excluded from the
+                           scores
+
+        :type unk_penalty: float
+        :param unk_penalty: if set to othern than None, used as <unk> token
+                            score
+
+        :type profile: bool
+        :param profile: if set to True, creates a Theano profile object
+
+        :type log_normalizer: float
+        :param log_normalizer: if set to other than None, the output is not
+                               normalized over the vocabulary, but this constant
+                               is subtracted from the target preactivations
+                               (only for self-normalized softmax models)
+
+        :type function_cache: FunctionCache
+        :param function_cache: if set to other than None, the compiled function
+                               is read from and written to this cache
+        """
+
+        self._network = network
+        self._vocabulary = network.vocabulary
+        self._ignore_unk = ignore_unk
+        self._unk_penalty = unk_penalty
+        self._sos_id = self._vocabulary.word_to_id['<s>']
+        self._unk_id = self._vocabulary.word_to_id['<unk>']
+
+        self.step_function = create_step_function(network, log_normalizer,
+                                                  profile, function_cache)
+
+        # These are updated by score_hypotheses(). num_evaluations is the number
+        # of words that were actually predicted using the network.
+        self.num_words = 0
+        self.num_unks = 0
+        self.num_evaluations = 0
+
+    def score_hypotheses(self, hypotheses):
+        """Computes the log probabilities of the hypotheses of one utterance.
+
+        Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) are
+        expected to be included in each hypothesis, the sequences starting with
+        ``<s>``.
+
+        :type hypotheses: list of lists of strs
+        :param hypotheses: the word sequences of the hypotheses
+
+        :rtype: list of floats
+        :returns: log probability of each hypothesis
+        """
+
+        root = self._build_prefix_tree(hypotheses)
+        result = [None] * len(hypotheses)
+        for index in root.hypothesis_indices:
+            result[index] = 0.0
+
+        sizes = self._network.recurrent_state_size
+        frontier = [root]
+        state = RecurrentState(sizes)
+        while frontier:
+            parent_indices = []
+            children = []
+            for parent_index, node in enumerate(frontier):
+                for child in node.children.values():
+                    parent_indices.append(parent_index)
+                    children.append(child)
+            if not children:
+                break
+
+            input_word_ids = [[frontier[index].word_id
+                               for index in parent_indices]]
+            input_word_ids = numpy.asarray(input_word_ids).astype('int64')
+            input_class_ids = \
+                self._vocabulary.word_id_to_class_id[input_word_ids]
+            target_word_ids = [[child.word_id for child in children]]
+            target_word_ids = numpy.asarray(target_word_ids).astype('int64')
+            target_class_ids, membership_probs = \
+                self._vocabulary.get_class_memberships(target_word_ids)
+            input_state = [layer_state[:, parent_indices]
+                           for layer_state in state.get()]
+            step_result = self.step_function(input_word_ids,
+                                             input_class_ids,
+                                             target_word_ids,
+                                             target_class_ids,
+                                             *input_state)
+            self.num_evaluations += len(children)
+            logprobs = step_result[0][0]
+            # Add logprobs from the class membership of the predicted words,
+            # unless the network predicts the words directly.
+            if not self._network.predicts_words:
+                logprobs += numpy.log(membership_probs[0])
+            output_state = step_result[1:]
+
+            for parent_index, child, logprob in \
+                zip(parent_indices, children, logprobs):
+                child.logprob = frontier[parent_index].logprob
+                if child.word_id != self._unk_id:
+                    child.logprob += logprob
+                elif self._ignore_unk:
+                    continue
+                elif not self._unk_penalty is None:
+                    child.logprob += self._unk_penalty
+                else:
+                    child.logprob += logprob
+
+            prefix_logprobs = numpy.array([child.logprob for child in children])
+            if numpy.any(numpy.isnan(prefix_logprobs)):
+                raise NumberError("Log probability of a sequence is NaN.")
+            if numpy.any(numpy.isinf(prefix_logprobs)):
+                raise NumberError("Log probability of a sequence is +/- "
+                                  "infinity.")
+            for child in children:
+                for index in child.hypothesis_indices:
+                    result[index] = child.logprob
+
+            # Only the prefixes that continue need to be passed to the next
+            # time step.
+            continuing = [index for index, child in enumerate(children)
+                          if child.children]
+            frontier = [children[index] for index in continuing]
+            state = RecurrentState(
+                sizes, len(continuing),
+                [layer_state[:, continuing] for layer_state in output_state])
+
+        return result
+
+    def _build_prefix_tree(self, hypotheses):
+        """Creates a prefix tree from word sequences.
+
+        The word sequences are converted to word IDs, and a node that
+        corresponds to the entire sequence stores the index of the hypothesis.
+        Updates the word and <unk> counters.
+
+        :type hypotheses: list of lists of strs
+        :param hypotheses: word sequences, starting with ``<s>``
+
+        :rtype: NBestScorer.PrefixNode
+        :returns: the root node of the prefix tree, corresponding to ``<s>``
+        """
+
+        root = self.PrefixNode(self._sos_id)
+        for index, words in enumerate(hypotheses):
+            word_ids = self._vocabulary.words_to_ids(words)
+            if (word_ids.size == 0) or (word_ids[0] != self._sos_id):
+                raise ValueError("Hypotheses should start with <s>.")
+            self.num_words += word_ids.size
+            self.num_unks += numpy.count_nonzero(word_ids == self._unk_id)
+            node = root
+            for word_id in word_ids[1:].tolist():
+                child = node.children.get(word_id)
+                if child is None:
+                    child = self.PrefixNode(word_id)
+                    node.children[word_id] = child
+                node = child
+            node.hypothesis_indices.append(index)
+        return root
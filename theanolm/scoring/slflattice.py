@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import numpy
 from shlex import shlex
 from theanolm.exceptions import InputError
@@ -13,6 +14,9 @@ class SLFLattice(Lattice):
     A word lattice that can be read in SLF format.
     """
 
+    # Matches the fields of an SLF line that doesn't need the shlex parser.
+    _field_pattern = re.compile(r'[^ \t\r\n]+')
+
     def __init__(self, lattice_file):
         """Reads an SLF lattice file.
 
@@ -35,37 +39,11 @@ class SLFLattice(Lattice):
         if lattice_file is None:
             self._num_nodes = 0
             self._num_links = 0
+            self._allocate_links(0)
             return
 
-        self._num_nodes = None
-        self._num_links = None
-        for line in lattice_file:
-            fields = self._split_slf_line(line)
-            self._read_slf_header(fields)
-            if (not self._num_nodes is None) and (not self._num_links is None):
-                break
-
-        if not self.wi_penalty is None:
-            if self._log_scale is None:
-                self.wi_penalty = numpy.log(self.wi_penalty)
-            else:
-                self.wi_penalty *= self._log_scale
-
-        self.nodes = [self.Node(id) for id in range(self._num_nodes)]
-
-        for line in lattice_file:
-            fields = self._split_slf_line(line)
-            if not fields:
-                continue
-            name, value = self._split_slf_field(fields[0])
-            if name == 'I':
-                self._read_slf_node(int(value), fields[1:])
-            elif name == 'J':
-                self._read_slf_link(int(value), fields[1:])
-
-        if len(self.links) != self._num_links:
-            raise InputError("Number of links in SLF lattice doesn't match the "
-                             "LINKS field.")
+        self._read_slf(lattice_file)
+        self._create_links()
 
         if not self._initial_node_id is None:
             self.initial_node = self.nodes[self._initial_node_id]
@@ -94,11 +72,106 @@ class SLFLattice(Lattice):
         # If word identity information is not present in node definitions then
         # it must appear in link definitions.
         self._move_words_to_links()
-        for link in self.links:
+        for link_id, link in enumerate(self.links):
             if link.word is None:
                 raise InputError("SLF lattice does not contain word identity "
                                  "in link {} or in the following node.".format(
-                                 link.id))
+                                 link_id))
+
+    def write(self, output_file, log_base=None):
+        """Writes the lattice in SLF format.
+
+        The lines are written to ``output_file`` one at a time, so the file can
+        be e.g. a gzip stream. Node IDs are required to be the indices of the
+        nodes in the node list.
+
+        :type output_file: file object
+        :param output_file: a text file where to write the lattice
+
+        :type log_base: int
+        :param log_base: write log probabilities in this base (default is the
+                         natural logarithm)
+        """
+
+        if log_base is None:
+            log_scale = 1.0
+        else:
+            log_scale = numpy.log(log_base)
+
+        output_file.write('VERSION=1.1\n')
+        if not self.utterance_id is None:
+            output_file.write('UTTERANCE={}\n'.format(
+                self._format_slf_value(self.utterance_id)))
+        if not log_base is None:
+            output_file.write('base={}\n'.format(log_base))
+        if not self.lm_scale is None:
+            output_file.write('lmscale={}\n'.format(float(self.lm_scale)))
+        if not self.wi_penalty is None:
+            output_file.write('wdpenalty={}\n'.format(
+                float(self.wi_penalty / log_scale)))
+        output_file.write('start={} end={}\n'.format(self.initial_node.id,
+                                                     self.final_node.id))
+        output_file.write('NODES={} LINKS={}\n'.format(len(self.nodes),
+                                                       len(self.links)))
+
+        for node in self.nodes:
+            if node.time is None:
+                output_file.write('I={}\n'.format(node.id))
+            else:
+                output_file.write('I={}\tt={}\n'.format(node.id,
+                                                        float(node.time)))
+
+        for link_id, link in enumerate(self.links):
+            fields = ['J={}'.format(link_id),
+                      'S={}'.format(link.start_node.id),
+                      'E={}'.format(link.end_node.id)]
+            if not link.word is None:
+                fields.append('W={}'.format(self._format_slf_value(link.word)))
+            if not link.ac_logprob is None:
+                fields.append('a={}'.format(
+                    float(link.ac_logprob / log_scale)))
+            if not link.lm_logprob is None:
+                fields.append('l={}'.format(
+                    float(link.lm_logprob / log_scale)))
+            output_file.write('\t'.join(fields) + '\n')
+
+    def _read_slf(self, lattice_file):
+        """Reads the header, nodes, and links of an SLF lattice file.
+
+        The nodes are created, but the links are only saved in the link arrays.
+        ``ArrayLattice`` reads the link arrays directly, without creating the
+        link objects.
+
+        :type lattice_file: file object
+        :param lattice_file: a file in SLF lattice format
+        """
+
+        self._num_nodes = None
+        self._num_links = None
+        for line in lattice_file:
+            fields = self._split_slf_line(line)
+            self._read_slf_header(fields)
+            if (not self._num_nodes is None) and (not self._num_links is None):
+                break
+
+        if not self.wi_penalty is None:
+            if self._log_scale is None:
+                self.wi_penalty = numpy.log(self.wi_penalty)
+            else:
+                self.wi_penalty *= self._log_scale
+
+        self.nodes = [self.Node(id) for id in range(self._num_nodes)]
+        self._allocate_links(self._num_links)
+
+        for line in lattice_file:
+            fields = self._split_slf_line(line)
+            if not fields:
+                continue
+            name, value = self._split_slf_field(fields[0])
+            if name == 'I':
+                self._read_slf_node(int(value), fields[1:])
+            elif name == 'J':
+                self._read_slf_link(int(value), fields[1:])
 
     def _read_slf_header(self, fields):
         """Reads SLF lattice header fields and saves them in member variables.
@@ -154,8 +227,25 @@ class SLFLattice(Lattice):
             elif (name == 'WORD') or (name == 'W'):
                 node.word = value
 
+    def _allocate_links(self, num_links):
+        """Allocates arrays for the link information that is read from the
+        lattice file.
+
+        :type num_links: int
+        :param num_links: number of links in the lattice
+        """
+
+        self._link_starts = numpy.full(num_links, -1, dtype='int64')
+        self._link_ends = numpy.full(num_links, -1, dtype='int64')
+        self._link_words = [None] * num_links
+        self._link_ac_values = numpy.full(num_links, numpy.nan)
+        self._link_lm_values = numpy.full(num_links, numpy.nan)
+
     def _read_slf_link(self, link_id, fields):
-        """Reads SLF lattice link fields and creates such link.
+        """Reads SLF lattice link fields and saves them in the link arrays.
+
+        The link objects are created by ``_create_links()`` after all the links
+        have been read.
 
         :type link_id: int
         :param link_id: ID of the link
@@ -164,41 +254,80 @@ class SLFLattice(Lattice):
         :param fields: the rest of the link fields after ID
         """
 
-        start_node = None
-        end_node = None
-        word = None
-        ac_logprob = None
-        lm_logprob = None
+        if (link_id < 0) or (link_id >= len(self._link_words)):
+            raise InputError("Invalid link ID in SLF lattice: {}".format(
+                             link_id))
 
         for field in fields:
-            name, value = self._split_slf_field(field)
+            name, separator, value = field.partition('=')
+            if not separator:
+                raise InputError("Expected '=' in SLF lattice field: "
+                                 "'{}'".format(field))
             if (name == 'START') or (name == 'S'):
-                start_node = self.nodes[int(value)]
+                self._link_starts[link_id] = int(value)
             elif (name == 'END') or (name == 'E'):
-                end_node = self.nodes[int(value)]
+                self._link_ends[link_id] = int(value)
             elif (name == 'WORD') or (name == 'W'):
-                word = value
+                self._link_words[link_id] = value
             elif (name == 'acoustic') or (name == 'a'):
-                if self._log_scale is None:
-                    ac_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    ac_logprob = logprob_type(value) * self._log_scale
+                self._link_ac_values[link_id] = float(value)
             elif (name == 'language') or (name == 'l'):
-                if self._log_scale is None:
-                    lm_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    lm_logprob = logprob_type(value) * self._log_scale
+                self._link_lm_values[link_id] = float(value)
 
-        if start_node is None:
+        if self._link_starts[link_id] < 0:
             raise InputError("Start node is not specified for link {}.".format(
                              link_id))
-        if end_node is None:
+        if self._link_ends[link_id] < 0:
             raise InputError("End node is not specified for link {}.".format(
                              link_id))
-        link = self._add_link(start_node, end_node)
-        link.word = word
-        link.ac_logprob = ac_logprob
-        link.lm_logprob = lm_logprob
+
+    def _create_links(self):
+        """Creates the link objects from the link arrays.
+        """
+
+        ac_logprobs, lm_logprobs = self._link_logprobs()
+        ac_missing = numpy.isnan(self._link_ac_values)
+        lm_missing = numpy.isnan(self._link_lm_values)
+
+        nodes = self.nodes
+        for link_id, word in enumerate(self._link_words):
+            link = self._add_link(nodes[self._link_starts[link_id]],
+                                  nodes[self._link_ends[link_id]])
+            link.word = word
+            if not ac_missing[link_id]:
+                link.ac_logprob = ac_logprobs[link_id]
+            if not lm_missing[link_id]:
+                link.lm_logprob = lm_logprobs[link_id]
+
+        self._allocate_links(0)
+
+    def _link_logprobs(self):
+        """Checks the link arrays and converts the acoustic and language model
+        scores to the internal log probability representation for all the
+        links at once.
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: the acoustic and language model log probabilities of the
+                  links, ``nan`` where the score is missing
+        """
+
+        if numpy.any(self._link_starts < 0):
+            raise InputError("Number of links in SLF lattice doesn't match the "
+                             "LINKS field.")
+        num_nodes = len(self.nodes)
+        if numpy.any(self._link_starts >= num_nodes) or \
+           numpy.any(self._link_ends >= num_nodes):
+            raise InputError("Invalid node ID in SLF lattice link.")
+
+        with numpy.errstate(divide='ignore'):
+            if self._log_scale is None:
+                ac_logprobs = numpy.log(self._link_ac_values)
+                lm_logprobs = numpy.log(self._link_lm_values)
+            else:
+                ac_logprobs = self._link_ac_values * self._log_scale
+                lm_logprobs = self._link_lm_values * self._log_scale
+        return ac_logprobs.astype(logprob_type), \
+               lm_logprobs.astype(logprob_type)
 
     def _split_slf_line(self, line):
         """Parses a list of fields from an SLF lattice line.
@@ -208,6 +337,9 @@ class SLFLattice(Lattice):
         " the double quote must be escaped (\"). I'm not surprise if other
         implementations or the standard doesn't agree.
 
+        Most lines don't contain quotes, escapes, or comments, and are split
+        using a regular expression. Other lines are parsed using ``shlex``.
+
         :type line: str
         :param line: a line from an SLF file
 
@@ -216,11 +348,29 @@ class SLFLattice(Lattice):
                   marks removed
         """
 
-        lex = shlex(line, posix=True)
-        lex.quotes = '"'
-        lex.wordchars += "'"
-        lex.whitespace_split = True
-        return list(lex)
+        if ('"' in line) or ('\\' in line) or ('#' in line):
+            lex = shlex(line, posix=True)
+            lex.quotes = '"'
+            lex.wordchars += "'"
+            lex.whitespace_split = True
+            return list(lex)
+        return self._field_pattern.findall(line)
+
+    def _format_slf_value(self, value):
+        """Quotes a field value for an SLF lattice, if necessary.
+
+        :type value: str
+        :param value: the value to be written
+
+        :rtype: str
+        :returns: the value, quoted and escaped if it contains whitespace,
+                  quotes, backslashes, or comment characters
+        """
+
+        if value and not any(char in value for char in ' \t\r\n"\\#'):
+            return value
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return '"' + value + '"'
 
     def _split_slf_field(self, field):
         """Parses the name and value from an SLF lattice field.
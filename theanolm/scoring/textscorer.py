@@ -5,6 +5,7 @@ import theano
 import theano.tensor as tensor
 import numpy
 from theanolm.matrixfunctions import test_value
+from theanolm.network import NumpyNetwork
 from theanolm.parsing import utterance_from_line
 from theanolm.exceptions import NumberError
 
@@ -13,7 +14,7 @@ class TextScorer(object):
     """
 
     def __init__(self, network, ignore_unk=False, unk_penalty=None,
-                 profile=False):
+                 profile=False, log_normalizer=None, function_cache=None):
         """Creates two Theano function, ``self._target_logprobs_function()``,
         which computes the log probabilities predicted by the neural network for
         the words in a mini-batch, and ``self._total_logprob_function()``, which
@@ -49,13 +50,59 @@ class TextScorer(object):
 
         :type profile: bool
         :param profile: if set to True, creates a Theano profile object
+
+        :type log_normalizer: float
+        :param log_normalizer: if set to other than None, the output is not
+                               normalized over the vocabulary, but this constant
+                               is subtracted from the target preactivations
+                               (only for self-normalized softmax models)
+
+        :type function_cache: FunctionCache
+        :param function_cache: if set to other than None, the compiled functions
+                               are read from and written to this cache
         """
 
+        self._network = network
+        self._profile = profile
+        self._log_normalizer = log_normalizer
+        self._log_normalizer_function = None
         self._ignore_unk = ignore_unk
         self._unk_penalty = unk_penalty
         self._vocabulary = network.vocabulary
         self._unk_id = network.vocabulary.word_to_id['<unk>']
 
+        # These are updated by score_line() and score_lines().
+        self.num_words = 0
+        self.num_unks = 0
+
+        # A NumPy network is evaluated directly, without compiling functions.
+        if isinstance(network, NumpyNetwork):
+            self._target_logprobs_function = self._numpy_target_logprobs
+            self._total_logprob_function = self._numpy_total_logprob
+            return
+
+        if (function_cache is None) or profile:
+            functions = self._create_functions()
+        else:
+            options = {'ignore_unk': ignore_unk,
+                       'unk_penalty': unk_penalty,
+                       'log_normalizer': log_normalizer}
+            functions = function_cache.get_functions(
+                network, 'target_logprobs', options, self._create_functions)
+        self._target_logprobs_function, self._total_logprob_function = \
+            functions
+
+    def _create_functions(self):
+        """Compiles the Theano functions that compute the target word log
+        probabilities and the total log probability of a mini-batch.
+
+        :rtype: list of theano.compile.function_module.Functions
+        :returns: the target log probabilities function and the total log
+                  probability function
+        """
+
+        network = self._network
+
         # The functions take as input a mini-batch of word IDs and class IDs,
         # and slice input and target IDs for the network.
         batch_word_ids = tensor.matrix('textscorer/batch_word_ids',
@@ -71,10 +118,12 @@ class TextScorer(object):
         membership_probs.tag.test_value = test_value(
             size=(100, 16), high=1.0)
 
-        logprobs = tensor.log(network.target_probs())
+        logprobs = network.target_logprobs(self._log_normalizer)
         # Add logprobs from the class membership of the predicted word at each
-        # time step of each sequence.
-        logprobs += tensor.log(membership_probs)
+        # time step of each sequence, unless the network predicts the words
+        # directly.
+        if not network.predicts_words:
+            logprobs += tensor.log(membership_probs)
         # If requested, predict <unk> with constant score.
         target_word_ids = batch_word_ids[1:]
         if not self._unk_penalty is None:
@@ -91,30 +140,29 @@ class TextScorer(object):
 
         # Ignore unused input variables, because is_training is only used by
         # dropout layer.
-        self._target_logprobs_function = theano.function(
+        target_logprobs_function = theano.function(
             [batch_word_ids, batch_class_ids, membership_probs, network.mask],
             [logprobs, mask],
             givens=[(network.input_word_ids, batch_word_ids[:-1]),
                     (network.input_class_ids, batch_class_ids[:-1]),
+                    (network.target_word_ids, batch_word_ids[1:]),
                     (network.target_class_ids, batch_class_ids[1:]),
                     (network.is_training, numpy.int8(0))],
             name='target_logprobs',
             on_unused_input='ignore',
-            profile=profile)
-        self._total_logprob_function = theano.function(
+            profile=self._profile)
+        total_logprob_function = theano.function(
             [batch_word_ids, batch_class_ids, membership_probs, network.mask],
             [logprobs.sum(), mask.sum()],
             givens=[(network.input_word_ids, batch_word_ids[:-1]),
                     (network.input_class_ids, batch_class_ids[:-1]),
+                    (network.target_word_ids, batch_word_ids[1:]),
                     (network.target_class_ids, batch_class_ids[1:]),
                     (network.is_training, numpy.int8(0))],
             name='total_logprob',
             on_unused_input='ignore',
-            profile=profile)
-
-        # These are updated by score_line().
-        self.num_words = 0
-        self.num_unks = 0
+            profile=self._profile)
+        return [target_logprobs_function, total_logprob_function]
 
     def score_batch(self, word_ids, class_ids, membership_probs, mask):
         """Computes the log probabilities predicted by the neural network for
@@ -214,6 +262,109 @@ class TextScorer(object):
         cross_entropy = -logprob / num_words
         return numpy.exp(cross_entropy)
 
+    def estimate_log_normalizer(self, batch_iter):
+        """Computes the average logarithm of the softmax normalizer on text
+        read using the given iterator.
+
+        The result can be given as ``log_normalizer`` to the constructor, when
+        scoring text with a self-normalized model. The Theano function that
+        computes the normalizers is compiled on the first call.
+
+        :type batch_iter: BatchIterator
+        :param batch_iter: an iterator that creates mini-batches from the input
+                           data
+
+        :rtype: float
+        :returns: the mean of the log normalizer over the predicted words
+        """
+
+        if isinstance(self._network, NumpyNetwork):
+            self._log_normalizer_function = self._numpy_log_normalizer
+        if self._log_normalizer_function is None:
+            network = self._network
+            batch_word_ids = tensor.matrix('textscorer/batch_word_ids',
+                                           dtype='int64')
+            batch_word_ids.tag.test_value = test_value(
+                size=(101, 16), high=self._vocabulary.num_words())
+            batch_class_ids = tensor.matrix('textscorer/batch_class_ids',
+                                            dtype='int64')
+            batch_class_ids.tag.test_value = test_value(
+                size=(101, 16), high=self._vocabulary.num_classes())
+            log_normalizers = network.log_normalizers()
+            log_normalizers *= tensor.cast(network.mask, theano.config.floatX)
+            self._log_normalizer_function = theano.function(
+                [batch_word_ids, batch_class_ids, network.mask],
+                [log_normalizers.sum(), network.mask.sum()],
+                givens=[(network.input_word_ids, batch_word_ids[:-1]),
+                        (network.input_class_ids, batch_class_ids[:-1]),
+                        (network.is_training, numpy.int8(0))],
+                name='log_normalizer',
+                on_unused_input='ignore',
+                profile=self._profile)
+
+        total = 0.0
+        num_words = 0
+        for word_ids, _, mask in batch_iter:
+            class_ids = self._vocabulary.word_id_to_class_id[word_ids]
+            batch_total, batch_num_words = \
+                self._log_normalizer_function(word_ids, class_ids, mask[1:])
+            total += batch_total
+            num_words += batch_num_words
+
+        if num_words == 0:
+            raise ValueError("Zero words for estimating the softmax "
+                             "normalizer.")
+        return total / num_words
+
+    def _numpy_target_logprobs(self, batch_word_ids, batch_class_ids,
+                               membership_probs, mask):
+        """Computes the log probabilities of the words in a mini-batch using a
+        NumPy network. Takes the same arguments and returns the same outputs as
+        ``self._target_logprobs_function()`` with a Theano network.
+        """
+
+        network = self._network
+        network.forward(batch_word_ids[:-1], batch_class_ids[:-1], mask)
+        logprobs = network.target_logprobs(batch_class_ids[1:],
+                                           self._log_normalizer)
+        # Add logprobs from the class membership of the predicted word at each
+        # time step of each sequence.
+        logprobs += numpy.log(membership_probs)
+        # If requested, predict <unk> with constant score.
+        target_word_ids = batch_word_ids[1:]
+        if not self._unk_penalty is None:
+            logprobs[target_word_ids == self._unk_id] = self._unk_penalty
+        # Ignore logprobs predicting a word that is past the sequence end, and
+        # possibly also those that are predicting <unk> token.
+        if self._ignore_unk:
+            mask = mask * (target_word_ids != self._unk_id)
+        logprobs *= mask
+        return logprobs, mask
+
+    def _numpy_total_logprob(self, batch_word_ids, batch_class_ids,
+                             membership_probs, mask):
+        """Computes the total log probability of the words in a mini-batch
+        using a NumPy network. Takes the same arguments and returns the same
+        outputs as ``self._total_logprob_function()`` with a Theano network.
+        """
+
+        logprobs, mask = self._numpy_target_logprobs(batch_word_ids,
+                                                     batch_class_ids,
+                                                     membership_probs,
+                                                     mask)
+        return logprobs.sum(), mask.sum()
+
+    def _numpy_log_normalizer(self, batch_word_ids, batch_class_ids, mask):
+        """Computes the sum of the log normalizers in a mini-batch using a
+        NumPy network. Takes the same arguments and returns the same outputs as
+        ``self._log_normalizer_function()`` with a Theano network.
+        """
+
+        network = self._network
+        network.forward(batch_word_ids[:-1], batch_class_ids[:-1], mask)
+        log_normalizers = network.log_normalizers() * mask
+        return log_normalizers.sum(), mask.sum()
+
     def score_sequence(self, word_ids, class_ids, membership_probs):
         """Computes the log probability of a word sequence.
 
@@ -280,13 +431,68 @@ class TextScorer(object):
         self.num_words += word_ids.size
         self.num_unks += numpy.count_nonzero(word_ids == unk_id)
 
-        class_ids = [vocabulary.word_id_to_class_id[word_id]
-                     for word_id in word_ids]
-        probs = [vocabulary.get_word_prob(word_id)
-                 for word_id in word_ids]
+        class_ids, probs = vocabulary.get_class_memberships(word_ids)
 
         return self.score_sequence(word_ids, class_ids, probs)
 
+    def score_lines(self, lines, vocabulary):
+        """Scores several lines of text in one mini-batch.
+
+        Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
+        inserted at the beginning and the end of each line, if they're missing.
+        The result contains ``None`` in place of empty lines, like
+        ``score_line()``.
+
+        :type lines: list of strs
+        :param lines: word sequences
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary for converting the words to word IDs
+
+        :rtype: list of floats
+        :returns: log probability of each word sequence, or None for empty
+                  lines
+        """
+
+        result = [None] * len(lines)
+        sequences = [utterance_from_line(line) for line in lines]
+        indices = [index for index, words in enumerate(sequences) if words]
+        if not indices:
+            return result
+
+        unk_id = vocabulary.word_to_id['<unk>']
+        batch_length = max(len(sequences[index]) for index in indices)
+        shape = (batch_length, len(indices))
+        word_ids = numpy.ones(shape, numpy.int64) * unk_id
+        mask = numpy.zeros(shape, numpy.int8)
+        for column, index in enumerate(indices):
+            sequence_word_ids = vocabulary.words_to_ids(sequences[index])
+            self.num_words += sequence_word_ids.size
+            self.num_unks += numpy.count_nonzero(sequence_word_ids == unk_id)
+            length = sequence_word_ids.size
+            word_ids[:length, column] = sequence_word_ids
+            mask[:length, column] = 1
+
+        class_ids, membership_probs = vocabulary.get_class_memberships(word_ids)
+        membership_probs = membership_probs.astype(theano.config.floatX)
+
+        # target_logprobs_function() uses the word and class IDs of the entire
+        # mini-batch, but membership probs and mask are only for the output.
+        # The log probabilities past the sequence ends are zero.
+        logprobs, _ = self._target_logprobs_function(word_ids,
+                                                     class_ids,
+                                                     membership_probs[1:],
+                                                     mask[1:])
+        logprobs = logprobs.sum(0)
+        if numpy.any(numpy.isnan(logprobs)):
+            raise NumberError("Log probability of a sequence is NaN.")
+        if numpy.any(numpy.isinf(logprobs)):
+            raise NumberError("Log probability of a sequence is +/- infinity.")
+
+        for column, index in enumerate(indices):
+            result[index] = logprobs[column]
+        return result
+
     def unk_ignored(self):
         """Indicates whether the scorer ignores <unk> tokens.
 
@@ -3,7 +3,7 @@
 
 import numpy
 import theano
-from theanolm.network import RecurrentState
+from theanolm.network import RecurrentState, NumpyNetwork
 
 class TextSampler(object):
     """Neural network language model sampler
@@ -12,7 +12,7 @@ class TextSampler(object):
     model.
     """
 
-    def __init__(self, network):
+    def __init__(self, network, function_cache=None):
         """Creates a Theano function that samples the next word of a set of word
         sequences.
 
@@ -24,11 +24,36 @@ class TextSampler(object):
 
         :type network: Network
         :param network: the neural network object
+
+        :type function_cache: FunctionCache
+        :param function_cache: if set to other than None, the compiled function
+                               is read from and written to this cache
         """
 
         self._network = network
         self._vocabulary = network.vocabulary
-        self._random = network.random
+
+        # A NumPy network is evaluated directly, without compiling a function.
+        if isinstance(network, NumpyNetwork):
+            self.step_function = self._numpy_step
+            return
+
+        if function_cache is None:
+            self.step_function = self._create_step_function()
+        else:
+            self.step_function, = function_cache.get_functions(
+                network, 'step_sampler', dict(),
+                lambda: [self._create_step_function()])
+
+    def _create_step_function(self):
+        """Compiles the Theano function that samples the next word of a set of
+        word sequences.
+
+        :rtype: theano.compile.function_module.Function
+        :returns: the step function
+        """
+
+        network = self._network
 
         inputs = [network.input_word_ids, network.input_class_ids]
         inputs.extend(network.recurrent_state_input)
@@ -36,20 +61,39 @@ class TextSampler(object):
         # multinomial() is only implemented for dimension <= 2, but the matrix
         # contains only one time step anyway.
         output_probs = network.output_probs()[0]
-        class_ids = self._random.multinomial(pvals=output_probs).argmax(1)
+        class_ids = network.random.multinomial(pvals=output_probs).argmax(1)
         class_ids = class_ids.reshape([1, class_ids.shape[0]])
         outputs = [class_ids]
         outputs.extend(network.recurrent_state_output)
 
         # Ignore unused input, because is_training is only used by dropout
         # layer.
-        self.step_function = theano.function(
+        return theano.function(
             inputs,
             outputs,
             givens=[(network.is_training, numpy.int8(0))],
             name='step_sampler',
             on_unused_input='ignore')
 
+    def _numpy_step(self, word_ids, class_ids, *state):
+        """Samples the next word of a set of word sequences using a NumPy
+        network. Takes the same arguments and returns the same outputs as
+        ``self.step_function()`` with a Theano network.
+        """
+
+        self._network.forward(word_ids, class_ids, recurrent_state=list(state))
+        output_probs = self._network.output_probs()[0]
+        # Sample one class per sequence by inverting the cumulative
+        # distribution.
+        cumulative_probs = output_probs.cumsum(axis=1)
+        thresholds = numpy.random.random_sample(cumulative_probs.shape[0])
+        thresholds *= cumulative_probs[:, -1]
+        class_ids = (cumulative_probs < thresholds[:, None]).sum(axis=1)
+        class_ids = numpy.minimum(class_ids, output_probs.shape[1] - 1)
+        result = [class_ids.reshape([1, -1]).astype('int64')]
+        result.extend(self._network.recurrent_state_output)
+        return result
+
     def generate(self, length, num_sequences=1):
         """Generates a text sequence.
 
@@ -85,11 +129,17 @@ class TextSampler(object):
             step_result = self.step_function(input_word_ids,
                                              input_class_ids,
                                              *state.get())
-            class_ids = step_result[0]
-            # The class IDs from the single time step.
-            step_class_ids = class_ids[0]
-            step_word_ids = numpy.array(
-                self._vocabulary.class_ids_to_word_ids(step_class_ids))
+            if self._network.predicts_words:
+                # The network samples words directly from the class-factored
+                # distribution.
+                step_word_ids = step_result[0][0]
+                class_ids = self._vocabulary.word_id_to_class_id[step_result[0]]
+            else:
+                class_ids = step_result[0]
+                # The class IDs from the single time step.
+                step_class_ids = class_ids[0]
+                step_word_ids = numpy.array(
+                    self._vocabulary.class_ids_to_word_ids(step_class_ids))
             result[time_step] = step_word_ids
             input_word_ids = step_word_ids[numpy.newaxis]
             input_class_ids = class_ids
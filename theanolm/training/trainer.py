@@ -8,6 +8,7 @@ import h5py
 import numpy
 import theano
 from theanolm import ShufflingBatchIterator, LinearBatchIterator
+from theanolm.parsing import PrefetchingBatchIterator
 from theanolm.exceptions import IncompatibleStateError, NumberError
 from theanolm.training.stoppers import create_stopper
 
@@ -73,7 +74,13 @@ class Trainer(object):
             sampling,
             vocabulary,
             batch_size=training_options['batch_size'],
-            max_sequence_length=training_options['sequence_length'])
+            max_sequence_length=training_options['sequence_length'],
+            sentence_index_cache=training_options['sentence_index_cache'])
+        # Prepares the mini-batches and class IDs in a background thread.
+        self._training_iter = PrefetchingBatchIterator(
+            self._training_iter,
+            vocabulary,
+            training_options['prefetch_batches'])
 
         self._stopper = create_stopper(training_options, self)
         self._options = training_options
@@ -199,11 +206,10 @@ class Trainer(object):
         start_time = time()
         while self._stopper.start_new_epoch():
             epoch_start_time = time()
-            for word_ids, file_ids, mask in self._training_iter:
+            for word_ids, class_ids, file_ids, mask in self._training_iter:
                 self.update_number += 1
                 self._total_updates += 1
 
-                class_ids = self._vocabulary.word_id_to_class_id[word_ids]
                 update_start_time = time()
                 self._optimizer.update_minibatch(word_ids, class_ids, file_ids, mask)
                 self._update_duration = time() - update_start_time
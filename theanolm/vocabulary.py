@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from collections import OrderedDict
+import hashlib
 import numpy
 import h5py
 from theanolm.parsing import utterance_from_line
@@ -240,6 +241,7 @@ class Vocabulary(object):
         self._word_classes = numpy.asarray(word_classes)
         self.word_to_id = {word: word_id
                            for word_id, word in enumerate(self.id_to_word)}
+        self._update_word_probs()
 
     @classmethod
     def from_file(classname, input_file, input_format):
@@ -461,6 +463,7 @@ class Vocabulary(object):
                 prob = 1.0 / len(cls)
                 for word_id, _ in cls:
                     cls.set_prob(word_id, prob)
+        self._update_word_probs()
 
     def get_state(self, state):
         """Saves the vocabulary in a network state file.
@@ -487,12 +490,10 @@ class Vocabulary(object):
         else:
             h5_vocabulary.create_dataset('classes', data=self.word_id_to_class_id)
 
-        probs = [self._word_classes[class_id].get_prob(word_id)
-                 for word_id, class_id in enumerate(self.word_id_to_class_id)]
         if 'probs' in h5_vocabulary:
-            state['probs'][:] = probs
+            state['probs'][:] = self._word_probs
         else:
-            h5_vocabulary.create_dataset('probs', data=probs)
+            h5_vocabulary.create_dataset('probs', data=self._word_probs)
 
     def num_words(self):
         """Returns the number of words in the vocabulary.
@@ -512,6 +513,19 @@ class Vocabulary(object):
 
         return self._word_classes.size
 
+    def checksum(self):
+        """Computes a checksum of the mapping from words to word IDs.
+
+        Data that has been converted to word IDs using this vocabulary can be
+        used with another vocabulary that has the same checksum.
+
+        :rtype: str
+        :returns: SHA-1 digest of the word list as a hexadecimal string
+        """
+
+        word_list = '\n'.join(self.id_to_word)
+        return hashlib.sha1(word_list.encode('utf-8')).hexdigest()
+
     def words_to_ids(self, words):
         """Translates words into word IDs.
 
@@ -523,13 +537,9 @@ class Vocabulary(object):
         """
 
         unk_id = self.word_to_id['<unk>']
-        result = numpy.zeros(len(words), dtype='int64')
-        for index, word in enumerate(words):
-            if word in self.word_to_id:
-                result[index] = self.word_to_id[word]
-            else:
-                result[index] = unk_id
-        return result
+        get_id = self.word_to_id.get
+        return numpy.fromiter((get_id(word, unk_id) for word in words),
+                              dtype='int64', count=len(words))
 
     def class_ids_to_word_ids(self, class_ids):
         """Samples a word from the membership probability distribution of a
@@ -555,9 +565,7 @@ class Vocabulary(object):
         :returns: the probability of the word within its class
         """
 
-        class_id = self.word_id_to_class_id[word_id]
-        word_class = self._word_classes[class_id]
-        return word_class.get_prob(word_id)
+        return self._word_probs[word_id]
 
     def get_class_memberships(self, word_ids):
         """Finds the classes and class membership probabilities given a matrix
@@ -571,10 +579,21 @@ class Vocabulary(object):
                   second one containing class membership probabilities
         """
 
-        class_ids = self.word_id_to_class_id[word_ids]
-        word_classes = self._word_classes[class_ids]
-        get_probs = numpy.vectorize(lambda wc, wid: wc.get_prob(wid))
-        return class_ids, get_probs(word_classes, word_ids)
+        return self.word_id_to_class_id[word_ids], self._word_probs[word_ids]
+
+    def _update_word_probs(self):
+        """Copies the class membership probabilities of the words from the word
+        classes into an array indexed by word ID.
+
+        The array is used for looking up the membership probabilities of entire
+        mini-batches using one indexing operation. It has to be updated
+        whenever the probabilities in the word classes are changed.
+        """
+
+        self._word_probs = numpy.zeros(self.num_words(), dtype='float64')
+        for word_class in self._word_classes:
+            for word_id, prob in word_class:
+                self._word_probs[word_id] = prob
 
     def words(self):
         """A generator for iterating through the words in the vocabulary.